@@ -17,8 +17,18 @@
 
 
 from .backtesting_engine import BacktestingEngine
+from .bar_cache import BarCache
+from .data_cache import DataFrameCache
+from .data_catalog import DataCatalog
+from .data_schema import KLineSchema
+from .data_store import PartitionedDataStore
 from .data_engine import DataProcessingInterface, HKEXInterface, YahooFinanceInterface, TuShareInterface
+from .download_scheduler import DownloadScheduler, TokenBucket
 from .email_engine import EmailEngine
+from .fundamentals_store import FundamentalsStore
+from .history_cache import YahooHistoryCache
 from .order_engine import *
+from .security_master import SecurityMaster
 from .stock_filter_engine import *
+from .trade_ledger import TradeLedger
 from .trading_engine import FutuTrade
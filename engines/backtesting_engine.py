@@ -16,15 +16,17 @@
 #  Copyright (c)  billpwchan - All Rights Reserved
 
 
-import json
+import time
 import warnings
-from collections import ChainMap
 from datetime import date, datetime, timedelta
-from multiprocessing import Pool, cpu_count
 
+import numpy as np
 import pandas as pd
 
-from engines.data_engine import DataProcessingInterface, HKEXInterface
+from engines.bar_cache import BarCache
+from engines.data_engine import DataProcessingInterface
+from engines.security_master import SecurityMaster
+from engines.trade_ledger import TradeLedger
 from strategies.Strategies import Strategies
 from util import logger
 from util.global_vars import *
@@ -55,53 +57,39 @@ class BacktestingEngine:
         self.input_data = None
         self.positions = {}
         self.transactions = pd.DataFrame(columns=['time_key', 'code', 'price', 'quantity', 'trd_side'])
-        self.board_lot_mapping = HKEXInterface.get_board_lot_full()
+        self.security_master = SecurityMaster.shared()
         self.returns_df = pd.DataFrame(0, columns=self.stock_list, index=self.date_range)
         self.returns_df = self.returns_df.apply(pd.to_numeric)
         self.fixed_charge = self.config['Backtesting.Commission.HK'].getfloat('FixedCharge')
         self.perc_charge = self.config['Backtesting.Commission.HK'].getfloat('PercCharge')
+        self.report_path = PATH_BACKTESTING_REPORT
+        self.ledger = TradeLedger(self.fixed_charge, self.perc_charge)
 
-    def prepare_input_data_file_1M(self) -> None:
+    def prepare_input_data_file_1M(self, columns: list = Strategies.REQUIRED_COLUMNS) -> None:
         """
         Prepare input data with 1M interval. Directly load data from stored .csv file (Assume 1M data already downloaded)
+        :param columns: Columns required by the strategy (None = All). Other columns are never decoded
         """
-        self.input_data = DataProcessingInterface.get_1M_data_range(self.date_range, self.stock_list)
-
-    def process_custom_interval_data(self, stock_code, column_names, custom_interval: int = 5):
-        output_dict = {}
-        for input_date in self.date_range:
-            custom_dict = DataProcessingInterface.get_custom_interval_data(target_date=input_date,
-                                                                           custom_interval=custom_interval,
-                                                                           stock_list=[stock_code])
-            for stock_code, df in custom_dict.items():
-                output_dict[stock_code] = pd.concat(
-                    [output_dict.get(stock_code, pd.DataFrame(columns=column_names)), df],
-                    ignore_index=True)
-
-        for stock_code, input_df in output_dict.items():
-            input_df[['open', 'close', 'high', 'low']] = input_df[['open', 'close', 'high', 'low']].apply(pd.to_numeric)
-            input_df.sort_values(by='time_key', ascending=True, inplace=True)
-        return output_dict
-
-    def prepare_input_data_file_custom_M(self, custom_interval: int = 5) -> None:
+        self.input_data = DataProcessingInterface.get_1M_data_range(self.date_range, self.stock_list, columns=columns)
+
+    def prepare_input_data_file_custom_M(self, custom_interval: int = 5,
+                                         columns: list = Strategies.REQUIRED_COLUMNS) -> None:
         """
         Prepare input data with customized interval. Generated based on 1M data.
-        Multi-threading enabled
+        Materialized bars are used if the interval is cached (see BarCache). Otherwise, all stocks and days are
+        resampled together in one vectorized pass
         :param custom_interval: Integer
+        :param columns: Columns required by the strategy (None = All). Other columns are never decoded
         """
-        column_names = json.loads(self.config.get('FutuOpenD.DataFormat', 'HistoryDataFormat'))
-
-        # Use Starmap to pass multiple arguments into process_custom_interval_data function
-        # Received a list of dict in format [{'HK.00001': pd.Dataframe}, {...}]
-        pool = Pool(min(cpu_count(), len(self.stock_list)))
-        list_of_custom_dict = pool.starmap(self.process_custom_interval_data,
-                                           [(stock_code, column_names, custom_interval) for stock_code in
-                                            self.stock_list])
-        pool.close()
-        pool.join()
-
-        output_dict = dict(ChainMap(*list_of_custom_dict))
-        self.input_data = output_dict
+        if custom_interval in BarCache.get_materialized_intervals():
+            self.input_data = BarCache().get_custom_interval_data_range(date_range=self.date_range,
+                                                                        custom_interval=custom_interval,
+                                                                        stock_list=self.stock_list, columns=columns)
+            return
+        self.input_data = DataProcessingInterface.get_custom_interval_data_range(date_range=self.date_range,
+                                                                                 custom_interval=custom_interval,
+                                                                                 stock_list=self.stock_list,
+                                                                                 columns=columns)
 
     def get_backtesting_init_data(self) -> dict:
         return {key: value.copy().iloc[:min(value.shape[0], self.observation)] for (key, value) in
@@ -126,7 +114,6 @@ class BacktestingEngine:
             # Remove duplicated indices
             ta_backtesting_data[stock_code] = ta_backtesting_data[stock_code][
                 ~ta_backtesting_data[stock_code].index.duplicated(keep='first')]
-        ta_backtesting_data['HK.01997'].to_csv("STEP 2.csv")
 
         # Gather all unique dates
         sequence_time = list(unique_time)
@@ -160,15 +147,12 @@ class BacktestingEngine:
                     if self.positions.get(stock_code, 0) == 0 and self.capital >= 0:
                         self.positions[stock_code] = self.positions.get(stock_code, row['close'])
                         current_price = row['close']
-                        lot_size = self.board_lot_mapping.get(stock_code, 0)
+                        lot_size = self.security_master.get_board_lot(stock_code, 0)
                         qty = lot_size * self.lot_size_multiplier
 
                         # Update Holding Capital
                         self.capital -= current_price * qty
-                        # Update Transaction History Dataframe
-                        self.transactions = self.transactions.append(
-                            pd.Series([row['time_key'], stock_code, current_price, qty, 'BUY'],
-                                      index=self.transactions.columns), ignore_index=True)
+                        self.ledger.add_fill(row['time_key'], stock_code, current_price, qty, 'BUY')
                         self.default_logger.info(f"SIMULATE BUY ORDER for {stock_code} using PRICE {row['close']}")
                     elif self.positions.get(stock_code, 0) != 0:
                         self.default_logger.info(
@@ -176,31 +160,105 @@ class BacktestingEngine:
                 if self.strategy.sell(stock_code) or index == list(ta_backtesting_data.values())[0].shape[0] - 1:
                     if self.positions.get(stock_code, 0) != 0:
                         current_price = row['close']
-                        buy_price = self.positions[stock_code]
                         # Sell all holding assets
-                        lot_size = self.board_lot_mapping.get(stock_code, 0)
+                        lot_size = self.security_master.get_board_lot(stock_code, 0)
                         qty = lot_size * self.lot_size_multiplier
 
                         # Profit = EBIT - fixed charge (15 HKD * 2) - Percentage Charge (Buy Value + Sale Value) * 0.10%
-                        EBIT = (current_price - buy_price) * qty
-                        profit = EBIT - 2 * self.fixed_charge - (
-                                buy_price + current_price) * qty * self.perc_charge / 100 / 2
-                        current_date = datetime.strptime(row['time_key'], '%Y-%m-%d  %H:%M:%S').date()
-
-                        self.returns_df.loc[str(current_date), stock_code] += profit
+                        profit = self.ledger.add_fill(row['time_key'], stock_code, current_price, qty, 'SELL')
                         self.capital += current_price * qty
-                        self.transactions = self.transactions.append(
-                            pd.Series([row['time_key'], stock_code, current_price, qty, 'SELL'],
-                                      index=self.transactions.columns), ignore_index=True)
                         self.default_logger.info(f"SIMULATE SELL ORDER FOR {stock_code} using PRICE {row['close']}")
                         self.default_logger.info(f"PROFIT earned: {profit}")
                         # Update Positions
                         self.positions.pop(stock_code, None)
 
+        self.save_report()
+
+    def calculate_return_vectorized(self) -> None:
+        """
+        Vectorized backtesting mode with the same rules & reports as calculate_return.
+        The buy / sell signals of each stock are computed once over its whole history (strategy.get_signals), and the
+        positions are resolved in one time-ordered pass over the bars with a signal instead of evaluating the strategy
+        for every bar of every stock.
+        """
+        start = time.time()
+        stock_data = {}
+        for stock_code in self.stock_list:
+            input_df = self.input_data[stock_code].reset_index(drop=True)
+            signals = self.strategy.get_signals(input_df)
+            # Bars with duplicated time_key are dropped after calculating the indicators (as in calculate_return)
+            unique_rows = ~input_df['time_key'].duplicated(keep='first').to_numpy()
+            stock_data[stock_code] = (input_df[unique_rows].reset_index(drop=True),
+                                      signals[unique_rows].reset_index(drop=True))
+        # Same evaluated bars as calculate_return: all unique timestamps, skipping 2 observation windows at the start
+        sequence_time = np.array(sorted(set().union(*[input_df['time_key'] for input_df, _ in stock_data.values()])),
+                                 dtype=object)[self.observation:]
+        # calculate_return liquidates all positions at the bar index given by the length of the first stock
+        last_index = stock_data[self.stock_list[0]][0].shape[0] - 1
+
+        stock_signals = []
+        for stock_code in self.stock_list:
+            input_df, signals = stock_data[stock_code]
+            rows = pd.Index(input_df['time_key']).get_indexer(sequence_time)
+            indices = np.arange(self.observation, len(sequence_time))
+            # A bar is evaluated if the stock has both the start and the end timestamp of the observation window
+            indices = indices[(rows[indices] >= 0) & (rows[indices - self.observation] >= 0)]
+            rows = rows[indices]
+            buy = signals['buy'].to_numpy(dtype=bool)[rows]
+            sell = signals['sell'].to_numpy(dtype=bool)[rows] | (indices == last_index)
+            # Only the bars with a signal can change the position
+            rows, indices, buy, sell = rows[buy | sell], indices[buy | sell], buy[buy | sell], sell[buy | sell]
+            qty = self.security_master.get_board_lot(stock_code, 0) * self.lot_size_multiplier
+            stock_signals.append({
+                'indices': indices, 'time_keys': input_df['time_key'].to_numpy()[rows],
+                'close':   input_df['close'].to_numpy(dtype=float)[rows], 'buy': buy, 'sell': sell,
+                'qty':     np.full(len(rows), qty, dtype=float)
+            })
+
+        # Signal bars of all stocks in the order of calculate_return (timestamp, stock). The capital is shared by all
+        # stocks, so the positions are resolved in one pass: a buy is skipped while the capital is negative
+        indices = np.concatenate([signals['indices'] for signals in stock_signals])
+        stock_indices = np.concatenate([np.full(len(signals['indices']), stock_index) for stock_index, signals in
+                                        enumerate(stock_signals)])
+        order = np.lexsort((stock_indices, indices))
+        stock_indices = stock_indices[order]
+        time_keys, close, qty, buy, sell = [np.concatenate([signals[column] for signals in stock_signals])[order] for
+                                            column in ['time_keys', 'close', 'qty', 'buy', 'sell']]
+        holding = np.zeros(len(self.stock_list), dtype=bool)
+        num_orders = 0
+        for time_key, stock_index, price, quantity, buy_signal, sell_signal in zip(
+                time_keys, stock_indices.tolist(), close.tolist(), qty.tolist(), buy.tolist(), sell.tolist()):
+            stock_code = self.stock_list[stock_index]
+            if buy_signal and not holding[stock_index] and self.capital >= 0:
+                holding[stock_index] = True
+                self.capital -= price * quantity
+                self.ledger.add_fill(time_key, stock_code, price, quantity, 'BUY')
+                self.positions[stock_code] = price
+                num_orders += 1
+            # A sell signal is applied after the buy signal of the same bar
+            if sell_signal and holding[stock_index]:
+                holding[stock_index] = False
+                self.capital += price * quantity
+                self.ledger.add_fill(time_key, stock_code, price, quantity, 'SELL')
+                self.positions.pop(stock_code, None)
+                num_orders += 1
+
+        self.default_logger.info(f'Vectorized backtesting of {len(self.stock_list)} stocks: {num_orders} orders in '
+                                 f'{time.time() - start:.2f}s')
+        self.save_report()
+
+    def save_report(self) -> None:
+        """
+        Materialize the ledger into the Returns / Transactions reports (and all fills as Parquet)
+        """
+        self.transactions = self.ledger.get_transactions_df()
+        self.returns_df = self.ledger.get_returns_df(self.date_range, self.stock_list)
         self.returns_df['returns'] = self.returns_df.sum(axis=1)
         time_key = datetime.now().strftime("%Y_%m_%d-%I_%M_%S_%p")
-        self.returns_df.to_csv(f'./backtesting_report/{time_key}_Returns.csv')
-        self.transactions.to_csv(f'./backtesting_report/{time_key}_Transactions.csv')
+        self.report_path.mkdir(parents=True, exist_ok=True)
+        self.returns_df.to_csv(self.report_path / f'{time_key}_Returns.csv')
+        self.transactions.to_csv(self.report_path / f'{time_key}_Transactions.csv')
+        self.ledger.save(self.report_path / f'{time_key}_Fills.parquet')
 
     # def create_tear_sheet(self):
     #     return_ser = pd.read_csv('output.csv', index_col=0, header=0)
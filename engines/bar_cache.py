@@ -0,0 +1,217 @@
+#  Futu Algo: Algorithmic High-Frequency Trading Framework
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#  Written by Bill Chan <billpwchan@hotmail.com>, 2021
+#  Copyright (c)  billpwchan - All Rights Reserved
+
+
+import hashlib
+import json
+import os
+
+import pandas as pd
+
+from engines.data_catalog import DataCatalog
+from engines.data_engine import DataProcessingInterface
+from engines.data_store import PartitionedDataStore
+from util import logger
+from util.global_vars import *
+
+
+class BarCache:
+    """
+        Materialized Customized-Interval bars (e.g., 3M/5M/15M/30M/60M) derived from 1M data.
+        Derived bars are stored next to the 1M data as data/{stock_code}/{stock_code}_{YYYY-MM-DD}_{N}M.parquet
+        The manifest data/{stock_code}/{stock_code}_bar_cache.json records the mtime, size and content hash of the
+        1M source of every trading day, so only the days with changed 1M data are rebuilt.
+    """
+    default_logger = logger.get_logger("bar_cache")
+
+    def __init__(self, root: Path = PATH_DATA, intervals: list = None):
+        self.root = Path(root)
+        self.intervals = intervals if intervals is not None else BarCache.get_materialized_intervals()
+        self.data_store = PartitionedDataStore(root=self.root)
+
+    @staticmethod
+    def get_materialized_intervals() -> list:
+        """
+            Customized-Intervals (in Minutes) to materialize during daily update, as defined in config.ini
+        """
+        return json.loads(config.get('DataStore', 'MaterializedIntervals', fallback='[]'))
+
+    def get_bar_path(self, stock_code: str, trading_date: str, custom_interval: int) -> Path:
+        return self.root / stock_code / f'{stock_code}_{trading_date}_{custom_interval}M.parquet'
+
+    def get_manifest_path(self, stock_code: str) -> Path:
+        return self.root / stock_code / f'{stock_code}_bar_cache.json'
+
+    def load_manifest(self, stock_code: str) -> dict:
+        manifest_path = self.get_manifest_path(stock_code)
+        if not manifest_path.is_file():
+            return {}
+        try:
+            with open(manifest_path, 'r') as f:
+                return json.load(f)
+        except json.JSONDecodeError:
+            self.default_logger.error(f'Corrupted bar cache manifest {manifest_path}. Rebuilding.')
+            return {}
+
+    def __save_manifest(self, stock_code: str, manifest: dict) -> None:
+        manifest_path = self.get_manifest_path(stock_code)
+        temp_path = manifest_path.with_suffix('.json.tmp')
+        with DataCatalog(self.root).keep_current(stock_code):
+            with open(temp_path, 'w') as f:
+                json.dump(manifest, f, indent=1, sort_keys=True)
+            os.replace(temp_path, manifest_path)
+
+    def get_source_path(self, stock_code: str, trading_date: str):
+        """
+            Locate the 1M source file of a trading day (per-day file first, then the monthly partition)
+        :return: Path or None if there is no 1M data for the day
+        """
+        daily_path = self.root / stock_code / f'{stock_code}_{trading_date}_1M.parquet'
+        if daily_path.is_file():
+            return daily_path
+        partition_path = self.data_store.get_partition_path(stock_code, int(trading_date[:4]), int(trading_date[5:7]))
+        return partition_path if partition_path.is_file() else None
+
+    def get_trading_dates(self, stock_code: str) -> list:
+        """
+            List all trading days that have 1M data for a stock in either layout
+        """
+        trading_dates = {daily_file.name[len(stock_code) + 1:len(stock_code) + 11] for daily_file in
+                         (self.root / stock_code).glob(f'{stock_code}_????-??-??_1M.parquet')}
+        trading_dates.update(self.data_store.get_trading_dates(stock_code))
+        return sorted(trading_dates)
+
+    def __load_1M_data(self, stock_code: str, trading_date: str) -> pd.DataFrame:
+        source_path = self.get_source_path(stock_code, trading_date)
+        if source_path is None:
+            return pd.DataFrame()
+        if source_path.name.endswith(f'{trading_date}_1M.parquet'):
+            return DataProcessingInterface.get_stock_df_from_file(source_path)
+        return self.data_store.read_stock_df(stock_code, trading_date, trading_date)
+
+    @staticmethod
+    def __hash_df(input_df: pd.DataFrame) -> str:
+        return hashlib.sha1(pd.util.hash_pandas_object(input_df, index=False).to_numpy().tobytes()).hexdigest()
+
+    def is_valid(self, stock_code: str, trading_date: str, custom_interval: int, manifest: dict = None) -> bool:
+        """
+            Check if the cached bars of a trading day exist and the 1M source has not been modified since (by stat)
+        """
+        manifest = self.load_manifest(stock_code) if manifest is None else manifest
+        record = manifest.get(trading_date)
+        if record is None or custom_interval not in record['intervals']:
+            return False
+        source_path = self.get_source_path(stock_code, trading_date)
+        if source_path is None or not self.get_bar_path(stock_code, trading_date, custom_interval).is_file():
+            return False
+        source_stat = source_path.stat()
+        return record['source'] == source_path.name and record['mtime_ns'] == source_stat.st_mtime_ns and \
+               record['size'] == source_stat.st_size
+
+    def update_stock(self, stock_code: str, trading_dates: list = None) -> int:
+        """
+            Materialize the bars of a stock for all configured intervals. Only rebuild the days whose 1M source has
+            changed (by stat, then by content hash) or whose cached files are missing.
+        :param stock_code: Stock Code with Format (e.g., HK.00001)
+        :param trading_dates: Trading days to check (Default = All days with 1M data)
+        :return: Number of trading days rebuilt
+        """
+        if not self.intervals:
+            return 0
+        manifest = self.load_manifest(stock_code)
+        trading_dates = self.get_trading_dates(stock_code) if trading_dates is None else trading_dates
+
+        rebuild_dfs = []
+        for trading_date in trading_dates:
+            if all(self.is_valid(stock_code, trading_date, custom_interval, manifest) for custom_interval in
+                   self.intervals):
+                continue
+            input_df = self.__load_1M_data(stock_code, trading_date)
+            if input_df.empty:
+                continue
+            source_path = self.get_source_path(stock_code, trading_date)
+            source_stat = source_path.stat()
+            record = {'source':    source_path.name, 'mtime_ns': source_stat.st_mtime_ns,
+                      'size':      source_stat.st_size, 'sha1': self.__hash_df(input_df),
+                      'intervals': sorted(self.intervals)}
+            previous_record = manifest.get(trading_date, {})
+            if previous_record.get('sha1') == record['sha1'] and all(
+                    self.get_bar_path(stock_code, trading_date, custom_interval).is_file() and
+                    custom_interval in previous_record['intervals'] for custom_interval in self.intervals):
+                # Source touched but unchanged (e.g., monthly partition rewritten for another day)
+                record['intervals'] = sorted(set(previous_record['intervals']) | set(self.intervals))
+                manifest[trading_date] = record
+                continue
+            manifest[trading_date] = record
+            rebuild_dfs.append(input_df)
+
+        if rebuild_dfs:
+            input_df = pd.concat(rebuild_dfs, ignore_index=True)
+            for custom_interval in self.intervals:
+                output_df = DataProcessingInterface.resample_custom_interval(input_df, custom_interval)
+                for trading_date, minute_df in output_df.groupby(output_df['time_key'].str[:10], sort=False):
+                    DataProcessingInterface.save_stock_df_to_file(
+                        minute_df.reset_index(drop=True),
+                        self.get_bar_path(stock_code, trading_date, custom_interval))
+            self.default_logger.info(f'Materialized {self.intervals}M bars of {stock_code} for '
+                                     f'{len(rebuild_dfs)} trading days')
+        self.__save_manifest(stock_code, manifest)
+        return len(rebuild_dfs)
+
+    def update(self, stock_list: list) -> int:
+        """
+            Materialize the bars for a list of stocks
+        :return: Number of trading days rebuilt
+        """
+        return sum(self.update_stock(stock_code) for stock_code in stock_list if (self.root / stock_code).is_dir())
+
+    def get_custom_interval_data_range(self, date_range: list, custom_interval: int, stock_list: list,
+                                       columns: list = None) -> dict:
+        """
+            Get Customized-Interval Data for a list of dates based on Stock List. Returned in Dict format
+            Valid cached bars are loaded directly. The remaining days are resampled from 1M data in one pass.
+        :param date_range: A list of Date in DateTime Format (YYYY-MM-DD)
+        :param custom_interval: Customized-Interval in unit of "Minutes"
+        :param stock_list: A List of Stock Code with Format (e.g., [HK.00001, HK.00002])
+        :param columns: Columns to return (Default = All). Only these columns are decoded from the cached bars
+        :return: Dictionary in Format {'HK.00001': pd.Dataframe, 'HK.00002': pd.Dataframe}
+        """
+        columns = columns if columns is None or 'time_key' in columns else columns + ['time_key']
+        date_range = [str(input_date)[:10] for input_date in date_range]
+        output_dict = {}
+        for stock_code in stock_list:
+            manifest = self.load_manifest(stock_code)
+            cached_dfs, raw_dfs = [], []
+            for trading_date in date_range:
+                if self.is_valid(stock_code, trading_date, custom_interval, manifest):
+                    cached_dfs.append(DataProcessingInterface.get_stock_df_from_file(
+                        self.get_bar_path(stock_code, trading_date, custom_interval), columns=columns))
+                else:
+                    raw_dfs.append(self.__load_1M_data(stock_code, trading_date))
+            raw_dfs = [input_df for input_df in raw_dfs if not input_df.empty]
+            # Resample all uncached days of the stock together
+            if raw_dfs:
+                minute_df = DataProcessingInterface.resample_custom_interval(pd.concat(raw_dfs, ignore_index=True),
+                                                                             custom_interval)
+                cached_dfs.append(minute_df if columns is None else minute_df[columns])
+            cached_dfs = [input_df for input_df in cached_dfs if not input_df.empty]
+            if not cached_dfs:
+                continue
+            output_df = pd.concat(cached_dfs, ignore_index=True)
+            output_df.sort_values(by='time_key', ascending=True, inplace=True, ignore_index=True)
+            output_dict[stock_code] = output_df
+        return output_dict
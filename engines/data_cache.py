@@ -0,0 +1,147 @@
+#  Futu Algo: Algorithmic High-Frequency Trading Framework
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#  Written by Bill Chan <billpwchan@hotmail.com>, 2021
+#  Copyright (c)  billpwchan - All Rights Reserved
+
+
+import threading
+from collections import OrderedDict
+
+import humanize
+import pandas as pd
+
+from util import logger
+from util.global_vars import *
+
+
+class DataFrameCache:
+    """
+        Process-wide LRU cache of DataFrames loaded from files.
+        Entries are keyed by (file path, loader options) and validated against the file mtime and size on every
+        lookup, so a rewritten file is reloaded. The least recently used entries are evicted once the total memory
+        usage exceeds the budget ([DataStore] CacheMemoryMB in config.ini, 0 = disabled).
+        Callers always receive a copy, so modifying a returned DataFrame never affects the cached one.
+    """
+    default_logger = logger.get_logger("data_cache")
+    __shared_cache = None
+    __shared_lock = threading.Lock()
+
+    def __init__(self, memory_budget: int = None):
+        """
+        :param memory_budget: Memory budget in bytes (Default = [DataStore] CacheMemoryMB in config.ini)
+        """
+        self.memory_budget = memory_budget if memory_budget is not None else DataFrameCache.get_memory_budget()
+        self.entries = OrderedDict()
+        self.memory_usage = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def get_memory_budget() -> int:
+        return int(config.getfloat('DataStore', 'CacheMemoryMB', fallback=512) * 1024 ** 2)
+
+    @staticmethod
+    def shared():
+        """
+            The cache instance shared by all loaders in the current process
+        """
+        with DataFrameCache.__shared_lock:
+            if DataFrameCache.__shared_cache is None:
+                DataFrameCache.__shared_cache = DataFrameCache()
+            return DataFrameCache.__shared_cache
+
+    @staticmethod
+    def __get_signature(input_path: Path):
+        try:
+            file_stat = Path(input_path).stat()
+        except FileNotFoundError:
+            return None
+        return file_stat.st_mtime_ns, file_stat.st_size
+
+    def get(self, input_path: Path, loader, options: tuple = ()) -> pd.DataFrame:
+        """
+            Return the cached DataFrame of a file, or load it with the loader and cache it
+        :param input_path: File to Load
+        :param loader: Callable without arguments that loads the file into a DataFrame
+        :param options: Hashable loader options (e.g., columns) that make the DataFrame differ for the same file
+        :return: A copy of the cached DataFrame
+        """
+        if self.memory_budget <= 0:
+            return loader()
+        key = (str(input_path), options)
+        signature = self.__get_signature(input_path)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and signature is not None and entry[0] == signature:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1].copy()
+            self.misses += 1
+            if entry is not None:
+                self.__remove(key)
+
+        output_df = loader()
+        if signature is None or signature != self.__get_signature(input_path):
+            # The file does not exist or is modified while loading
+            return output_df
+        self.put(key, signature, output_df)
+        return output_df.copy()
+
+    def put(self, key: tuple, signature: tuple, input_df: pd.DataFrame) -> None:
+        memory_usage = int(input_df.memory_usage(index=True, deep=True).sum())
+        if memory_usage > self.memory_budget:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.__remove(key)
+            self.entries[key] = (signature, input_df, memory_usage)
+            self.memory_usage += memory_usage
+            while self.memory_usage > self.memory_budget:
+                self.__remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def __remove(self, key: tuple) -> None:
+        self.memory_usage -= self.entries.pop(key)[2]
+
+    def invalidate(self, input_path: Path) -> None:
+        """
+            Drop all cached DataFrames of a file (e.g., after the file is rewritten)
+        """
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == str(input_path)]:
+                self.__remove(key)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.memory_usage = 0
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {'hits':          self.hits,
+                    'misses':        self.misses,
+                    'evictions':     self.evictions,
+                    'entries':       len(self.entries),
+                    'memory_usage':  self.memory_usage,
+                    'memory_budget': self.memory_budget}
+
+    def log_stats(self) -> None:
+        stats = self.get_stats()
+        self.default_logger.info(f"DataFrame Cache: {stats['hits']} hits, {stats['misses']} misses, "
+                                 f"{stats['evictions']} evictions, {stats['entries']} entries using "
+                                 f"{humanize.naturalsize(stats['memory_usage'])} / "
+                                 f"{humanize.naturalsize(stats['memory_budget'])}")
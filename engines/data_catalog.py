@@ -0,0 +1,323 @@
+#  Futu Algo: Algorithmic High-Frequency Trading Framework
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#  Written by Bill Chan <billpwchan@hotmail.com>, 2021
+#  Copyright (c)  billpwchan - All Rights Reserved
+
+
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+from engines.data_schema import KLineSchema
+from util import logger
+from util.global_vars import *
+
+
+class DataCatalog:
+    """
+        Persistent index of the K-line files under the data folder (data/catalog.sqlite).
+        Every file is recorded with its stock code, interval, date range, row count, byte size and mtime (the change
+        key), so readers can resolve which files exist for a (stock, interval, date range) without probing the
+        filesystem. The checksum is only computed when the catalog is (re-)built.
+        The catalog is opt-in: it is only used (and maintained by the writers) once it has been built with
+            python main_backend.py --rebuild_catalog
+        The mtime of each stock folder is recorded as well. If a folder was changed by a writer that does not maintain
+        the catalog, the catalog is stale for that stock (is_current) and readers fall back to the filesystem.
+        Writers of other files in a stock folder (e.g., manifests) keep the catalog current with keep_current.
+    """
+    default_logger = logger.get_logger("data_catalog")
+    CATALOG_NAME = 'catalog.sqlite'
+    # One connection per catalog file, shared by all threads of the process
+    connections = {}
+    lock = threading.RLock()
+    stale_stocks = set()
+    # {stock_code}_{YYYY-MM-DD | YYYY-MM | YYYY}_{interval}.parquet
+    FILE_PATTERN = re.compile(r'^(?P<code>[A-Z]+\.[0-9A-Z]+)_(?P<period>\d{4}(-\d{2}){0,2})_(?P<interval>\d+[MDW])'
+                              r'\.parquet$')
+
+    def __init__(self, root: Path = PATH_DATA):
+        self.root = Path(root)
+        self.catalog_path = self.root / DataCatalog.CATALOG_NAME
+
+    @staticmethod
+    def for_file(input_path: Path):
+        """
+            Catalog of the data folder containing a K-line file (i.e., the parent of its stock folder)
+        """
+        parsed = DataCatalog.parse_file_name(input_path)
+        if parsed is not None:
+            for parent in Path(input_path).parents:
+                if parent.name == parsed[0]:
+                    return DataCatalog(parent.parent)
+        return DataCatalog()
+
+    def is_available(self) -> bool:
+        return self.catalog_path.is_file()
+
+    def __connect(self) -> sqlite3.Connection:
+        """
+            Shared connection of the catalog file (must be used while holding DataCatalog.lock). A catalog replaced by
+            rebuild() in another process is a new file, which gets a new connection
+        """
+        key = (str(self.catalog_path.resolve()), self.catalog_path.stat().st_ino)
+        connection = DataCatalog.connections.get(key)
+        if connection is None:
+            # Other processes writing the catalog are waited for
+            connection = sqlite3.connect(self.catalog_path, timeout=30, check_same_thread=False)
+            # Catalogs built before the folder mtimes were recorded
+            connection.execute('CREATE TABLE IF NOT EXISTS dirs (code TEXT PRIMARY KEY, mtime_ns INTEGER)')
+            DataCatalog.connections[key] = connection
+        return connection
+
+    def close(self) -> None:
+        """
+            Close the shared connection(s) of the catalog file
+        """
+        with DataCatalog.lock:
+            for key in [key for key in DataCatalog.connections if key[0] == str(self.catalog_path.resolve())]:
+                DataCatalog.connections.pop(key).close()
+
+    def __create_table(self, connection: sqlite3.Connection) -> None:
+        connection.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, code TEXT NOT NULL, '
+                           'interval TEXT NOT NULL, start_date TEXT, end_date TEXT, num_rows INTEGER, '
+                           'num_bytes INTEGER, mtime_ns INTEGER, checksum TEXT)')
+        connection.execute('CREATE INDEX IF NOT EXISTS files_code_interval ON files (code, interval, start_date)')
+        connection.execute('CREATE TABLE IF NOT EXISTS dirs (code TEXT PRIMARY KEY, mtime_ns INTEGER)')
+
+    def __get_dir_mtime(self, stock_code: str):
+        stock_dir = self.root / stock_code
+        return stock_dir.stat().st_mtime_ns if stock_dir.is_dir() else None
+
+    def is_current(self, stock_code: str) -> bool:
+        """
+            Check if the catalog can be used for a stock, i.e., its folder was not changed by a writer that does not
+            maintain the catalog since it was last recorded. Otherwise, the files of the stock must be listed from the
+            filesystem (or the catalog rebuilt)
+        """
+        if not self.is_available():
+            return False
+        with DataCatalog.lock:
+            stored_mtime = self.__get_stored_dir_mtime(stock_code)
+        is_current = stored_mtime == self.__get_dir_mtime(stock_code)
+        if not is_current and stock_code not in DataCatalog.stale_stocks:
+            DataCatalog.stale_stocks.add(stock_code)
+            self.default_logger.warning(f'Data catalog is stale for {stock_code}. Listing its files from the '
+                                        f'filesystem (Run --rebuild_catalog to refresh)')
+        return is_current
+
+    @contextmanager
+    def keep_current(self, stock_code: str):
+        """
+            Write a file that is not recorded in the catalog (e.g., a manifest) into a stock folder, without making the
+            catalog stale for the stock. A catalog that was already stale stays stale
+                with DataCatalog(root).keep_current(stock_code):
+                    ...
+        """
+        with DataCatalog.lock:
+            stored_mtime = self.__get_stored_dir_mtime(stock_code)
+        was_current = stored_mtime is not None and stored_mtime == self.__get_dir_mtime(stock_code)
+        yield
+        if was_current:
+            with DataCatalog.lock, self.__connect() as connection:
+                # Only if no other writer changed the folder in the meantime
+                if self.__get_stored_dir_mtime(stock_code) == stored_mtime:
+                    self.__record_dir(connection, stock_code)
+
+    def __get_stored_dir_mtime(self, stock_code: str):
+        """
+            Recorded mtime of a stock folder (must be used while holding DataCatalog.lock)
+        """
+        if not self.is_available():
+            return None
+        row = self.__connect().execute('SELECT mtime_ns FROM dirs WHERE code = ?', (stock_code,)).fetchone()
+        return row[0] if row is not None else None
+
+    def __get_relative_path(self, input_path: Path):
+        try:
+            return Path(input_path).resolve().relative_to(self.root.resolve()).as_posix()
+        except ValueError:
+            return None
+
+    @staticmethod
+    def parse_file_name(input_path: Path):
+        """
+            Parse the stock code and interval of a K-line file name
+        :return: (stock_code, interval) or None if the file is not a K-line file
+        """
+        match = DataCatalog.FILE_PATTERN.match(Path(input_path).name)
+        return (match.group('code'), match.group('interval')) if match else None
+
+    @staticmethod
+    def get_checksum(input_path: Path, chunk_size: int = 1 << 20) -> str:
+        checksum = hashlib.sha1()
+        with open(input_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                checksum.update(chunk)
+        return checksum.hexdigest()
+
+    @staticmethod
+    def get_date_range(input_path: Path) -> tuple:
+        """
+            Date range (YYYY-MM-DD) and row count of a K-line Parquet file from its footer (statistics of time_key)
+        :return: (start_date, end_date, num_rows)
+        """
+        metadata = pq.ParquetFile(input_path).metadata
+        time_index = metadata.schema.to_arrow_schema().get_field_index('time_key')
+        if time_index < 0 or metadata.num_rows == 0:
+            return None, None, metadata.num_rows
+        start_dates, end_dates = [], []
+        for i in range(metadata.num_row_groups):
+            statistics = metadata.row_group(i).column(time_index).statistics
+            if statistics is None or not statistics.has_min_max:
+                time_keys = KLineSchema.from_table(pq.read_table(input_path, columns=['time_key']))['time_key']
+                return time_keys.min()[:10], time_keys.max()[:10], metadata.num_rows
+            start_dates.append(str(statistics.min)[:10])
+            end_dates.append(str(statistics.max)[:10])
+        return min(start_dates), max(end_dates), metadata.num_rows
+
+    def __get_record(self, input_path: Path, input_df: pd.DataFrame = None, with_checksum: bool = False):
+        relative_path = self.__get_relative_path(input_path)
+        parsed = self.parse_file_name(input_path)
+        if relative_path is None or parsed is None:
+            return None
+        if input_df is not None and 'time_key' in input_df.columns:
+            time_keys = input_df['time_key'].astype(str)
+            start_date, end_date, num_rows = (time_keys.min()[:10], time_keys.max()[:10], input_df.shape[0]) if \
+                not input_df.empty else (None, None, 0)
+        else:
+            start_date, end_date, num_rows = self.get_date_range(input_path)
+        file_stat = Path(input_path).stat()
+        return (relative_path, parsed[0], parsed[1], start_date, end_date, num_rows, file_stat.st_size,
+                file_stat.st_mtime_ns, self.get_checksum(input_path) if with_checksum else None)
+
+    def record_file(self, input_path: Path, input_df: pd.DataFrame = None) -> bool:
+        """
+            Insert / Update the record of a file that has just been written. Skipped if the catalog is not built or the
+            file is not a K-line file under the data folder
+        :param input_path: Written file
+        :param input_df: Written Dataframe (avoids reading the file again for the date range & row count)
+        :return: True if recorded
+        """
+        if not self.is_available():
+            return False
+        record = self.__get_record(input_path, input_df)
+        if record is None:
+            return False
+        with DataCatalog.lock, self.__connect() as connection:
+            connection.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', record)
+            self.__record_dir(connection, record[1])
+        return True
+
+    def __record_dir(self, connection: sqlite3.Connection, stock_code: str) -> None:
+        connection.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?)', (stock_code, self.__get_dir_mtime(stock_code)))
+
+    def remove_file(self, input_path: Path) -> None:
+        relative_path = self.__get_relative_path(input_path)
+        parsed = self.parse_file_name(input_path)
+        if not self.is_available() or relative_path is None:
+            return
+        with DataCatalog.lock, self.__connect() as connection:
+            connection.execute('DELETE FROM files WHERE path = ?', (relative_path,))
+            if parsed is not None:
+                self.__record_dir(connection, parsed[0])
+
+    def rebuild(self) -> int:
+        """
+            (Re-)Build the catalog by scanning all K-line files under the data folder. The new catalog replaces the
+            old one atomically
+        :return: Number of files recorded
+        """
+        temp_path = self.catalog_path.with_suffix('.sqlite.tmp')
+        temp_path.unlink(missing_ok=True)
+        records = [record for record in (self.__get_record(input_path, with_checksum=True) for input_path in
+                                         sorted(self.root.rglob('*.parquet'))) if record is not None]
+        stock_list = sorted({record[1] for record in records})
+        connection = sqlite3.connect(temp_path)
+        try:
+            with connection:
+                self.__create_table(connection)
+                connection.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', records)
+                connection.executemany('INSERT OR REPLACE INTO dirs VALUES (?, ?)',
+                                       [(stock_code, self.__get_dir_mtime(stock_code)) for stock_code in stock_list])
+        finally:
+            connection.close()
+        # The shared connection must not keep the old catalog open
+        self.close()
+        os.replace(temp_path, self.catalog_path)
+        DataCatalog.stale_stocks.clear()
+        self.default_logger.info(f'Data catalog rebuilt with {len(records)} files: {self.catalog_path}')
+        return len(records)
+
+    def get_files(self, stock_code: str = None, interval: str = None, start_date: str = None,
+                  end_date: str = None, num_rows: int = None) -> pd.DataFrame:
+        """
+            Query the recorded files. Files overlapping [start_date, end_date] are returned
+        :param stock_code: Stock Code with Format (e.g., HK.00001)
+        :param interval: Interval (e.g., 1M, 5M, 1D, 1W)
+        :param start_date: Inclusive start date (YYYY-MM-DD)
+        :param end_date: Inclusive end date (YYYY-MM-DD)
+        :param num_rows: Exact number of rows (e.g., 0 for empty files)
+        :return: Dataframe of the records with the absolute file paths
+        """
+        conditions, parameters = [], []
+        for condition, parameter in [('code = ?', stock_code), ('interval = ?', interval),
+                                     ('end_date >= ?', start_date), ('start_date <= ?', end_date),
+                                     ('num_rows = ?', num_rows)]:
+            if parameter is not None:
+                conditions.append(condition)
+                parameters.append(parameter)
+        query = 'SELECT * FROM files' + (f" WHERE {' AND '.join(conditions)}" if conditions else '') + \
+                ' ORDER BY code, interval, start_date'
+        with DataCatalog.lock:
+            output_df = pd.read_sql_query(query, self.__connect(), params=parameters)
+        output_df['path'] = [self.root / relative_path for relative_path in output_df['path']]
+        return output_df
+
+    def get_stock_list(self) -> list:
+        with DataCatalog.lock:
+            return [row[0] for row in self.__connect().execute('SELECT DISTINCT code FROM files ORDER BY code')]
+
+    def get_last_modified(self, stock_code: str):
+        """
+            Last modification time (datetime) of the files of a stock, or None if the stock has no files
+        """
+        with DataCatalog.lock:
+            mtime_ns = self.__connect().execute('SELECT MAX(mtime_ns) FROM files WHERE code = ?',
+                                                (stock_code,)).fetchone()[0]
+        return datetime.fromtimestamp(mtime_ns / 1e9) if mtime_ns is not None else None
+
+    def has_partitions(self, stock_code: str, interval: str = '1M') -> bool:
+        """
+            Check if a stock has monthly partitions (data/{stock_code}/{interval}/year=YYYY/month=MM/...)
+        """
+        return any(len(DataCatalog.FILE_PATTERN.match(path.name).group('period')) == len('YYYY-MM') for path in
+                   self.get_files(stock_code, interval)['path'])
+
+    def get_daily_dates(self, stock_code: str, interval: str = '1M', start_date: str = None,
+                        end_date: str = None) -> dict:
+        """
+            Map each trading day to its per-day file (data/{stock_code}/{stock_code}_{YYYY-MM-DD}_{interval}.parquet)
+        :return: {'YYYY-MM-DD': Path}
+        """
+        output_df = self.get_files(stock_code, interval, start_date, end_date)
+        return {DataCatalog.FILE_PATTERN.match(path.name).group('period'): path for path in output_df['path'] if
+                len(DataCatalog.FILE_PATTERN.match(path.name).group('period')) == len('YYYY-MM-DD')}
@@ -16,17 +16,20 @@
 #  Copyright (c)  billpwchan - All Rights Reserved
 
 
-import csv
 import json
 import os
 import re
 import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from multiprocessing import Pool, cpu_count
 
 import humanize
-import openpyxl
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import requests
 import tushare as ts
 import yahooquery
@@ -34,6 +37,11 @@ import yfinance as yf
 from deprecated import deprecated
 from tqdm import tqdm
 
+from engines.data_cache import DataFrameCache
+from engines.data_catalog import DataCatalog
+from engines.data_schema import KLineSchema
+from engines.data_store import PartitionedDataStore
+from engines.security_master import SecurityMaster
 from util import logger
 from util.global_vars import *
 
@@ -92,103 +100,254 @@ class DataProcessingInterface:
         dir_path.mkdir(parents=True, exist_ok=True)
 
     @staticmethod
-    def get_1M_data_range(date_range: list, stock_list: list) -> dict:
+    def get_loader_workers() -> int:
         """
-            Get 1M Data from CSV based on Stock List. Returned in Dict format
+            Number of threads used to load / save data files concurrently, as defined in config.ini (0 = CPU Count)
+        """
+        return config.getint('DataStore', 'LoaderWorkers', fallback=0) or cpu_count()
+
+    @staticmethod
+    def get_1M_data_range(date_range: list, stock_list: list, parse_dates: bool = False, columns: list = None,
+                          start_time=None, end_time=None, max_workers: int = None, combined: bool = False,
+                          sort: bool = True):
+        """
+            Get 1M Data from Parquet based on Stock List. Returned in Dict format
+            Partitioned data (data/{stock_code}/1M/...) is preferred. Per-day files are still read for the dates
+            that are not available in the partitioned store.
+            Column projection and the time range are pushed down to pyarrow, so unused columns and row groups are
+            never decoded. All (stock, date) files are loaded concurrently by a thread pool (Parquet decoding
+            releases the GIL, so no pickling across processes is needed).
         :param date_range: A list of Date in DateTime Format (YYYY-MM-DD)
         :param stock_list: A List of Stock Code with Format (e.g., [HK.00001, HK.00002])
+        :param parse_dates: Return time_key as datetime64 instead of string
+        :param columns: Columns to load (Default = All). time_key is always loaded for ordering
+        :param start_time: Inclusive start time (date, datetime or string). Default = Beginning of date_range
+        :param end_time: Inclusive end time (date, datetime or string). Default = End of date_range
+        :param max_workers: Number of loader threads (Default = [DataStore] LoaderWorkers in config.ini)
+        :param combined: Return one Dataframe indexed by (code, time_key) instead of a dictionary
+        :param sort: Sort the records by time_key (Otherwise, the records are kept in the stored order)
         :return: Dictionary in Format {'HK.00001': pd.Dataframe, 'HK.00002': pd.Dataframe}
         """
+        start = time.time()
+        data_store = PartitionedDataStore()
+        data_catalog = DataCatalog()
+        columns = columns if columns is None or 'time_key' in columns else columns + ['time_key']
+        if combined and columns is not None and 'code' not in columns:
+            columns = ['code'] + columns
+        date_range = [str(input_date)[:10] for input_date in date_range]
+        start_key = KLineSchema.to_time_key(start_time) if start_time is not None else None
+        end_key = KLineSchema.to_time_key(end_time, end_of_day=True) if end_time is not None else None
+        date_range = [input_date for input_date in date_range if (start_key is None or input_date >= start_key[:10])
+                      and (end_key is None or input_date <= end_key[:10])]
+
+        def load_stored_df(stock_code: str) -> pd.DataFrame:
+            stored_df = data_store.read_stock_df(
+                stock_code, max(KLineSchema.to_time_key(min(date_range)), start_key or ''),
+                min(KLineSchema.to_time_key(max(date_range), end_of_day=True), end_key or '9999'),
+                columns=columns, parse_dates=True)
+            return stored_df[np.isin(stored_df['time_key'].to_numpy().astype('datetime64[D]').astype(str),
+                                     date_range)]
+
+        def load_daily_df(input_path: Path) -> pd.DataFrame:
+            return DataProcessingInterface.get_stock_df_from_file(input_path, parse_dates=parse_dates, columns=columns,
+                                                                  start_time=start_key, end_time=end_key)
+
+        input_dfs = {stock_code: [] for stock_code in stock_list}
+        with ThreadPoolExecutor(max_workers=max_workers or DataProcessingInterface.get_loader_workers()) as executor:
+            # Partitioned store first, then the per-day files of the dates that are not in the store
+            stored_futures = {stock_code: executor.submit(load_stored_df, stock_code) for stock_code in stock_list
+                              if date_range and (data_catalog.has_partitions(stock_code) if
+                                                 data_catalog.is_current(stock_code) else
+                                                 data_store.has_data(stock_code))}
+            stored_dates = {stock_code: set() for stock_code in stock_list}
+            for stock_code, future in stored_futures.items():
+                stored_df = future.result()
+                stored_dates[stock_code] = set(stored_df['time_key'].to_numpy().astype('datetime64[D]').astype(str))
+                if not parse_dates:
+                    stored_df = stored_df.assign(
+                        time_key=DataProcessingInterface.format_time_key(stored_df['time_key']))
+                input_dfs[stock_code].append(stored_df)
+            daily_futures = []
+            for stock_code in stock_list:
+                # Resolve the per-day files from the catalog if available instead of probing every (stock, date)
+                daily_files = data_catalog.get_daily_dates(stock_code, '1M', min(date_range), max(date_range)) if \
+                    date_range and data_catalog.is_current(stock_code) else None
+                for input_date in date_range:
+                    input_path = PATH_DATA / stock_code / f'{stock_code}_{input_date}_1M.parquet'
+                    if input_date not in stored_dates[stock_code] and (
+                            input_date in daily_files if daily_files is not None else input_path.is_file()):
+                        daily_futures.append((stock_code, executor.submit(load_daily_df, input_path)))
+            for stock_code, future in daily_futures:
+                input_dfs[stock_code].append(future.result())
+
         output_dict = {}
         for stock_code in stock_list:
             # input_df refers to the all the 1M data from start_date to end_date in pd.Dataframe format
-            input_df = pd.concat(
-                [DataProcessingInterface.get_stock_df_from_file(
-                    PATH_DATA / stock_code / f'{stock_code}_{input_date}_1M.parquet')
-                    for input_date in date_range if
-                    (PATH_DATA / stock_code / f'{stock_code}_{input_date}_1M.parquet').is_file()],
-                ignore_index=True)
-            input_df[['open', 'close', 'high', 'low']] = input_df[['open', 'close', 'high', 'low']].apply(pd.to_numeric)
-            input_df.sort_values(by='time_key', ascending=True, inplace=True)
+            if not input_dfs[stock_code]:
+                input_dfs[stock_code].append(KLineSchema.get_empty_df(columns, parse_dates=parse_dates))
+            input_df = pd.concat(input_dfs[stock_code], ignore_index=True) if len(input_dfs[stock_code]) > 1 else \
+                input_dfs[stock_code][0]
+            if sort:
+                input_df.sort_values(by='time_key', ascending=True, inplace=True)
             output_dict[stock_code] = output_dict.get(stock_code, input_df)
+
+        num_rows = sum(input_df.shape[0] for input_df in output_dict.values())
+        elapsed = time.time() - start
+        DataProcessingInterface.default_logger.info(
+            f'Loaded {num_rows} 1M records of {len(stock_list)} stocks ({len(stored_futures)} partitioned, '
+            f'{len(daily_futures)} per-day files) in {elapsed:.2f}s ({num_rows / max(elapsed, 1e-6):.0f} rows/s)')
+        if combined:
+            output_df = pd.concat(output_dict.values(), ignore_index=True) if output_dict else \
+                KLineSchema.get_empty_df(columns, parse_dates=parse_dates)
+            return output_df.astype({'code': str}).set_index(['code', 'time_key']).sort_index()
         return output_dict
 
     @staticmethod
-    def get_custom_interval_data(target_date: datetime, custom_interval: int, stock_list: list) -> dict:
+    def resample_custom_interval(input_df: pd.DataFrame, custom_interval: int) -> pd.DataFrame:
+        """
+            Resample 1M K-line data into 3M/5M/15M/30M/60M/Other Customized-Interval data in one vectorized pass.
+            The input can contain multiple stocks and multiple days.
+            Bars are anchored at the start of each HK trading session (09:30 & 13:00) and capped at the session end,
+            so the 09:30 opening-auction bar is merged into the first bar and no bar spans the lunch break
+            (e.g., for 60M: 10:30, 11:30, 12:00, 14:00, 15:00, 16:00).
+            Last Close = Previous Bar Close Price (first bar of the day uses the last close of the first 1M record)
+            Change Rate = (Close Price - Last Close Price) / Last Close Price * 100
+        :param input_df: 1M K-line Dataframe in HistoryDataFormat. A subset of the columns is allowed (code & time_key
+                         are required), in which case only the columns that can be derived are returned
+        :param custom_interval: Customized-Interval in unit of "Minutes"
+        :return: Dataframe in HistoryDataFormat sorted by code & time_key
+        """
+        column_names = json.loads(config.get('FutuOpenD.DataFormat', 'HistoryDataFormat'))
+        if input_df.empty:
+            return pd.DataFrame(columns=column_names)
+
+        time_key = pd.to_datetime(input_df['time_key'], format='%Y-%m-%d %H:%M:%S').to_numpy(dtype='datetime64[ns]')
+        trading_day = time_key.astype('datetime64[D]')
+        minutes = (time_key - trading_day).astype('timedelta64[m]').astype('int64')
+
+        # Each 1M bar belongs to the first session that has not ended yet
+        session_start = np.array([int(item[0][:2]) * 60 + int(item[0][3:]) for item in HK_TRADING_SESSIONS])
+        session_end = np.array([int(item[1][:2]) * 60 + int(item[1][3:]) for item in HK_TRADING_SESSIONS])
+        session = np.minimum(np.searchsorted(session_end, minutes, side='left'), len(session_end) - 1)
+        # The opening-auction bar (e.g., 09:30) falls into the first bar of the session
+        bar_index = np.maximum(np.ceil((minutes - session_start[session]) / custom_interval), 1).astype('int64')
+        bar_minutes = np.minimum(session_start[session] + bar_index * custom_interval, session_end[session])
+        bar_time = trading_day.astype('datetime64[m]') + bar_minutes
+
+        # Sort by (code, time_key) so that every output bar is a contiguous block of 1M bars
+        code_index, code_list = pd.factorize(input_df['code'], sort=True)
+        order = np.lexsort((time_key, code_index))
+        code_index, bar_time, trading_day = code_index[order], bar_time[order], trading_day[order]
+        new_bar = np.ones(len(order), dtype=bool)
+        new_bar[1:] = (code_index[1:] != code_index[:-1]) | (bar_time[1:] != bar_time[:-1])
+        bar_start = np.flatnonzero(new_bar)
+        bar_end = np.append(bar_start[1:], len(order)) - 1
+
+        input_values = {column: input_df[column].to_numpy()[order] for column in
+                        ['open', 'close', 'high', 'low', 'pe_ratio', 'turnover_rate', 'volume', 'turnover',
+                         'last_close'] if column in input_df.columns}
+        minute_df = pd.DataFrame({'code': code_list.take(code_index[bar_start]), 'time_key': bar_time[bar_start]})
+        for column, values in input_values.items():
+            if column == 'open':
+                minute_df[column] = values[bar_start]
+            elif column in ['close', 'pe_ratio']:
+                minute_df[column] = values[bar_end]
+            elif column == 'high':
+                minute_df[column] = np.maximum.reduceat(values, bar_start)
+            elif column == 'low':
+                minute_df[column] = np.minimum.reduceat(values, bar_start)
+        # Use pandas group sum (compensated summation) to stay identical with the per-day resampling results
+        sum_columns = [column for column in ['turnover_rate', 'volume', 'turnover'] if column in input_values]
+        if sum_columns:
+            bar_id = np.cumsum(new_bar) - 1
+            minute_df[sum_columns] = pd.DataFrame({column: input_values[column] for column in sum_columns}).groupby(
+                bar_id, sort=False).sum().to_numpy()
+        if 'volume' in sum_columns:
+            minute_df['volume'] = minute_df['volume'].astype(input_df['volume'].dtype)
+
+        if 'close' in input_values and 'last_close' in input_values:
+            # Within a day, Last Close is the previous bar's close. The first bar keeps the last close of its 1st 1M bar
+            first_bar = np.ones(len(bar_start), dtype=bool)
+            first_bar[1:] = (code_index[bar_start][1:] != code_index[bar_start][:-1]) | \
+                            (trading_day[bar_start][1:] != trading_day[bar_start][:-1])
+            last_close = np.roll(minute_df['close'].to_numpy(), 1)
+            last_close[first_bar] = input_values['last_close'][bar_start][first_bar]
+            minute_df['last_close'] = last_close
+            minute_df['change_rate'] = 100 * (minute_df['close'] - minute_df['last_close']) / minute_df['last_close']
+
+        minute_df['time_key'] = DataProcessingInterface.format_time_key(minute_df['time_key'])
+        # Only the columns that can be derived from the input columns are returned
+        return minute_df.reindex(columns=[column for column in column_names if column in minute_df.columns])
+
+    @staticmethod
+    def format_time_key(input_series: pd.Series) -> pd.Series:
         """
-            Get 5M/15M/Other Customized-Interval Data from CSV based on Stock List. Returned in Dict format
-            Supported Interval: 3M, 5M, 15M, 30M
-            Not-Supported Interval: 60M
+            Convert a datetime64 series into the time_key string format (YYYY-MM-DD HH:MM:SS)
+            Arrow casting is used as it is much faster than Series.dt.strftime for millions of rows
+        """
+        return pd.Series(pa.array(input_series.to_numpy(dtype='datetime64[s]')).cast(pa.string()).to_numpy(
+            zero_copy_only=False), index=input_series.index, dtype=object)
+
+    @staticmethod
+    def get_custom_interval_data(target_date: datetime, custom_interval: int, stock_list: list, columns: list = None,
+                                 start_time=None, end_time=None) -> dict:
+        """
+            Get 5M/15M/Other Customized-Interval Data from Parquet based on Stock List. Returned in Dict format
+            Supported Interval: 3M, 5M, 15M, 30M, 60M
         :param target_date: Date in DateTime Format (YYYY-MM-DD)
         :param custom_interval: Customized-Interval in unit of "Minutes"
         :param stock_list: A List of Stock Code with Format (e.g., [HK.00001, HK.00002])
+        :param columns: Columns to return (Default = All). Only the 1M columns required to derive them are loaded
+        :param start_time: Inclusive start time of the bars (date, datetime or string)
+        :param end_time: Inclusive end time of the bars (date, datetime or string)
         :return: Dictionary in Format {'HK.00001': pd.Dataframe, 'HK.00002': pd.Dataframe}
         """
+        target_date = target_date.strftime(DATETIME_FORMAT_DW) if isinstance(target_date, datetime) else str(
+            target_date)[:10]
+        return DataProcessingInterface.get_custom_interval_data_range([target_date], custom_interval, stock_list,
+                                                                      columns, start_time, end_time)
 
-        input_data = {}
-        target_date = target_date.strftime('%Y-%m-%d')
-        for stock_code in stock_list:
-            input_path = PATH_DATA / stock_code / f'{stock_code}_{target_date}_1M.parquet'
-
-            if not Path(input_path).is_file():
-                continue
-
-            input_df = DataProcessingInterface.get_stock_df_from_file(input_path)
-            # Non-Trading Day -> Skip
-            if input_df.empty:
-                continue
-            # Set Time-key as Index & Convert to Datetime
-            input_df = input_df.set_index('time_key')
-            input_df.index = pd.to_datetime(input_df.index, infer_datetime_format=True)
-            # Define Function List
-            agg_list = {
-                "code":          "first",
-                "open":          "first",
-                "close":         "last",
-                "high":          "max",
-                "low":           "min",
-                "pe_ratio":      "last",
-                "turnover_rate": "sum",
-                "volume":        "sum",
-                "turnover":      "sum",
-            }
-            # Group from 09:31:00 with Freq = 5 Min
-            minute_df = input_df.groupby(
-                pd.Grouper(freq=f'{custom_interval}min', closed='left', offset='1min', origin='start')
-            ).agg(agg_list)[1:]
-            # For 1min -> 5min, need to add Timedelta of 4min
-            minute_df.index = minute_df.index + pd.Timedelta(minutes=int(custom_interval - 1))
-            # Drop Lunch Time
-            minute_df.dropna(inplace=True)
-
-            # Update First Row (Special Cases) e.g. For 1min -> 5min, need to use the first 6min Rows of data
-            minute_df.iloc[0] = \
-                input_df.iloc[:(custom_interval + 1)].groupby('code').agg(agg_list).iloc[0]
-
-            # Update Last Close Price
-            last_index = minute_df.index[0]
-            minute_df['change_rate'] = 0
-            minute_df['last_close'] = input_df['last_close'][0]
-            minute_df.loc[last_index, 'change_rate'] = 100 * (float(minute_df.loc[last_index, 'close']) - float(
-                minute_df.loc[last_index, 'last_close'])) / float(minute_df.loc[last_index, 'last_close'])
-
-            # Change Rate = (Close Price - Last Close Price) / Last Close Price * 100
-            # Last Close = Previous Close Price
-            for index, row in minute_df[1:].iterrows():
-                minute_df.loc[index, 'last_close'] = minute_df.loc[last_index, 'close']
-                minute_df.loc[index, 'change_rate'] = 100 * (
-                        float(row['close']) - float(minute_df.loc[last_index, 'close'])) / float(
-                    minute_df.loc[last_index, 'close'])
-                last_index = index
-
-            minute_df.reset_index(inplace=True)
-            column_names = json.loads(config.get('FutuOpenD.DataFormat', 'HistoryDataFormat'))
-            minute_df = minute_df.reindex(columns=column_names)
-
-            # Convert Timestamp type column to standard String format
-            minute_df['time_key'] = minute_df['time_key'].dt.strftime('%Y-%m-%d %H:%M:%S')
-            input_data[stock_code] = input_data.get(stock_code, minute_df)
-        return input_data
+    @staticmethod
+    def get_custom_interval_data_range(date_range: list, custom_interval: int, stock_list: list, columns: list = None,
+                                       start_time=None, end_time=None) -> dict:
+        """
+            Get Customized-Interval Data for a list of dates based on Stock List. Returned in Dict format
+            All stocks and days are resampled together in one pass
+            The time range is pushed down to whole trading days (a bar depends on the previous bars of the same day),
+            and the bars are then filtered by their own time_key
+        :param date_range: A list of Date in DateTime Format (YYYY-MM-DD)
+        :param custom_interval: Customized-Interval in unit of "Minutes"
+        :param stock_list: A List of Stock Code with Format (e.g., [HK.00001, HK.00002])
+        :param columns: Columns to return (Default = All). Only the 1M columns required to derive them are loaded
+        :param start_time: Inclusive start time of the bars (date, datetime or string)
+        :param end_time: Inclusive end time of the bars (date, datetime or string)
+        :return: Dictionary in Format {'HK.00001': pd.Dataframe, 'HK.00002': pd.Dataframe}. Stocks without data
+                 in the date range (e.g., Non-Trading Day) are skipped
+        """
+        input_columns = None
+        if columns is not None:
+            input_columns = ['code', 'time_key'] + [column for column in columns if column not in
+                                                    ['code', 'time_key', 'last_close', 'change_rate']]
+            if 'last_close' in columns or 'change_rate' in columns:
+                input_columns += [column for column in ['close', 'last_close'] if column not in input_columns]
+        start_key = KLineSchema.to_time_key(start_time) if start_time is not None else None
+        end_key = KLineSchema.to_time_key(end_time, end_of_day=True) if end_time is not None else None
+        input_dfs = [input_df for input_df in DataProcessingInterface.get_1M_data_range(
+            date_range, stock_list, parse_dates=True, columns=input_columns,
+            start_time=start_key[:10] if start_key else None, end_time=end_key[:10] if end_key else None).values()
+                     if not input_df.empty]
+        if not input_dfs:
+            return {}
+        output_df = DataProcessingInterface.resample_custom_interval(pd.concat(input_dfs, ignore_index=True),
+                                                                     custom_interval)
+        if start_key is not None:
+            output_df = output_df[output_df['time_key'] >= start_key]
+        if end_key is not None:
+            output_df = output_df[output_df['time_key'] <= end_key]
+        if columns is not None:
+            output_df = output_df[['code'] + [column for column in columns if column != 'code']]
+        return {stock_code: minute_df.reset_index(drop=True) for stock_code, minute_df in
+                output_df.groupby('code', sort=False, observed=True)}
 
     @staticmethod
     def convert_day_interval_to_weekly(input_df: pd.DataFrame):
@@ -209,9 +368,140 @@ class DataProcessingInterface:
         input_df.index = input_df.index - pd.tseries.frequencies.to_offset("6D")
 
     @staticmethod
-    def validate_1M_data(date_range: list, stock_list: list, trading_days: dict):
-        raise NotImplementedError
-        # TODO: Validate data against futu records
+    def get_session_minutes(sessions: list = None) -> np.ndarray:
+        """
+            Minutes of the day (e.g., 570 = 09:30) of all 1M bars in a HK trading day, i.e. the opening-auction
+            bar (09:30), 09:31 - 12:00 and 13:01 - 16:00 for a full trading day
+        :param sessions: Trading sessions (Default = HK_TRADING_SESSIONS, HK_HALF_DAY_SESSIONS for half-days)
+        """
+        session_minutes = []
+        for i, (session_start, session_end) in enumerate(sessions or HK_TRADING_SESSIONS):
+            start_minute = int(session_start[:2]) * 60 + int(session_start[3:])
+            end_minute = int(session_end[:2]) * 60 + int(session_end[3:])
+            session_minutes.append(np.arange(start_minute if i == 0 else start_minute + 1, end_minute + 1))
+        return np.concatenate(session_minutes)
+
+    @staticmethod
+    def get_half_days(trading_days: list) -> list:
+        """
+            Christmas Eve & New Year's Eve among the trading days (half-day trading in HK). Lunar New Year's Eve is
+            only known from the trading calendar of OpenD (see FutuTrade.get_half_trading_days)
+        :param trading_days: List of Date (YYYY-MM-DD)
+        """
+        return [str(trading_day)[:10] for trading_day in trading_days if str(trading_day)[5:10] in ['12-24', '12-31']]
+
+    @staticmethod
+    def get_max_zero_volume_run() -> int:
+        """
+            Max. number of consecutive zero-volume 1M bars of a valid trading day, as defined in config.ini
+        """
+        return config.getint('DataStore', 'MaxZeroVolumeRun', fallback=30)
+
+    @staticmethod
+    def get_1M_data_quality(input_df: pd.DataFrame, trading_days: list = None, half_days: list = None,
+                            max_zero_volume_run: int = None) -> pd.DataFrame:
+        """
+            Vectorized data-quality checks of the 1M K-line data of one stock (records in the stored order)
+        :param input_df: 1M K-line Dataframe with code, time_key (datetime64), open, close, high, low & volume
+        :param trading_days: Expected trading days (YYYY-MM-DD). Days without any record are reported as well
+        :param half_days: Half trading days (YYYY-MM-DD), checked against the morning session only
+                          (Default = get_half_days of the trading days)
+        :param max_zero_volume_run: Max. consecutive zero-volume bars of a valid day (Default = [DataStore]
+                                    MaxZeroVolumeRun in config.ini)
+        :return: Dataframe with one row per trading day:
+                 date, num_rows, missing_minutes (vs. the HK session calendar), off_session_rows, duplicates,
+                 non_monotonic, ohlc_errors (high < low, open / close outside [low, high]), zero_volume,
+                 max_zero_volume_run (longest run of consecutive zero-volume bars) & is_valid
+        """
+        max_zero_volume_run = max_zero_volume_run if max_zero_volume_run is not None else \
+            DataProcessingInterface.get_max_zero_volume_run()
+        session_minutes = DataProcessingInterface.get_session_minutes()
+        half_day_minutes = DataProcessingInterface.get_session_minutes(HK_HALF_DAY_SESSIONS)
+        time_key = pd.to_datetime(input_df['time_key']).to_numpy(dtype='datetime64[m]')
+        trading_day = time_key.astype('datetime64[D]')
+        minutes = (time_key - trading_day).astype('int64')
+        high, low = input_df['high'].to_numpy(), input_df['low'].to_numpy()
+        volume = input_df['volume'].to_numpy()
+        dates = trading_day.astype(str)
+        if half_days is None:
+            half_days = DataProcessingInterface.get_half_days(
+                sorted(set(dates) | {str(item)[:10] for item in trading_days or []}))
+        half_days = {str(item)[:10] for item in half_days}
+        is_half_day = np.isin(dates, list(half_days))
+
+        in_session = np.where(is_half_day, np.isin(minutes, half_day_minutes), np.isin(minutes, session_minutes))
+        duplicated = pd.Series(time_key).duplicated().to_numpy()
+        non_monotonic = np.zeros(len(time_key), dtype=bool)
+        non_monotonic[1:] = (time_key[1:] < time_key[:-1]) & (trading_day[1:] == trading_day[:-1])
+        ohlc_errors = (high < low)
+        for column in ['open', 'close']:
+            ohlc_errors |= (input_df[column].to_numpy() > high) | (input_df[column].to_numpy() < low)
+        zero_volume = volume == 0
+        # Consecutive zero-volume bars of the same day share the same run id
+        new_run = np.ones(len(time_key), dtype=bool)
+        new_run[1:] = (zero_volume[1:] != zero_volume[:-1]) | (trading_day[1:] != trading_day[:-1])
+        zero_volume_run = pd.Series(zero_volume).groupby(np.cumsum(new_run)).transform('sum').to_numpy()
+
+        output_df = pd.DataFrame({'date':                dates,
+                                  'num_rows':            1,
+                                  'session_minutes':     in_session & ~duplicated,
+                                  'off_session_rows':    ~in_session,
+                                  'duplicates':          duplicated,
+                                  'non_monotonic':       non_monotonic,
+                                  'ohlc_errors':         ohlc_errors,
+                                  'zero_volume':         zero_volume,
+                                  'max_zero_volume_run': np.where(zero_volume, zero_volume_run, 0)})
+        output_df = output_df.groupby('date').agg(
+            {column: 'max' if column == 'max_zero_volume_run' else 'sum' for column in output_df.columns[1:]})
+        if trading_days is not None:
+            output_df = output_df.reindex(sorted(set(output_df.index) | {str(item)[:10] for item in trading_days}),
+                                          fill_value=0)
+        expected_minutes = np.where(output_df.index.isin(list(half_days)), len(half_day_minutes),
+                                    len(session_minutes))
+        output_df.insert(1, 'missing_minutes', expected_minutes - output_df.pop('session_minutes'))
+        output_df = output_df.astype('int64')
+        output_df['is_valid'] = (output_df[['missing_minutes', 'off_session_rows', 'duplicates', 'non_monotonic',
+                                            'ohlc_errors']] == 0).all(axis=1) & (
+                                        output_df['max_zero_volume_run'] <= max_zero_volume_run)
+        output_df = output_df.rename_axis('date').reset_index()
+        output_df.insert(0, 'code', input_df['code'].iloc[0] if not input_df.empty else None)
+        return output_df
+
+    @staticmethod
+    def validate_1M_data(date_range: list, stock_list: list, trading_days: list = None, half_days: list = None,
+                         max_workers: int = None, output_path: Path = None) -> pd.DataFrame:
+        """
+            Validate the stored 1M K-line data against the HK session calendar.
+            The data of all stocks is loaded concurrently in the stored order, and each stock is checked in one
+            vectorized pass. Half trading days are checked against the morning session only.
+            The invalid days (is_valid = False) are the ones to re-download.
+        :param date_range: A list of Date in DateTime Format (YYYY-MM-DD)
+        :param stock_list: A List of Stock Code with Format (e.g., [HK.00001, HK.00002])
+        :param trading_days: Expected trading days (Default = date_range)
+        :param half_days: Half trading days (Default = Christmas Eve & New Year's Eve, see get_half_days)
+        :param max_workers: Number of loader threads (Default = [DataStore] LoaderWorkers in config.ini)
+        :param output_path: Output Parquet report (Default = ./data_report/{time}_1M_Validation.parquet)
+        :return: Dataframe with one row per stock & trading day (see get_1M_data_quality)
+        """
+        trading_days = trading_days if trading_days is not None else date_range
+        input_dict = DataProcessingInterface.get_1M_data_range(
+            date_range, stock_list, parse_dates=True, columns=['time_key', 'open', 'close', 'high', 'low', 'volume'],
+            max_workers=max_workers, sort=False)
+        with ThreadPoolExecutor(max_workers=max_workers or DataProcessingInterface.get_loader_workers()) as executor:
+            output_dfs = list(executor.map(
+                lambda stock_code: DataProcessingInterface.get_1M_data_quality(
+                    input_dict[stock_code].assign(code=stock_code), trading_days, half_days), stock_list))
+        output_df = pd.concat(output_dfs, ignore_index=True) if output_dfs else \
+            DataProcessingInterface.get_1M_data_quality(KLineSchema.get_empty_df(parse_dates=True))
+
+        DataProcessingInterface.default_logger.info(
+            f'Validated {len(output_df)} 1M trading days of {len(stock_list)} stocks: '
+            f'{(~output_df["is_valid"]).sum()} invalid')
+        if output_path is None:
+            DataProcessingInterface.validate_dir(PATH_DATA_REPORT)
+            output_path = PATH_DATA_REPORT / f'{datetime.now().strftime("%Y_%m_%d-%I_%M_%S_%p")}_1M_Validation.parquet'
+        output_df.to_parquet(output_path, index=False)
+        return output_df
 
     @staticmethod
     def save_stock_df_to_file(data: pd.DataFrame, output_path: str, file_type='parquet') -> bool:
@@ -223,50 +513,195 @@ class DataProcessingInterface:
         :return: None
         """
         if not data.empty:
+            DataFrameCache.shared().invalidate(output_path)
             if file_type == 'csv':
                 data.to_csv(output_path, index=False, encoding='utf-8-sig')
             elif file_type == 'parquet':
                 try:
-                    data.to_parquet(output_path, index=False)
+                    if KLineSchema.is_kline_df(data):
+                        pq.write_table(KLineSchema.to_table(data), output_path, compression=KLineSchema.COMPRESSION)
+                    else:
+                        data.to_parquet(output_path, index=False)
+                    DataCatalog.for_file(output_path).record_file(output_path, data)
                 except OverflowError:
                     print("Error")
             return True
         return False
 
     @staticmethod
-    def get_stock_df_from_file(input_path: Path) -> pd.DataFrame:
+    def save_1M_data_by_day(stock_code: str, history_df: pd.DataFrame, root: Path = PATH_DATA,
+                            max_workers: int = None) -> list:
+        """
+            Split downloaded 1M K-line data into per-day files (data/{stock_code}/{stock_code}_{YYYY-MM-DD}_1M.parquet)
+            The Dataframe is grouped by trading date in a single pass and the days are written concurrently
+        :param stock_code: Stock Code with Format (e.g., HK.00001)
+        :param history_df: 1M K-line Dataframe in HistoryDataFormat (may span multiple days)
+        :param root: Data Folder (Default = ./data)
+        :param max_workers: Number of writer threads (Default = [DataStore] LoaderWorkers in config.ini)
+        :return: List of the written file paths
+        """
+        if history_df.empty:
+            return []
+        DataProcessingInterface.validate_dir(Path(root) / stock_code)
+        day_groups = [(Path(root) / stock_code / f'{stock_code}_{input_date}_1M.parquet',
+                       output_df.reset_index(drop=True)) for input_date, output_df in
+                      history_df.groupby(history_df['time_key'].astype(str).str[:10], sort=True)]
+        with ThreadPoolExecutor(max_workers=max_workers or DataProcessingInterface.get_loader_workers()) as executor:
+            results = list(executor.map(lambda item: DataProcessingInterface.save_stock_df_to_file(item[1], item[0]),
+                                        day_groups))
+        return [output_path for (output_path, output_df), result in zip(day_groups, results) if result]
+
+    @staticmethod
+    def get_stock_df_from_file(input_path: Path, parse_dates: bool = False, columns: list = None, start_time=None,
+                               end_time=None) -> pd.DataFrame:
         """
         Load Data from File (CSV / Feather / Parquet)
+        K-line Parquet files are returned ready-typed (categorical code, numeric prices) in both the compact and the
+        legacy schema. Column projection and the time range are pushed down to pyarrow for Parquet files
+        Loaded files are kept in the shared DataFrameCache until they are modified
         :param input_path: File Name to Load
+        :param parse_dates: Return time_key of K-line Parquet files as datetime64 instead of string
+        :param columns: Columns to load (Default = All)
+        :param start_time: Inclusive start of time_key (date, datetime or string). None means unbounded
+        :param end_time: Inclusive end of time_key (date, datetime or string). None means unbounded
         :return: DataFrame
+        :raises ValueError: If a time range is given for a file without time_key
         """
-        data = pd.DataFrame(columns=json.loads(config.get('FutuOpenD.DataFormat', 'HistoryDataFormat')))
+        if input_path.suffix in ['.csv', '.parquet']:
+            options = (tuple(columns) if columns is not None else None, str(start_time), str(end_time), parse_dates)
+            return DataFrameCache.shared().get(input_path, lambda: DataProcessingInterface.__read_stock_df_from_file(
+                input_path, parse_dates, columns, start_time, end_time), options)
+        return pd.DataFrame(columns=columns or json.loads(config.get('FutuOpenD.DataFormat', 'HistoryDataFormat')))
+
+    @staticmethod
+    def __read_stock_df_from_file(input_path: Path, parse_dates: bool, columns: list, start_time,
+                                  end_time) -> pd.DataFrame:
+        data = pd.DataFrame(columns=columns or json.loads(config.get('FutuOpenD.DataFormat', 'HistoryDataFormat')))
         if input_path.suffix == '.csv':
-            data = pd.read_csv(input_path, index_col=None, encoding='utf-8-sig')
+            data = pd.read_csv(input_path, index_col=None, encoding='utf-8-sig', usecols=columns)
+            if (start_time is not None or end_time is not None) and 'time_key' not in data.columns:
+                raise ValueError(f'Cannot filter {input_path} by time range: time_key is not loaded')
+            if start_time is not None:
+                data = data[data['time_key'] >= KLineSchema.to_time_key(start_time)]
+            if end_time is not None:
+                data = data[data['time_key'] <= KLineSchema.to_time_key(end_time, end_of_day=True)]
         elif input_path.suffix == '.parquet':
-            data = pd.read_parquet(input_path)
+            schema = pq.read_schema(input_path)
+            if (start_time is not None or end_time is not None) and 'time_key' not in schema.names:
+                raise ValueError(f'Cannot filter {input_path} by time range: no time_key column')
+            time_filter = KLineSchema.get_time_filter(schema.field('time_key').type, start_time, end_time) if (
+                    start_time is not None or end_time is not None) else None
+            table = pq.read_table(input_path, columns=columns, filters=time_filter)
+            data = KLineSchema.from_table(table, parse_dates=parse_dates) if KLineSchema.is_kline_schema(
+                schema) else table.to_pandas()
         return data
 
     @staticmethod
     def check_empty_data(input_path: Path) -> bool:
         """
-        Check if the input file is empty
+        Check if the input file is empty (Only the footer is read for Parquet files)
         :param input_path:
         :return:
         """
-        input_df = DataProcessingInterface.get_stock_df_from_file(input_path)
-        if input_df.empty:
+        is_empty = pq.read_metadata(input_path).num_rows == 0 if input_path.suffix == '.parquet' else \
+            DataProcessingInterface.get_stock_df_from_file(input_path).empty
+        if is_empty:
             input_path.unlink()
+            DataCatalog().remove_file(input_path)
             DataProcessingInterface.default_logger.info(f'{input_path} removed.')
             return True
         return False
 
+    @staticmethod
+    def inspect_data_file(input_path: Path) -> dict:
+        """
+            Check the integrity of a K-line Parquet file by reading its footer only (row count, schema and the
+            min/max statistics of time_key)
+            Status: ok / empty / truncated (unreadable footer) / schema_mismatch / out_of_range (time_key outside the
+            period in the file name, e.g., HK.00001_2022-04-11_1M.parquet)
+        :param input_path: K-line Parquet File
+        :return: {'path': str, 'status': str, 'num_rows': int, 'start_time': str, 'end_time': str, 'message': str}
+        """
+        output_dict = {'path': str(input_path), 'status': 'ok', 'num_rows': None, 'start_time': None,
+                       'end_time': None, 'message': ''}
+        try:
+            metadata = pq.read_metadata(input_path)
+            schema = metadata.schema.to_arrow_schema()
+        except (OSError, pa.ArrowException) as e:
+            output_dict.update(status='truncated', message=str(e))
+            return output_dict
+        output_dict['num_rows'] = metadata.num_rows
+        missing_columns = [column for column in KLineSchema.REQUIRED_COLUMNS if column not in schema.names]
+        if missing_columns:
+            output_dict.update(status='schema_mismatch', message=f'Missing columns {missing_columns}')
+            return output_dict
+        if metadata.num_rows == 0:
+            output_dict['status'] = 'empty'
+            return output_dict
+
+        time_index = schema.get_field_index('time_key')
+        statistics = [metadata.row_group(i).column(time_index).statistics for i in range(metadata.num_row_groups)]
+        if all(item is not None and item.has_min_max for item in statistics):
+            output_dict['start_time'] = min(str(item.min) for item in statistics)
+            output_dict['end_time'] = max(str(item.max) for item in statistics)
+            match = DataCatalog.FILE_PATTERN.match(Path(input_path).name)
+            period = match.group('period') if match else None
+            if period and not (output_dict['start_time'].startswith(period) and
+                               output_dict['end_time'].startswith(period)):
+                output_dict.update(status='out_of_range', message=f'time_key outside {period}')
+        return output_dict
+
+    @staticmethod
+    def scan_data_files(input_paths: list = None, action: str = None, statuses: list = None,
+                        report_path: Path = None) -> pd.DataFrame:
+        """
+            Scan K-line Parquet files for empty / truncated / schema-mismatched / out-of-range files in one pass.
+            Only the file footers are read (concurrently), so the whole data folder is scanned in seconds
+        :param input_paths: Files to Scan (Default = All K-line files under the data folder)
+        :param action: None (report only), 'quarantine' (move to ./data_quarantine) or 'delete'
+        :param statuses: Statuses to apply the action to (Default = All except ok)
+        :param report_path: Output CSV report (Default = ./data_report/{time}_Data_Scan.csv)
+        :return: Dataframe of the scan results
+        """
+        input_paths = input_paths if input_paths is not None else [
+            input_path for input_path in PATH_DATA.rglob('*.parquet') if DataCatalog.parse_file_name(input_path)]
+        statuses = statuses or ['empty', 'truncated', 'schema_mismatch', 'out_of_range']
+        with ThreadPoolExecutor(max_workers=DataProcessingInterface.get_loader_workers()) as executor:
+            output_df = pd.DataFrame(list(executor.map(DataProcessingInterface.inspect_data_file, input_paths)),
+                                     columns=['path', 'status', 'num_rows', 'start_time', 'end_time', 'message'])
+        output_df['action'] = ''
+
+        data_catalog = DataCatalog()
+        for index in output_df.index[output_df['status'].isin(statuses)] if action else []:
+            input_path = Path(output_df.loc[index, 'path'])
+            if action == 'quarantine':
+                try:
+                    output_path = PATH_DATA_QUARANTINE / input_path.resolve().relative_to(PATH_DATA.resolve())
+                except ValueError:
+                    output_path = PATH_DATA_QUARANTINE / input_path.name
+                output_path.parent.mkdir(parents=True, exist_ok=True)
+                os.replace(input_path, output_path)
+                output_df.loc[index, 'action'] = f'quarantined to {output_path}'
+            elif action == 'delete':
+                input_path.unlink()
+                output_df.loc[index, 'action'] = 'deleted'
+            data_catalog.remove_file(input_path)
+            DataFrameCache.shared().invalidate(input_path)
+
+        summary = output_df['status'].value_counts().to_dict()
+        DataProcessingInterface.default_logger.info(f'Scanned {len(output_df)} data files: {summary}')
+        if report_path is None:
+            DataProcessingInterface.validate_dir(PATH_DATA_REPORT)
+            report_path = PATH_DATA_REPORT / f'{datetime.now().strftime("%Y_%m_%d-%I_%M_%S_%p")}_Data_Scan.csv'
+        output_df.to_csv(report_path, index=False, encoding='utf-8-sig')
+        return output_df
+
     @staticmethod
     def clear_empty_data():
-        pool = Pool(cpu_count())
-        pool.map(DataProcessingInterface.check_empty_data, PATH_DATA.rglob("*/*_1[DWM].parquet"))
-        pool.close()
-        pool.join()
+        data_catalog = DataCatalog()
+        # The catalog already knows the empty files. Otherwise, every file footer has to be checked
+        input_paths = data_catalog.get_files(num_rows=0)['path'].tolist() if data_catalog.is_available() else None
+        DataProcessingInterface.scan_data_files(input_paths, action='delete', statuses=['empty'])
 
     @staticmethod
     def convert_csv_to_parquet(input_file: Path) -> bool:
@@ -310,6 +745,10 @@ class DataProcessingInterface:
 
     @staticmethod
     def get_num_days_to_update(stock_code) -> int:
+        data_catalog = DataCatalog()
+        if data_catalog.is_current(stock_code):
+            last_modified = data_catalog.get_last_modified(stock_code)
+            return (datetime.now() - last_modified).days if last_modified is not None else 365 * 2
         try:
             return (datetime.now() - datetime.fromtimestamp(
                 Path(max((PATH_DATA / stock_code).glob('*.parquet'), key=os.path.getctime)).stat().st_mtime)).days
@@ -317,6 +756,157 @@ class DataProcessingInterface:
         except ValueError:
             return 365 * 2
 
+    @staticmethod
+    def get_1D_data_dict(stock_list: list, start_date=None, end_date=None, interval: str = '1D',
+                         max_workers: int = None) -> dict:
+        """
+            Get the daily (or weekly) K-line data of a list of stocks from the yearly files
+            (data/{stock_code}/{stock_code}_{YYYY}_1D.parquet). All files are loaded concurrently, and the records
+            overlapping between yearly files are kept once (the later download wins)
+        :param stock_list: A List of Stock Code with Format (e.g., [HK.00001, HK.00002])
+        :param start_date: Inclusive start date (date or YYYY-MM-DD). None means unbounded
+        :param end_date: Inclusive end date (date or YYYY-MM-DD). None means unbounded
+        :param interval: 1D or 1W
+        :param max_workers: Number of loader threads (Default = [DataStore] LoaderWorkers in config.ini)
+        :return: Dictionary in Format {'HK.00001': pd.Dataframe, 'HK.00002': pd.Dataframe} with time_key as datetime64.
+                 Stocks without local data get an empty Dataframe
+        """
+        start_date = str(start_date)[:10] if start_date is not None else None
+        end_date = str(end_date)[:10] if end_date is not None else None
+        data_catalog = DataCatalog()
+        input_files = []
+        for stock_code in stock_list:
+            if data_catalog.is_current(stock_code):
+                input_paths = data_catalog.get_files(stock_code, interval, start_date, end_date)['path'].tolist()
+            else:
+                # Yearly files are named by the first year they cover
+                input_paths = [input_path for input_path in
+                               sorted((PATH_DATA / stock_code).glob(f'{stock_code}_????_{interval}.parquet'))
+                               if end_date is None or input_path.name[len(stock_code) + 1:][:4] <= end_date[:4]]
+            input_files.extend((stock_code, input_path) for input_path in input_paths)
+
+        with ThreadPoolExecutor(max_workers=max_workers or DataProcessingInterface.get_loader_workers()) as executor:
+            futures = [(stock_code, executor.submit(DataProcessingInterface.get_stock_df_from_file, input_path,
+                                                    parse_dates=True, start_time=start_date, end_time=end_date))
+                       for stock_code, input_path in input_files]
+            input_dfs = {stock_code: [] for stock_code in stock_list}
+            for stock_code, future in futures:
+                input_dfs[stock_code].append(future.result())
+
+        output_dict = {}
+        for stock_code in stock_list:
+            if not input_dfs[stock_code]:
+                output_dict[stock_code] = KLineSchema.get_empty_df(parse_dates=True)
+                continue
+            input_df = pd.concat(input_dfs[stock_code], ignore_index=True)
+            input_df = input_df.drop_duplicates(subset=['time_key'], keep='last')
+            output_dict[stock_code] = input_df.sort_values(by='time_key', ignore_index=True)
+        DataProcessingInterface.default_logger.info(
+            f'Loaded {interval} data of {sum(not item.empty for item in output_dict.values())}/{len(stock_list)} '
+            f'stocks from {len(input_files)} files')
+        return output_dict
+
+    @staticmethod
+    def get_1M_trading_dates(stock_code: str) -> list:
+        """
+            List all trading days that have 1M data for a stock in either layout (per-day files & partitioned store)
+        :param stock_code: Stock Code with Format (e.g., HK.00001)
+        :return: Sorted list of Date in String Format (YYYY-MM-DD)
+        """
+        data_catalog = DataCatalog()
+        if data_catalog.is_current(stock_code):
+            trading_dates = set(data_catalog.get_daily_dates(stock_code, '1M'))
+        else:
+            trading_dates = {daily_file.name[len(stock_code) + 1:len(stock_code) + 11] for daily_file in
+                             (PATH_DATA / stock_code).glob(f'{stock_code}_????-??-??_1M.parquet')}
+        trading_dates.update(PartitionedDataStore().get_trading_dates(stock_code))
+        return sorted(trading_dates)
+
+    @staticmethod
+    def get_empty_day_grace_days() -> int:
+        """
+            Min. age (in days) of a trading day without 1M data before it is recorded as empty, as defined in config.ini
+        """
+        return config.getint('DataStore', 'EmptyDayGraceDays', fallback=3)
+
+    @staticmethod
+    def read_empty_1M_dates(stock_code: str, root: Path = PATH_DATA) -> dict:
+        """
+            All recorded trading days without 1M data of a stock, with the time they were checked
+            (data/{stock_code}/{stock_code}_empty_1M.json)
+        :return: Dictionary in Format {'2022-04-14': '2022-04-20T16:30:00'}. Days recorded without a check time
+                 (older format) map to None
+        """
+        input_path = Path(root) / stock_code / f'{stock_code}_empty_1M.json'
+        if not input_path.is_file():
+            return {}
+        with open(input_path, 'r') as input_file:
+            empty_dates = json.load(input_file)
+        return dict.fromkeys(empty_dates) if isinstance(empty_dates, list) else empty_dates
+
+    @staticmethod
+    def get_empty_1M_dates(stock_code: str, root: Path = PATH_DATA, retry_days: int = None) -> set:
+        """
+            Trading days known to have no 1M data for a stock (e.g., suspension or temporary closure). Days checked
+            more than retry_days ago are not returned, so that they are requested again
+        :param stock_code: Stock Code with Format (e.g., HK.00001)
+        :param root: Data Folder (Default = ./data)
+        :param retry_days: Days after which a check expires (Default = [DataStore] EmptyDayRetryDays in config.ini)
+        :return: Set of Date in String Format (YYYY-MM-DD)
+        """
+        retry_days = retry_days if retry_days is not None else \
+            config.getint('DataStore', 'EmptyDayRetryDays', fallback=30)
+        expiry_time = (datetime.now() - timedelta(days=retry_days)).isoformat(timespec='seconds')
+        return {empty_date for empty_date, checked_at in
+                DataProcessingInterface.read_empty_1M_dates(stock_code, root).items() if
+                checked_at is not None and checked_at >= expiry_time}
+
+    @staticmethod
+    def add_empty_1M_dates(stock_code: str, empty_dates: list, root: Path = PATH_DATA, checked_at: str = None) -> None:
+        """
+            Record trading days without 1M data for a stock, so that they are not requested again until the check
+            expires
+        :param stock_code: Stock Code with Format (e.g., HK.00001)
+        :param empty_dates: List of Date in String Format (YYYY-MM-DD)
+        :param root: Data Folder (Default = ./data)
+        :param checked_at: Time of the check in ISO Format (Default = Now)
+        """
+        if not empty_dates:
+            return
+        output_path = Path(root) / stock_code / f'{stock_code}_empty_1M.json'
+        DataProcessingInterface.validate_dir(output_path.parent)
+        checked_at = checked_at or datetime.now().isoformat(timespec='seconds')
+        output_dates = {**DataProcessingInterface.read_empty_1M_dates(stock_code, root),
+                        **dict.fromkeys(empty_dates, checked_at)}
+        temp_path = output_path.with_suffix('.json.tmp')
+        with DataCatalog(root).keep_current(stock_code):
+            with open(temp_path, 'w') as output_file:
+                json.dump(dict(sorted(output_dates.items())), output_file)
+            os.replace(temp_path, output_path)
+        DataProcessingInterface.default_logger.info(f'{len(empty_dates)} days without 1M data recorded for '
+                                                    f'{stock_code}')
+
+    @staticmethod
+    def get_missing_date_ranges(trading_days: list, stored_dates) -> list:
+        """
+            Group the trading days without stored data into consecutive ranges, so that each range can be downloaded
+            with a single history K-line request
+            E.g., trading_days = [04-11, 04-12, 04-13, 04-14], stored_dates = {04-12}
+                  => [(04-11, 04-11), (04-13, 04-14)]
+        :param trading_days: Sorted list of trading days (YYYY-MM-DD) from the trading calendar
+        :param stored_dates: Trading days (YYYY-MM-DD) that already have data
+        :return: [(start_date, end_date), ...]
+        """
+        output_list = []
+        for index, trading_day in enumerate(trading_days):
+            if trading_day in stored_dates:
+                continue
+            if output_list and trading_days[index - 1] == output_list[-1][1]:
+                output_list[-1] = (output_list[-1][0], trading_day)
+            else:
+                output_list.append((trading_day, trading_day))
+        return output_list
+
     @staticmethod
     def get_file_to_df(input_file: Path) -> pd.DataFrame:
         if input_file.suffix == '.parquet':
@@ -326,7 +916,16 @@ class DataProcessingInterface:
 
 
 class TuShareInterface:
+    """
+        Daily history of China A-shares from TuShare.
+        The history is kept as one panel sorted by (code, time_key) with the row offsets of every code, so a stock is
+        looked up in O(1) instead of scanning the whole panel. The panel is stored in
+        data/Stock_Pool/tushare_history_1D.parquet, and reruns on the same day only request the missing stocks.
+    """
+    default_logger = logger.get_logger("tushare")
     output_df = pd.DataFrame()
+    # {'600000.SH': (start, end)}: Rows of each code in output_df
+    code_slices = {}
     pro = ts.pro_api(config.get('TuShare.Credential', 'token'))
 
     @staticmethod
@@ -341,27 +940,65 @@ class TuShareInterface:
                 for stock_code in stock_list]
 
     @staticmethod
-    def update_stocks_history(stock_list: list) -> bool:
+    def set_output_df(output_df: pd.DataFrame) -> None:
+        """
+            Replace the panel and index the rows of every code
+        """
+        output_df = output_df.sort_values(by=['code', 'time_key'], ascending=[True, True], ignore_index=True)
+        codes = output_df['code'].to_numpy()
+        boundaries = np.flatnonzero(codes[1:] != codes[:-1]) + 1
+        starts = np.concatenate([[0], boundaries]) if len(codes) else np.array([], dtype='int64')
+        ends = np.append(boundaries, len(codes)) if len(codes) else np.array([], dtype='int64')
+        TuShareInterface.output_df = output_df
+        TuShareInterface.code_slices = {code: (int(start), int(end)) for code, start, end in
+                                        zip(codes[starts], starts, ends)}
+
+    @staticmethod
+    def update_stocks_history(stock_list: list,
+                              cache_path: Path = PATH_DATA / 'Stock_Pool' / 'tushare_history_1D.parquet') -> bool:
+        """
+            Get the daily history (1 year) of a list of stocks from TuShare into the indexed panel
+        :param stock_list: Stock List in Futu Format (e.g., [SH.600000, SZ.000001])
+        :param cache_path: Local store of the panel. Stocks already requested today are loaded from here
+        """
         stock_list = TuShareInterface.__validate_stock_code(stock_list)
+        update_date = datetime.today().strftime("%Y%m%d")
+        cached_df, requested_list = pd.DataFrame(), []
+        if cache_path.is_file():
+            table = pq.read_table(cache_path)
+            metadata = json.loads((table.schema.metadata or {}).get(b'tushare', b'{}'))
+            if metadata.get('update_date') == update_date:
+                cached_df, requested_list = table.to_pandas(), metadata.get('codes', [])
+        missing_list = sorted(set(stock_list) - set(requested_list))
+
         # Rate Limit = 6000 data per request
         interval = int(6000 / 300)
-        stock_lists = [stock_list[i:i + interval] for i in range(0, len(stock_list), interval)]
-        start_date = str((datetime.today() - timedelta(days=round(365 * 1))).date())
-        end_date = str(datetime.today().date().strftime("%Y%m%d"))
-        super_x = [TuShareInterface.output_df]
-        for stock_list in tqdm(stock_lists):
-            super_x.append(
-                TuShareInterface.pro.daily(ts_code=','.join(stock_list), start_date=start_date, end_date=end_date))
-        TuShareInterface.output_df = pd.concat(super_x, ignore_index=True)
-        TuShareInterface.output_df.sort_values(by=['ts_code', 'trade_date'], ascending=[True, True], inplace=True)
-        TuShareInterface.output_df = TuShareInterface.output_df.rename(
-            columns={"ts_code": "code", "trade_date": "time_key", "vol": "volume"})
+        stock_lists = [missing_list[i:i + interval] for i in range(0, len(missing_list), interval)]
+        start_date = (datetime.today() - timedelta(days=round(365 * 1))).strftime("%Y%m%d")
+        super_x = [cached_df]
+        for stock_list_chunk in tqdm(stock_lists, disable=not stock_lists):
+            super_x.append(TuShareInterface.pro.daily(ts_code=','.join(stock_list_chunk), start_date=start_date,
+                                                      end_date=update_date).rename(
+                columns={"ts_code": "code", "trade_date": "time_key", "vol": "volume"}))
+        output_df = pd.concat([item for item in super_x if not item.empty], ignore_index=True) if \
+            any(not item.empty for item in super_x) else pd.DataFrame(columns=['code', 'time_key'])
+        TuShareInterface.set_output_df(output_df)
+
+        if missing_list:
+            table = pa.Table.from_pandas(TuShareInterface.output_df, preserve_index=False)
+            table = table.replace_schema_metadata({**(table.schema.metadata or {}), b'tushare': json.dumps(
+                {'update_date': update_date, 'codes': sorted(set(requested_list) | set(missing_list))}).encode()})
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            pq.write_table(table, cache_path)
+        TuShareInterface.default_logger.info(f'TuShare daily history of {len(stock_list)} stocks ready '
+                                             f'({len(missing_list)} requested in {len(stock_lists)} API calls)')
         return True
 
     @staticmethod
     def get_stock_history(stock_code: str) -> pd.DataFrame:
         stock_code = TuShareInterface.__validate_stock_code([stock_code])[0]
-        return TuShareInterface.output_df[TuShareInterface.output_df['code'] == stock_code].reset_index(drop=True)
+        start, end = TuShareInterface.code_slices.get(stock_code, (0, 0))
+        return TuShareInterface.output_df.iloc[start:end].reset_index(drop=True)
 
     @staticmethod
     def get_stocks_email(stock_list: list) -> dict:
@@ -369,8 +1006,11 @@ class TuShareInterface:
         output_dict = {}
         input_df = TuShareInterface.pro.stock_basic(ts_code=','.join(stock_list), exchange='', list_status='L',
                                                     fields='ts_code,symbol,name,area,industry,market,list_date,enname,fullname,curr_type')
+        input_df = input_df.drop_duplicates(subset=['ts_code']).set_index('ts_code')
         for stock_code in stock_list:
-            stock_info = input_df[input_df['ts_code'] == stock_code].reset_index(drop=True)
+            if stock_code not in input_df.index:
+                continue
+            stock_info = input_df.loc[[stock_code]].reset_index(drop=True)
             stock_price = TuShareInterface.get_stock_history(stock_code).tail(1).reset_index(drop=True)
             output_dict[stock_code] = {
                 'Company Name': f"{stock_info['name'][0]} ({stock_info['market'][0]}) {stock_info['enname'][0]}",
@@ -386,6 +1026,9 @@ class TuShareInterface:
 
 
 class YahooFinanceInterface:
+    default_logger = logger.get_logger("yahoo_finance")
+    REPORT_MODULES = ['price', 'summaryDetail', 'assetProfile']
+
     @staticmethod
     def __validate_stock_code(stock_list: list) -> list:
         """
@@ -453,24 +1096,95 @@ class YahooFinanceInterface:
         return {stock_code: yf.Ticker(stock_code).info['longName'] for stock_code in stock_list}
 
     @staticmethod
-    def get_stocks_email(stock_list: list) -> dict:
+    def request_modules(symbols: list, modules: list, ticker_factory=yahooquery.Ticker, chunk_size: int = 50,
+                        max_workers: int = 4) -> dict:
+        """
+            Request Yahoo Finance modules of a list of symbols in multi-symbol calls running concurrently
+        :param symbols: Symbols in Yahoo Finance Format (e.g., [9988.HK, AAPL])
+        :param modules: yahooquery modules (e.g., ['price', 'summaryDetail'])
+        :param ticker_factory: yahooquery.Ticker or a stand-in (injectable for testing)
+        :param chunk_size: Number of symbols per call
+        :param max_workers: Number of concurrent calls
+        :return: Dictionary in Format {'9988.HK': {'price': {...}, ...}}. Symbols without data or in a failed call
+                 are omitted
+        """
+
+        def request_chunk(chunk: list) -> dict:
+            try:
+                output_modules = ticker_factory(chunk, asynchronous=True).get_modules(modules)
+            except Exception as e:
+                YahooFinanceInterface.default_logger.error(f'Yahoo Finance request of {len(chunk)} symbols failed: '
+                                                           f'{e!r}')
+                return {}
+            # Symbols without data are returned as an error message
+            return {symbol: symbol_modules for symbol, symbol_modules in output_modules.items() if
+                    isinstance(symbol_modules, dict)}
+
+        output_dict = {}
+        chunks = [symbols[i:i + chunk_size] for i in range(0, len(symbols), chunk_size)]
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for output_modules in executor.map(request_chunk, chunks):
+                output_dict.update(output_modules)
+        return output_dict
+
+    @staticmethod
+    def get_report_modules(stock_list: list, ticker_factory=yahooquery.Ticker, chunk_size: int = 50,
+                           max_workers: int = 4,
+                           cache_path: Path = PATH_DATA / 'Stock_Pool' / 'yahoo_report_modules.json') -> dict:
+        """
+            Get the price, summary detail and asset profile of a list of stocks for the email reports.
+            Symbols are requested in multi-symbol calls running concurrently, and the results are cached for the day
+        :param stock_list: Either in Futu Format (Starts with HK/US) / Yahoo Finance Format (Starts with Number)
+        :param ticker_factory: yahooquery.Ticker or a stand-in (injectable for testing)
+        :param chunk_size: Number of symbols per call
+        :param max_workers: Number of concurrent calls
+        :param cache_path: Daily cache of the results (JSON)
+        :return: Dictionary in Format {'9988.HK': {'price': {...}, 'summaryDetail': {...}, 'assetProfile': {...}}}
+        """
         stock_list = YahooFinanceInterface.__validate_stock_code(stock_list)
+        today = datetime.today().strftime(DATETIME_FORMAT_DW)
+        cached_modules = {}
+        if cache_path.is_file():
+            with open(cache_path, 'r', encoding='utf-8') as f:
+                cache = json.load(f)
+            cached_modules = cache.get('modules', {}) if cache.get('date') == today else {}
+        missing_list = [stock_code for stock_code in dict.fromkeys(stock_list) if stock_code not in cached_modules]
+        if missing_list:
+            cached_modules.update(YahooFinanceInterface.request_modules(
+                missing_list, YahooFinanceInterface.REPORT_MODULES, ticker_factory, chunk_size, max_workers))
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(cache_path, 'w', encoding='utf-8') as f:
+                json.dump({'date': today, 'modules': cached_modules}, f, default=str)
+        YahooFinanceInterface.default_logger.info(f'Yahoo Finance report data of {len(stock_list)} stocks ready '
+                                                  f'({len(missing_list)} requested)')
+        return {stock_code: cached_modules[stock_code] for stock_code in stock_list if stock_code in cached_modules}
+
+    @staticmethod
+    def get_stocks_email(stock_list: list, ticker_factory=yahooquery.Ticker,
+                         cache_path: Path = PATH_DATA / 'Stock_Pool' / 'yahoo_report_modules.json') -> dict:
+        """
+            Report data of a list of stocks for the email subscription (see get_report_modules)
+        :return: Dictionary in Format {'9988.HK': {'Company Name': ..., 'Sector': ..., 'Last Close': ..., ...}}
+        """
+        stock_modules = YahooFinanceInterface.get_report_modules(stock_list, ticker_factory=ticker_factory,
+                                                                 cache_path=cache_path)
         output_dict = {}
-        for stock_code in stock_list:
-            # stock_ticker = yf.Ticker(stock_code)
-            stock_ticker = yahooquery.Ticker(stock_code)
+        for stock_code, modules in stock_modules.items():
+            price = modules.get('price', {})
+            asset_profile = modules.get('assetProfile', {})
+            summary_detail = modules.get('summaryDetail', {})
+            currency = summary_detail.get('currency', 'N/A')
             output_dict[stock_code] = {
-                'Company Name':         f"{stock_ticker.price[stock_code].get('shortName')} {stock_ticker.price[stock_code].get('longName')}",
-                'Sector':               stock_ticker.asset_profile[stock_code].get('sector', 'N/A'),
-                'Last Close':           f"{stock_ticker.summary_detail[stock_code].get('currency', 'N/A')} {stock_ticker.summary_detail[stock_code].get('previousClose', 0):.3f}",
-                'Open':                 f"{stock_ticker.summary_detail[stock_code].get('currency', 'N/A')} {stock_ticker.price[stock_code].get('regularMarketDayHigh', 0):.3f}",
-                'Close':                f"{stock_ticker.summary_detail[stock_code].get('currency', 'N/A')} {stock_ticker.price[stock_code].get('regularMarketPrice', 0):.3f}",
-                '% Change':             f"{float(stock_ticker.price[stock_code].get('regularMarketChangePercent', 0))*100:.2f}%",
-                'Volume':               f"{stock_ticker.summary_detail[stock_code].get('currency', 'N/A')} {humanize.intword(stock_ticker.summary_detail[stock_code].get('volume', 'N/A'))}",
-                '52 Week Range':        f"{stock_ticker.summary_detail[stock_code].get('currency', 'N/A')} {stock_ticker.summary_detail[stock_code].get('fiftyTwoWeekLow', 'N/A')}-{stock_ticker.summary_detail[stock_code].get('fiftyTwoWeekHigh', 'N/A')}",
-                'PE(Trailing/Forward)': f"{stock_ticker.summary_detail[stock_code].get('trailingPE', 'N/A')} / {stock_ticker.summary_detail[stock_code].get('forwardPE', 'N/A')}",
+                'Company Name':         f"{price.get('shortName')} {price.get('longName')}",
+                'Sector':               asset_profile.get('sector', 'N/A'),
+                'Last Close':           f"{currency} {summary_detail.get('previousClose', 0):.3f}",
+                'Open':                 f"{currency} {price.get('regularMarketDayHigh', 0):.3f}",
+                'Close':                f"{currency} {price.get('regularMarketPrice', 0):.3f}",
+                '% Change':             f"{float(price.get('regularMarketChangePercent', 0)) * 100:.2f}%",
+                'Volume':               f"{currency} {humanize.intword(summary_detail.get('volume', 0))}",
+                '52 Week Range':        f"{currency} {summary_detail.get('fiftyTwoWeekLow', 'N/A')}-{summary_detail.get('fiftyTwoWeekHigh', 'N/A')}",
+                'PE(Trailing/Forward)': f"{summary_detail.get('trailingPE', 'N/A')} / {summary_detail.get('forwardPE', 'N/A')}",
             }
-
         return output_dict
 
     @staticmethod
@@ -492,31 +1206,29 @@ class YahooFinanceInterface:
 class HKEXInterface:
 
     @staticmethod
-    def update_security_list_full() -> None:
+    def update_security_list_full(http_get=requests.get, security_master: SecurityMaster = None) -> bool:
         """
             Get Full Security List from HKEX. Can Daily Update (Override)
+            The workbook is streamed directly into the typed security master, which is skipped if the download is
+            identical with the previous one
             URL: https://www.hkex.com.hk/eng/services/trading/securities/securitieslists/ListOfSecurities.xlsx
+        :param http_get: HTTP GET function (injectable for testing)
+        :param security_master: Security master to update (Default = Shared instance)
+        :return: True if the security master is regenerated
         """
         full_stock_list = "https://www.hkex.com.hk/eng/services/trading/securities/securitieslists/ListOfSecurities.xlsx"
-        resp = requests.get(full_stock_list)
-        with open(PATH_DATA / 'Stock_Pool' / 'ListOfSecurities.xlsx', 'wb') as fp:
-            fp.write(resp.content)
-
-        wb = openpyxl.load_workbook(PATH_DATA / 'Stock_Pool' / 'ListOfSecurities.xlsx')
-        sh = wb.active
-        with open(PATH_DATA / 'Stock_Pool' / 'ListOfSecurities.csv', 'w', newline="") as f:
-            c = csv.writer(f)
-            for r in sh.rows:
-                c.writerow([cell.value for cell in r])
+        resp = http_get(full_stock_list)
+        resp.raise_for_status()
+        return (security_master or SecurityMaster.shared()).update_source(resp.content)
 
     @staticmethod
     def get_security_df_full() -> pd.DataFrame:
-        input_csv = pd.read_csv(PATH_DATA / 'Stock_Pool' / 'ListOfSecurities.csv', index_col=None, skiprows=2,
-                                dtype={'Stock Code': str})
-        input_csv.dropna(subset=['Stock Code'], inplace=True)
-        input_csv.drop(input_csv.columns[-1], axis=1, inplace=True)
-        input_csv.set_index('Stock Code')
-        return input_csv
+        """
+            Return Full List of Securities with the HKEX column names (Stock Code without the HK. prefix).
+            Board Lot & Spread Table (header without the legend) are integers and the eligibility columns are booleans.
+            Use SecurityMaster.shared().get_security_df() for the security master indexed by Futu Stock Code
+        """
+        return SecurityMaster.shared().get_hkex_df()
 
     @staticmethod
     def get_equity_list_full() -> list:
@@ -524,8 +1236,7 @@ class HKEXInterface:
             Return Full List of Equity in FuTu Stock Code Format E.g. HK.00001
         :return:
         """
-        input_csv = HKEXInterface.get_security_df_full()
-        return [('HK.' + item) for item in input_csv[input_csv['Category'] == 'Equity']['Stock Code'].tolist()]
+        return SecurityMaster.shared().get_stock_list('Equity')
 
     @staticmethod
     def get_equity_info_full() -> list:
@@ -533,16 +1244,14 @@ class HKEXInterface:
             Return Full List of Equity dict in Futu Stock Code Format including Basic Info
             E.g., {"Stock Code": HK.00001, "Name of Securities": "CKH HOLDINGS", "Board Lot": 500}
         """
-        input_csv = HKEXInterface.get_security_df_full()
-        return [{"Stock Code": f'HK.{row["Stock Code"]}', "Name of Securities": row["Name of Securities"],
-                 "Board Lot":  row["Board Lot"]} for index, row in
-                input_csv[input_csv['Category'] == 'Equity'].iterrows()]
+        equity_df = SecurityMaster.shared().get_security_df('Equity')
+        return pd.DataFrame({"Stock Code":         equity_df.index,
+                             "Name of Securities": equity_df['name'].to_numpy(),
+                             "Board Lot":          equity_df['board_lot'].to_numpy()}).to_dict('records')
 
     @staticmethod
     def get_board_lot_full() -> dict:
         """
             Return Full Dict of the Board Lot Size (Minimum Trading Unit) for each stock E.g. {'HK.00001': 500}
         """
-        input_csv = HKEXInterface.get_security_df_full()
-        return {('HK.' + row['Stock Code']): int(row['Board Lot'].replace(',', '')) for index, row in
-                input_csv[input_csv['Category'] == 'Equity'].iterrows()}
+        return SecurityMaster.shared().get_board_lot_map('Equity')
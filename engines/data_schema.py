@@ -0,0 +1,164 @@
+#  Futu Algo: Algorithmic High-Frequency Trading Framework
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#  Written by Bill Chan <billpwchan@hotmail.com>, 2021
+#  Copyright (c)  billpwchan - All Rights Reserved
+
+
+import json
+from datetime import date, datetime
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from util.global_vars import *
+
+
+class KLineSchema:
+    """
+        Compact storage schema for K-line data (1M / 1D / 1W and Customized-Interval bars)
+            code:                                           dictionary-encoded string
+            time_key:                                       timestamp (seconds, HK local time)
+            open, close, high, low, last_close:             float64 (QFQ-adjusted prices are not on a decimal grid)
+            pe_ratio, turnover_rate, turnover, change_rate: float64
+            volume:                                         int64
+        Files written before this schema (string time_key) remain readable.
+    """
+    REQUIRED_COLUMNS = ['code', 'time_key', 'open', 'close', 'high', 'low', 'volume']
+    PRICE_COLUMNS = ['open', 'close', 'high', 'low']
+    FIELD_TYPES = {
+        'code':          pa.dictionary(pa.int32(), pa.string()),
+        'time_key':      pa.timestamp('s'),
+        'open':          pa.float64(),
+        'close':         pa.float64(),
+        'high':          pa.float64(),
+        'low':           pa.float64(),
+        'pe_ratio':      pa.float64(),
+        'turnover_rate': pa.float64(),
+        'volume':        pa.int64(),
+        'turnover':      pa.float64(),
+        'change_rate':   pa.float64(),
+        'last_close':    pa.float64(),
+    }
+    COMPRESSION = 'zstd'
+
+    @staticmethod
+    def is_kline_df(input_df: pd.DataFrame) -> bool:
+        return all(column in input_df.columns for column in KLineSchema.REQUIRED_COLUMNS)
+
+    @staticmethod
+    def is_kline_schema(schema: pa.Schema) -> bool:
+        return all(column in schema.names for column in KLineSchema.REQUIRED_COLUMNS)
+
+    @staticmethod
+    def get_empty_df(columns: list = None, parse_dates: bool = False) -> pd.DataFrame:
+        """
+            Empty K-line Dataframe with the typed columns (instead of object columns)
+        """
+        columns = columns or json.loads(config.get('FutuOpenD.DataFormat', 'HistoryDataFormat'))
+        schema = pa.schema([pa.field(column, KLineSchema.FIELD_TYPES.get(column, pa.string())) for column in columns])
+        return KLineSchema.from_table(schema.empty_table(), parse_dates=parse_dates)
+
+    @staticmethod
+    def to_table(input_df: pd.DataFrame) -> pa.Table:
+        """
+            Convert a K-line Dataframe (string or datetime64 time_key) into an Arrow Table with the compact schema.
+            Unknown columns are kept with their inferred types.
+        """
+        table = pa.Table.from_pandas(input_df, preserve_index=False)
+        for column, field_type in KLineSchema.FIELD_TYPES.items():
+            index = table.schema.get_field_index(column)
+            if index < 0 or table.schema.field(index).type == field_type:
+                continue
+            array = table.column(index)
+            if column == 'time_key' and pa.types.is_timestamp(array.type):
+                array = array.cast(pa.timestamp('s'), safe=False)
+            elif column == 'time_key':
+                array = array.cast(pa.string()).cast(pa.timestamp('s'))
+            elif column == 'code':
+                array = array.cast(pa.string()).dictionary_encode()
+            else:
+                array = array.cast(field_type)
+            table = table.set_column(index, pa.field(column, array.type), array)
+        return table.replace_schema_metadata(None)
+
+    @staticmethod
+    def from_table(table: pa.Table, parse_dates: bool = False) -> pd.DataFrame:
+        """
+            Convert an Arrow Table into a ready-typed K-line Dataframe.
+            code is categorical, prices/volume are numeric and time_key is either a string (YYYY-MM-DD HH:MM:SS)
+            or datetime64 if parse_dates is specified.
+        :param table: Arrow Table in either the compact schema or the legacy (string time_key) schema
+        :param parse_dates: Return time_key as datetime64 instead of string
+        """
+        index = table.schema.get_field_index('time_key')
+        if index >= 0:
+            array = table.column(index)
+            if parse_dates and not pa.types.is_timestamp(array.type):
+                array = array.cast(pa.string()).cast(pa.timestamp('s'))
+            elif not parse_dates and pa.types.is_timestamp(array.type):
+                # Arrow formats timestamp[s] as "YYYY-MM-DD HH:MM:SS"
+                array = array.cast(pa.timestamp('s')).cast(pa.string())
+            table = table.set_column(index, pa.field('time_key', array.type), array)
+        index = table.schema.get_field_index('code')
+        if index >= 0 and not pa.types.is_dictionary(table.schema.field(index).type):
+            array = table.column(index).cast(pa.string()).dictionary_encode()
+            table = table.set_column(index, pa.field('code', array.type), array)
+        return table.replace_schema_metadata(None).to_pandas()
+
+    @staticmethod
+    def to_time_scalar(input_time: str, field_type: pa.DataType) -> pa.Scalar:
+        """
+            Convert a time_key string (YYYY-MM-DD HH:MM:SS) to a scalar comparable with the stored time_key column
+        """
+        if pa.types.is_timestamp(field_type):
+            return pa.scalar(pd.Timestamp(input_time).to_pydatetime(), type=field_type)
+        return pa.scalar(input_time, type=pa.string())
+
+    @staticmethod
+    def to_time_key(input_time, end_of_day: bool = False) -> str:
+        """
+            Normalize a date / datetime / string into the time_key string format (YYYY-MM-DD HH:MM:SS)
+        :param input_time: Date, datetime or string. A date means the beginning (or the end) of that day
+        :param end_of_day: Use the end of the day for a date
+        """
+        if isinstance(input_time, datetime):
+            return input_time.strftime('%Y-%m-%d %H:%M:%S')
+        if isinstance(input_time, date):
+            input_time = input_time.strftime(DATETIME_FORMAT_DW)
+        input_time = str(input_time)
+        if len(input_time) == 10:
+            return f"{input_time} {'23:59:59' if end_of_day else '00:00:00'}"
+        return input_time
+
+    @staticmethod
+    def get_time_filter(field_type: pa.DataType, start_time=None, end_time=None):
+        """
+            Build a pyarrow filter expression for an inclusive time range on the stored time_key column
+        :param field_type: Stored type of time_key (timestamp or legacy string)
+        :param start_time: Inclusive start (date, datetime or string). None means unbounded
+        :param end_time: Inclusive end (date, datetime or string). None means unbounded
+        :return: pyarrow.compute.Expression or None if the range is unbounded
+        """
+        expressions = []
+        if start_time is not None:
+            expressions.append(pc.field('time_key') >= KLineSchema.to_time_scalar(
+                KLineSchema.to_time_key(start_time), field_type))
+        if end_time is not None:
+            expressions.append(pc.field('time_key') <= KLineSchema.to_time_scalar(
+                KLineSchema.to_time_key(end_time, end_of_day=True), field_type))
+        if not expressions:
+            return None
+        return expressions[0] if len(expressions) == 1 else expressions[0] & expressions[1]
@@ -0,0 +1,227 @@
+#  Futu Algo: Algorithmic High-Frequency Trading Framework
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#  Written by Bill Chan <billpwchan@hotmail.com>, 2021
+#  Copyright (c)  billpwchan - All Rights Reserved
+
+
+import os
+import re
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+from engines.data_catalog import DataCatalog
+from engines.data_schema import KLineSchema
+from util import logger
+from util.global_vars import *
+
+
+class PartitionedDataStore:
+    """
+        Per-symbol columnar store for 1M K-line data.
+        Each symbol keeps a single Parquet dataset partitioned by year/month, i.e.
+            data/{stock_code}/1M/year=2022/month=04/{stock_code}_2022-04_1M.parquet
+        Every monthly file is sorted by time_key and holds exactly one row group per trading day, so a reader can use
+        the row group statistics to skip days outside the requested time range without decoding them.
+    """
+    default_logger = logger.get_logger("data_store")
+
+    def __init__(self, root: Path = PATH_DATA, interval: str = '1M'):
+        self.root = Path(root)
+        self.interval = interval
+
+    @staticmethod
+    def is_enabled() -> bool:
+        """
+            Check if the partitioned layout is selected for newly downloaded 1M data in config.ini
+        """
+        return config.get('DataStore', 'Layout', fallback='daily').strip().lower() == 'partitioned'
+
+    def get_symbol_dir(self, stock_code: str) -> Path:
+        return self.root / stock_code / self.interval
+
+    def get_partition_path(self, stock_code: str, year: int, month: int) -> Path:
+        return self.get_symbol_dir(stock_code) / f'year={year}' / f'month={month:02d}' / \
+               f'{stock_code}_{year}-{month:02d}_{self.interval}.parquet'
+
+    def get_partition_list(self, stock_code: str) -> list:
+        """
+            List all partition files of a stock, sorted by (year, month)
+        :param stock_code: Stock Code with Format (e.g., HK.00001)
+        :return: [(year, month, Path), ...]
+        """
+        output_list = []
+        for partition_file in self.get_symbol_dir(stock_code).glob(f'year=*/month=*/*_{self.interval}.parquet'):
+            match = re.match(r'^year=(\d{4})/month=(\d{2})$', f'{partition_file.parent.parent.name}/'
+                                                                f'{partition_file.parent.name}')
+            if match:
+                output_list.append((int(match.group(1)), int(match.group(2)), partition_file))
+        return sorted(output_list)
+
+    def has_data(self, stock_code: str) -> bool:
+        return len(self.get_partition_list(stock_code)) > 0
+
+    def get_trading_dates(self, stock_code: str) -> list:
+        """
+            List all trading days stored for a stock (YYYY-MM-DD).
+            Every row group holds exactly one trading day, so only the file footers (statistics) are read.
+        :param stock_code: Stock Code with Format (e.g., HK.00001)
+        """
+        trading_dates = set()
+        for year, month, partition_file in self.get_partition_list(stock_code):
+            metadata = pq.ParquetFile(partition_file).metadata
+            time_index = metadata.schema.to_arrow_schema().get_field_index('time_key')
+            for i in range(metadata.num_row_groups):
+                statistics = metadata.row_group(i).column(time_index).statistics
+                if statistics is None or not statistics.has_min_max:
+                    time_keys = KLineSchema.from_table(pq.read_table(partition_file, columns=['time_key']))
+                    trading_dates.update(time_keys['time_key'].str[:10])
+                    break
+                trading_dates.add(str(statistics.min)[:10])
+        return sorted(trading_dates)
+
+    def write_stock_df(self, stock_code: str, input_df: pd.DataFrame) -> bool:
+        """
+            Merge new K-line records into the monthly partitions of a stock.
+            Records with an existing time_key override the stored ones. Only the touched months are rewritten.
+        :param stock_code: Stock Code with Format (e.g., HK.00001)
+        :param input_df: K-line Dataframe in HistoryDataFormat (may span multiple days / months)
+        :return: True if anything is written
+        """
+        if input_df.empty:
+            return False
+        input_df = input_df.copy()
+        input_df['time_key'] = pd.to_datetime(input_df['time_key'], format='%Y-%m-%d %H:%M:%S')
+        months = input_df['time_key'].dt.year * 100 + input_df['time_key'].dt.month
+        for year_month, month_df in input_df.groupby(months, sort=True):
+            year, month = divmod(int(year_month), 100)
+            output_path = self.get_partition_path(stock_code, year, month)
+            if output_path.is_file():
+                month_df = pd.concat([KLineSchema.from_table(pq.read_table(output_path), parse_dates=True),
+                                      month_df], ignore_index=True)
+            self.__write_partition(month_df, output_path)
+            self.default_logger.info(f'Saved {self.interval} K-line data to {output_path}')
+        return True
+
+    def __write_partition(self, month_df: pd.DataFrame, output_path: Path) -> None:
+        """
+            Write a monthly partition atomically with one row group per trading day
+        """
+        month_df = month_df.drop_duplicates(subset=['time_key'], keep='last')
+        month_df = month_df.sort_values(by='time_key', ascending=True, ignore_index=True)
+        table = KLineSchema.to_table(month_df)
+        day_keys = month_df['time_key'].to_numpy().astype('datetime64[D]')
+        # Boundaries between trading days in the sorted frame
+        boundaries = [0] + list(np.flatnonzero(day_keys[1:] != day_keys[:-1]) + 1) + [len(day_keys)]
+
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = output_path.with_suffix('.parquet.tmp')
+        with pq.ParquetWriter(temp_path, table.schema, compression=KLineSchema.COMPRESSION) as writer:
+            for start, end in zip(boundaries[:-1], boundaries[1:]):
+                writer.write_table(table.slice(start, end - start), row_group_size=end - start)
+        os.replace(temp_path, output_path)
+        DataCatalog(self.root).record_file(output_path, month_df)
+
+    def read_stock_df(self, stock_code: str, start_time, end_time, columns: list = None,
+                      parse_dates: bool = False) -> pd.DataFrame:
+        """
+            Read K-line data of a stock within [start_time, end_time].
+            Partitions outside the range are never opened and row groups outside the range are never decoded.
+        :param stock_code: Stock Code with Format (e.g., HK.00001)
+        :param start_time: Inclusive start (date, datetime or string). A date means the beginning of that day
+        :param end_time: Inclusive end (date, datetime or string). A date means the end of that day
+        :param columns: Columns to load (Default = All)
+        :param parse_dates: Return time_key as datetime64 instead of string
+        :return: DataFrame sorted by time_key
+        """
+        start_key = KLineSchema.to_time_key(start_time)
+        end_key = KLineSchema.to_time_key(end_time, end_of_day=True)
+        start_month, end_month = start_key[:7], end_key[:7]
+        read_columns = columns if columns is None or 'time_key' in columns else columns + ['time_key']
+
+        tables = []
+        for year, month, partition_file in self.get_partition_list(stock_code):
+            if not (start_month <= f'{year}-{month:02d}' <= end_month):
+                continue
+            parquet_file = pq.ParquetFile(partition_file)
+            time_index = parquet_file.schema_arrow.get_field_index('time_key')
+            time_type = parquet_file.schema_arrow.field(time_index).type
+            start_scalar = KLineSchema.to_time_scalar(start_key, time_type)
+            end_scalar = KLineSchema.to_time_scalar(end_key, time_type)
+            row_groups = []
+            for i in range(parquet_file.metadata.num_row_groups):
+                statistics = parquet_file.metadata.row_group(i).column(time_index).statistics
+                if statistics is not None and statistics.has_min_max and \
+                        (statistics.max < start_scalar.as_py() or statistics.min > end_scalar.as_py()):
+                    continue
+                row_groups.append(i)
+            if not row_groups:
+                continue
+            table = parquet_file.read_row_groups(row_groups, columns=read_columns)
+            # Row groups are per day, so the first and last day may still contain records outside the range
+            tables.append(table.filter(KLineSchema.get_time_filter(time_type, start_key, end_key)))
+        if not tables:
+            return KLineSchema.get_empty_df(columns, parse_dates=parse_dates)
+
+        # Legacy (string time_key) and compact partitions can be mixed, so convert them one by one
+        output_df = pd.concat([KLineSchema.from_table(table, parse_dates=parse_dates) for table in tables],
+                              ignore_index=True)
+        return output_df if columns is None else output_df[columns]
+
+    def read_range(self, stock_list: list, start_time, end_time, columns: list = None) -> dict:
+        """
+            Read K-line data for a list of stocks within [start_time, end_time]
+        :return: Dictionary in Format {'HK.00001': pd.Dataframe, 'HK.00002': pd.Dataframe}
+        """
+        return {stock_code: self.read_stock_df(stock_code, start_time, end_time, columns) for stock_code in
+                stock_list}
+
+    def migrate_stock(self, stock_code: str, remove_source: bool = False) -> int:
+        """
+            Convert the per-day layout (data/{stock_code}/{stock_code}_{YYYY-MM-DD}_1M.parquet) of a stock into
+            monthly partitions. The per-day files are kept unless remove_source is specified.
+        :param stock_code: Stock Code with Format (e.g., HK.00001)
+        :param remove_source: Remove the per-day files after a successful conversion
+        :return: Number of per-day files converted
+        """
+        daily_files = sorted((self.root / stock_code).glob(f'{stock_code}_????-??-??_{self.interval}.parquet'))
+        if not daily_files:
+            return 0
+        monthly_files = {}
+        for daily_file in daily_files:
+            monthly_files.setdefault(daily_file.name[len(stock_code) + 1:len(stock_code) + 8], []).append(daily_file)
+
+        for year_month, input_files in monthly_files.items():
+            month_df = pd.concat([KLineSchema.from_table(pq.read_table(input_file), parse_dates=True) for
+                                  input_file in input_files], ignore_index=True)
+            if month_df.empty:
+                continue
+            self.write_stock_df(stock_code, month_df)
+
+        if remove_source:
+            for daily_file in daily_files:
+                daily_file.unlink()
+                DataCatalog(self.root).remove_file(daily_file)
+        self.default_logger.info(f'Migrated {len(daily_files)} {self.interval} files of {stock_code}')
+        return len(daily_files)
+
+    def migrate_all(self, remove_source: bool = False) -> int:
+        """
+            Migrate every stock folder under the data root into the partitioned layout
+        :return: Number of per-day files converted
+        """
+        return sum(self.migrate_stock(stock_dir.name, remove_source) for stock_dir in sorted(self.root.iterdir()) if
+                   stock_dir.is_dir() and stock_dir.name != 'Stock_Pool')
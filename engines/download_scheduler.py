@@ -0,0 +1,149 @@
+#  Futu Algo: Algorithmic High-Frequency Trading Framework
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#  Written by Bill Chan <billpwchan@hotmail.com>, 2021
+#  Copyright (c)  billpwchan - All Rights Reserved
+
+
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from util import logger
+from util.global_vars import *
+
+
+class TokenBucket:
+    """
+        Thread-safe limiter for OpenD requests (e.g., max. 60 history K-line requests per 30 seconds).
+        The bucket holds `capacity` tokens and every token is refilled `period` seconds after it is taken, so at most
+        `capacity` requests are made within any `period` window while the full budget stays usable. (A constant refill
+        rate would either burst over the OpenD limit or leave part of the quota unused.)
+    """
+
+    def __init__(self, capacity: int, period: float, clock=time.monotonic, sleep=time.sleep):
+        """
+        :param capacity: Max. number of requests within a period
+        :param period: Period in seconds
+        :param clock: Monotonic clock (injectable for testing)
+        :param sleep: Sleep function (injectable for testing)
+        """
+        self.capacity = capacity
+        self.period = period
+        self.clock = clock
+        self.sleep = sleep
+        self.taken = deque()
+        self.total_acquired = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def from_config():
+        """
+            Limiter of history K-line requests as defined in config.ini
+        """
+        return TokenBucket(config.getint('FutuOpenD.Config', 'HistoryRequestLimit', fallback=60),
+                           config.getfloat('FutuOpenD.Config', 'HistoryRequestPeriod', fallback=30))
+
+    def __refill(self, now: float) -> None:
+        while self.taken and self.taken[0] + self.period <= now:
+            self.taken.popleft()
+
+    def try_acquire(self) -> float:
+        """
+            Take a token if available
+        :return: 0 if a token is taken. Otherwise, the number of seconds until the next token is refilled
+        """
+        with self.lock:
+            now = self.clock()
+            self.__refill(now)
+            if len(self.taken) < self.capacity:
+                self.taken.append(now)
+                self.total_acquired += 1
+                return 0
+            return self.taken[0] + self.period - now
+
+    def acquire(self) -> None:
+        """
+            Block until a token is taken
+        """
+        while True:
+            wait_time = self.try_acquire()
+            if wait_time <= 0:
+                return
+            self.sleep(wait_time)
+
+
+class DownloadScheduler:
+    """
+        Run download tasks (e.g., update K-line data of a stock) on a small thread pool.
+        The request rate is limited by the shared TokenBucket used inside the tasks, so the workers only need to keep
+        enough requests in flight to use up the quota. Failed tasks (returning False or raising) are retried with
+        exponential backoff.
+    """
+    default_logger = logger.get_logger("download_scheduler")
+
+    def __init__(self, rate_limiter: TokenBucket = None, max_workers: int = None, max_retries: int = 3,
+                 backoff: float = 2.0, sleep=time.sleep):
+        """
+        :param rate_limiter: Limiter shared by the tasks (only used for reporting the number of requests)
+        :param max_workers: Number of worker threads (Default = [DataStore] DownloadWorkers in config.ini)
+        :param max_retries: Max. number of retries of a failed task
+        :param backoff: Delay in seconds before the first retry. Doubled for each subsequent retry
+        :param sleep: Sleep function (injectable for testing)
+        """
+        self.rate_limiter = rate_limiter
+        self.max_workers = max_workers or config.getint('DataStore', 'DownloadWorkers', fallback=4)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.sleep = sleep
+
+    def __run_task(self, task_name: str, task) -> bool:
+        for attempt in range(self.max_retries + 1):
+            try:
+                if task() is not False:
+                    return True
+                self.default_logger.warning(f'Download task {task_name} failed (attempt {attempt + 1})')
+            except Exception as e:
+                self.default_logger.error(f'Download task {task_name} raised {e!r} (attempt {attempt + 1})')
+            if attempt < self.max_retries:
+                self.sleep(self.backoff * 2 ** attempt)
+        return False
+
+    def run(self, tasks: list) -> dict:
+        """
+            Run all download tasks and report the progress & throughput
+        :param tasks: [(task_name, callable), ...]. A task fails if it returns False or raises an exception
+        :return: {'completed': [task_name, ...], 'failed': [task_name, ...], 'elapsed': seconds, 'requests': int}
+        """
+        start = time.time()
+        start_requests = self.rate_limiter.total_acquired if self.rate_limiter else 0
+        completed, failed = [], []
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(self.__run_task, task_name, task): task_name for task_name, task in tasks}
+            for future in as_completed(futures):
+                (completed if future.result() else failed).append(futures[future])
+                done = len(completed) + len(failed)
+                if done % 10 == 0 or done == len(tasks):
+                    elapsed = time.time() - start
+                    self.default_logger.info(f'Download progress: {done}/{len(tasks)} tasks ({len(failed)} failed) '
+                                             f'in {elapsed:.1f}s ({done / max(elapsed, 1e-6):.2f} tasks/s)')
+        requests = (self.rate_limiter.total_acquired if self.rate_limiter else 0) - start_requests
+        elapsed = time.time() - start
+        self.default_logger.info(f'Download finished: {len(completed)} completed, {len(failed)} failed, '
+                                 f'{requests} requests in {elapsed:.1f}s ({60 * requests / max(elapsed, 1e-6):.1f} '
+                                 f'requests/min)')
+        if failed:
+            self.default_logger.error(f'Failed download tasks: {failed}')
+        return {'completed': completed, 'failed': failed, 'elapsed': elapsed, 'requests': requests}
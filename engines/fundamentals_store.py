@@ -0,0 +1,150 @@
+#  Futu Algo: Algorithmic High-Frequency Trading Framework
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#  Written by Bill Chan <billpwchan@hotmail.com>, 2021
+#  Copyright (c)  billpwchan - All Rights Reserved
+
+
+import json
+import os
+import time
+from datetime import datetime, timedelta
+
+import pandas as pd
+import yahooquery
+
+from engines.data_engine import YahooFinanceInterface
+from util import logger
+from util.global_vars import *
+
+
+class FundamentalsStore:
+    """
+        Columnar store of stock fundamentals from Yahoo Finance (data/Stock_Pool/stock_fundamentals.parquet).
+        One row per stock (indexed by Futu stock code) with the selected fields as typed columns, plus the full
+        Yahoo Finance record as JSON in the info column. Only missing or outdated stocks are requested, in
+        multi-symbol calls running concurrently.
+        Filters receive get_info(stock_code) as their info_data.
+    """
+    default_logger = logger.get_logger("fundamentals_store")
+    MODULES = ['price', 'summaryDetail', 'defaultKeyStatistics', 'financialData', 'assetProfile']
+    NUMERIC_FIELDS = ['marketCap', 'trailingPE', 'forwardPE', 'priceToBook', 'trailingEps', 'bookValue',
+                      'dividendYield', 'payoutRatio', 'beta', 'profitMargins', 'returnOnEquity', 'returnOnAssets',
+                      'debtToEquity', 'currentRatio', 'totalRevenue', 'revenueGrowth', 'earningsGrowth',
+                      'sharesOutstanding', 'floatShares', 'averageVolume', 'fiftyTwoWeekLow', 'fiftyTwoWeekHigh']
+    STRING_FIELDS = ['shortName', 'longName', 'currency', 'sector', 'industry', 'country']
+
+    def __init__(self, store_path: Path = PATH_DATA / 'Stock_Pool' / 'stock_fundamentals.parquet',
+                 ticker_factory=yahooquery.Ticker, chunk_size: int = 50, max_workers: int = 4):
+        """
+        :param store_path: Fundamentals table (Parquet)
+        :param ticker_factory: yahooquery.Ticker or a stand-in (injectable for testing)
+        :param chunk_size: Number of symbols per call
+        :param max_workers: Number of concurrent calls
+        """
+        self.store_path = Path(store_path)
+        self.ticker_factory = ticker_factory
+        self.chunk_size = chunk_size
+        self.max_workers = max_workers
+        self.fundamentals_df = self.get_empty_df()
+        self.records = {}
+        if self.store_path.is_file():
+            self.set_fundamentals_df(pd.read_parquet(self.store_path))
+
+    @staticmethod
+    def get_empty_df() -> pd.DataFrame:
+        output_df = pd.DataFrame({**{field: pd.Series(dtype='float64') for field in FundamentalsStore.NUMERIC_FIELDS},
+                                  **{field: pd.Series(dtype=object) for field in FundamentalsStore.STRING_FIELDS},
+                                  'updated_at': pd.Series(dtype='datetime64[ns]'),
+                                  'info': pd.Series(dtype=object)})
+        return output_df.rename_axis('code')
+
+    def set_fundamentals_df(self, fundamentals_df: pd.DataFrame) -> None:
+        self.fundamentals_df = fundamentals_df
+        # Plain dictionaries of the typed fields for O(1) lookups
+        self.records = fundamentals_df.drop(columns=['info']).to_dict('index')
+
+    @staticmethod
+    def to_record(modules: dict) -> dict:
+        """
+            Flatten the Yahoo Finance modules of a symbol into one record (the first module with a field wins)
+        """
+        info = {}
+        for module in FundamentalsStore.MODULES:
+            for field, value in (modules.get(module) or {}).items():
+                if info.get(field) is None:
+                    info[field] = value
+        return info
+
+    def update(self, stock_list: list, max_age_days: int = 7) -> int:
+        """
+            Request the fundamentals of the stocks that are missing or older than max_age_days
+        :param stock_list: Stock List in Futu Format (e.g., [HK.00001, HK.00002])
+        :param max_age_days: Max. age of a stored record in days
+        :return: Number of stocks updated
+        """
+        start = time.time()
+        now = datetime.now()
+        updated_at = self.fundamentals_df['updated_at'].reindex(stock_list)
+        missing_list = updated_at.index[updated_at.isna() | (updated_at < now - timedelta(days=max_age_days))].tolist()
+        code_map = {YahooFinanceInterface.futu_code_to_yfinance_code(stock_code): stock_code for stock_code in
+                    missing_list}
+        output_modules = YahooFinanceInterface.request_modules(list(code_map), FundamentalsStore.MODULES,
+                                                               self.ticker_factory, self.chunk_size, self.max_workers)
+        records = {code_map[symbol]: self.to_record(modules) for symbol, modules in output_modules.items() if
+                   symbol in code_map}
+        if records:
+            new_df = pd.DataFrame.from_dict(records, orient='index')
+            update_df = self.get_empty_df().reindex(new_df.index)
+            for field in FundamentalsStore.NUMERIC_FIELDS:
+                if field in new_df.columns:
+                    update_df[field] = pd.to_numeric(new_df[field], errors='coerce').astype('float64')
+            for field in FundamentalsStore.STRING_FIELDS:
+                if field in new_df.columns:
+                    update_df[field] = new_df[field].where(new_df[field].notna(), None).astype(object)
+            update_df['updated_at'] = now
+            update_df['info'] = [json.dumps(records[stock_code], default=str) for stock_code in update_df.index]
+            update_df = update_df.rename_axis('code')
+            fundamentals_df = pd.concat([self.fundamentals_df[~self.fundamentals_df.index.isin(update_df.index)],
+                                         update_df]).sort_index()
+            self.store_path.parent.mkdir(parents=True, exist_ok=True)
+            temp_path = self.store_path.with_suffix('.parquet.tmp')
+            fundamentals_df.to_parquet(temp_path)
+            os.replace(temp_path, self.store_path)
+            self.set_fundamentals_df(fundamentals_df)
+        self.default_logger.info(f'Updated fundamentals of {len(records)}/{len(missing_list)} outdated stocks in '
+                                 f'{-(-len(code_map) // self.chunk_size)} requests ({time.time() - start:.1f}s)')
+        return len(records)
+
+    def get_info(self, stock_code: str) -> dict:
+        """
+            Typed fundamentals of a stock (e.g., {'marketCap': 2.1e11, 'trailingPE': 9.5, 'sector': 'Industrials'})
+        :return: Empty dictionary if the stock is not stored
+        """
+        return dict(self.records.get(stock_code, {}))
+
+    def get_full_info(self, stock_code: str) -> dict:
+        """
+            Full Yahoo Finance record of a stock
+        """
+        if stock_code not in self.records:
+            return {}
+        return json.loads(self.fundamentals_df.at[stock_code, 'info'])
+
+    def get_fundamentals_df(self, stock_list: list = None) -> pd.DataFrame:
+        """
+            Typed fundamentals of a list of stocks (Default = All) for vectorized screening
+        """
+        output_df = self.fundamentals_df.drop(columns=['info'])
+        return output_df.copy() if stock_list is None else output_df.reindex(stock_list)
@@ -0,0 +1,211 @@
+#  Futu Algo: Algorithmic High-Frequency Trading Framework
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#  Written by Bill Chan <billpwchan@hotmail.com>, 2021
+#  Copyright (c)  billpwchan - All Rights Reserved
+
+
+import json
+import os
+import time
+from datetime import date, timedelta
+
+import pandas as pd
+import yfinance as yf
+
+from engines.data_cache import DataFrameCache
+from engines.data_engine import YahooFinanceInterface
+from util import logger
+from util.global_vars import *
+
+
+class YahooHistoryCache:
+    """
+        Local store of Yahoo Finance daily bars (auto-adjusted) used by the stock filters
+        (data/Stock_Pool/yahoo_history_1D.parquet, one row per stock & day).
+        Missing bars are downloaded in chunks of many tickers per request, and later runs only fetch the bars since
+        the last cached date. Stocks with a new dividend / split are downloaded again in full, because the adjusted
+        prices of all their previous bars change. Bars older than history_days are dropped when the store is
+        rewritten, and stocks without any Yahoo Finance data are recorded (yahoo_history_1D_empty.json), so that only
+        the days since the last request are requested again.
+    """
+    default_logger = logger.get_logger("history_cache")
+    COLUMNS = ['open', 'high', 'low', 'close', 'volume', 'dividends', 'stock_splits']
+
+    def __init__(self, cache_path: Path = PATH_DATA / 'Stock_Pool' / 'yahoo_history_1D.parquet', downloader=None,
+                 chunk_size: int = 200, history_days: int = 365):
+        """
+        :param cache_path: Local store of the daily bars (Parquet)
+        :param downloader: Function (yfinance_codes, start_date, end_date) -> Dataframe in yf.download(group_by='ticker')
+                           format (injectable for testing). end_date is exclusive
+        :param chunk_size: Number of tickers per download request
+        :param history_days: Number of calendar days downloaded for a new stock & kept in the store
+        """
+        self.cache_path = Path(cache_path)
+        self.empty_path = self.cache_path.with_name(f'{self.cache_path.stem}_empty.json')
+        self.downloader = downloader or YahooHistoryCache.download_yfinance
+        self.chunk_size = chunk_size
+        self.history_days = history_days
+
+    @staticmethod
+    def download_yfinance(yfinance_codes: list, start_date: date, end_date: date) -> pd.DataFrame:
+        return yf.download(yfinance_codes, start=start_date, end=end_date, group_by='ticker', auto_adjust=True,
+                           actions=True, progress=False, threads=True)
+
+    @staticmethod
+    def to_long_df(download_df: pd.DataFrame, code_map: dict) -> pd.DataFrame:
+        """
+            Convert a download (columns grouped by ticker) into one row per stock & day
+        :param download_df: Dataframe in yf.download(group_by='ticker') format
+        :param code_map: Map of Yahoo Finance code to Futu code (e.g., {'9988.HK': 'HK.09988'})
+        :return: Dataframe with code, date & COLUMNS
+        """
+        if download_df is None or download_df.empty:
+            return pd.DataFrame(columns=['code', 'date'] + YahooHistoryCache.COLUMNS)
+        if not isinstance(download_df.columns, pd.MultiIndex):
+            download_df = pd.concat({next(iter(code_map)): download_df}, axis=1)
+        output_df = download_df.stack(level=0)
+        output_df.columns = [str(column).lower().replace(' ', '_') for column in output_df.columns]
+        output_df = output_df.reindex(columns=YahooHistoryCache.COLUMNS).dropna(subset=['close'])
+        output_df.index.names = ['date', 'ticker']
+        output_df = output_df.reset_index()
+        output_df.insert(0, 'code', output_df.pop('ticker').map(code_map))
+        output_df['date'] = pd.to_datetime(output_df['date'], utc=False)
+        if output_df['date'].dt.tz is not None:
+            output_df['date'] = output_df['date'].dt.tz_localize(None)
+        output_df['date'] = output_df['date'].dt.normalize()
+        output_df[['dividends', 'stock_splits']] = output_df[['dividends', 'stock_splits']].fillna(0)
+        return output_df.dropna(subset=['code'])
+
+    def load(self) -> pd.DataFrame:
+        """
+            All cached daily bars (code, date, open, high, low, close, volume, dividends, stock_splits)
+        """
+        if not self.cache_path.is_file():
+            return pd.DataFrame(columns=['code', 'date'] + YahooHistoryCache.COLUMNS)
+        return DataFrameCache.shared().get(self.cache_path, lambda: pd.read_parquet(self.cache_path))
+
+    def get_empty_dates(self) -> dict:
+        """
+            Stocks without any Yahoo Finance data, with the last date requested
+        :return: Dictionary in Format {'HK.00001': '2022-04-29'}
+        """
+        if not self.empty_path.is_file():
+            return {}
+        with open(self.empty_path, 'r') as input_file:
+            return json.load(input_file)
+
+    def save_empty_dates(self, empty_dates: dict) -> None:
+        self.empty_path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = self.empty_path.with_suffix('.json.tmp')
+        with open(temp_path, 'w') as output_file:
+            json.dump(dict(sorted(empty_dates.items())), output_file)
+        os.replace(temp_path, self.empty_path)
+
+    def __download(self, stock_list: list, start_date: date, end_date: date, failed_list: list) -> pd.DataFrame:
+        code_map = {YahooFinanceInterface.futu_code_to_yfinance_code(stock_code): stock_code for stock_code in
+                    stock_list}
+        yfinance_codes = list(code_map)
+        output_dfs = []
+        for i in range(0, len(yfinance_codes), self.chunk_size):
+            chunk = yfinance_codes[i:i + self.chunk_size]
+            try:
+                output_dfs.append(self.to_long_df(self.downloader(chunk, start_date, end_date + timedelta(days=1)),
+                                                  {yfinance_code: code_map[yfinance_code] for yfinance_code in chunk}))
+            except Exception as e:
+                failed_list.extend(code_map[yfinance_code] for yfinance_code in chunk)
+                self.default_logger.error(f'Yahoo Finance download of {len(chunk)} tickers from {start_date} failed: '
+                                          f'{e!r}')
+        return pd.concat(output_dfs, ignore_index=True) if output_dfs else self.to_long_df(None, {})
+
+    def update(self, stock_list: list, end_date: date = None) -> int:
+        """
+            Download the missing daily bars of a list of stocks (HK / US) into the local store
+        :param stock_list: Stock List in Futu Format (e.g., [HK.00001, US.AAPL])
+        :param end_date: Last date to download (Default = Today)
+        :return: Number of bars downloaded
+        """
+        start = time.time()
+        end_date = end_date or date.today()
+        cached_df = self.load()
+        last_dates = cached_df.groupby('code')['date'].max() if not cached_df.empty else pd.Series(dtype=object)
+        empty_dates = self.get_empty_dates()
+        first_date = end_date - timedelta(days=self.history_days)
+
+        # The last cached bar is downloaded again, since it may have been incomplete (e.g., during trading hours)
+        start_dates = {}
+        for stock_code in stock_list:
+            if stock_code in last_dates.index:
+                start_date = last_dates[stock_code].date()
+            elif stock_code in empty_dates:
+                start_date = max(date.fromisoformat(empty_dates[stock_code]), first_date)
+            else:
+                start_date = first_date
+            if start_date <= end_date:
+                start_dates.setdefault(start_date, []).append(stock_code)
+        failed_list = []
+        new_dfs = [self.__download(stock_codes, start_date, end_date, failed_list) for start_date, stock_codes in
+                   sorted(start_dates.items())]
+        new_df = pd.concat(new_dfs, ignore_index=True) if new_dfs else self.to_long_df(None, {})
+
+        # Stocks without any data so far are only requested again from end_date on
+        requested_list = [stock_code for stock_codes in start_dates.values() for stock_code in stock_codes]
+        new_codes = set(new_df['code'])
+        new_empty_dates = {**{stock_code: empty_date for stock_code, empty_date in empty_dates.items() if
+                              stock_code not in new_codes},
+                           **{stock_code: end_date.isoformat() for stock_code in requested_list if
+                              stock_code not in new_codes and stock_code not in last_dates.index and
+                              stock_code not in failed_list}}
+        if new_empty_dates != empty_dates:
+            self.save_empty_dates(new_empty_dates)
+
+        # New dividends / splits change the adjusted prices of all previous bars
+        new_actions = new_df[(new_df['dividends'] != 0) | (new_df['stock_splits'] != 0)]
+        adjusted_list = sorted({stock_code for stock_code, action_date in zip(new_actions['code'], new_actions['date'])
+                                if stock_code in last_dates.index and action_date > last_dates[stock_code]})
+        if adjusted_list:
+            self.default_logger.info(f'Downloading the full history of {len(adjusted_list)} stocks with new actions')
+            new_df = pd.concat([new_df[~new_df['code'].isin(adjusted_list)], self.__download(
+                adjusted_list, first_date, end_date, failed_list)], ignore_index=True)
+            cached_df = cached_df[~cached_df['code'].isin(adjusted_list)]
+
+        # Bars older than history_days are dropped
+        expired = cached_df['date'] < pd.Timestamp(first_date)
+        if not new_df.empty or expired.any():
+            output_df = pd.concat([cached_df[~expired], new_df[new_df['date'] >= pd.Timestamp(first_date)]],
+                                  ignore_index=True)
+            output_df = output_df.drop_duplicates(subset=['code', 'date'], keep='last')
+            output_df = output_df.sort_values(by=['code', 'date'], ignore_index=True)
+            self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+            temp_path = self.cache_path.with_suffix('.parquet.tmp')
+            output_df.to_parquet(temp_path, index=False)
+            os.replace(temp_path, self.cache_path)
+        self.default_logger.info(f'Yahoo Finance daily bars updated: {len(new_df)} bars of '
+                                 f'{sum(len(stock_codes) for stock_codes in start_dates.values())} stocks in '
+                                 f'{time.time() - start:.1f}s')
+        return len(new_df)
+
+    def get_history_dict(self, stock_list: list) -> dict:
+        """
+            Cached daily bars of a list of stocks, loaded in bulk
+        :return: Dictionary in Format {'HK.00001': pd.Dataframe indexed by date with COLUMNS}. Stocks without
+                 cached bars are omitted
+        """
+        cached_df = self.load()
+        cached_df = cached_df[cached_df['code'].isin(stock_list)]
+        return {stock_code: stock_df.drop(columns='code').set_index('date') for stock_code, stock_df in
+                cached_df.groupby('code', sort=False)}
+
+    def get_history(self, stock_code: str) -> pd.DataFrame:
+        return self.get_history_dict([stock_code]).get(stock_code, pd.DataFrame(columns=YahooHistoryCache.COLUMNS))
@@ -16,14 +16,17 @@
 #  Copyright (c)  billpwchan - All Rights Reserved
 
 
+import threading
 import time
+from datetime import datetime
 
-from futu import ModifyOrderOp, OpenHKTradeContext, OpenQuoteContext, OrderStatus, OrderType, RET_OK, \
+from futu import DealStatus, ModifyOrderOp, OpenHKTradeContext, OpenQuoteContext, OrderStatus, OrderType, RET_OK, \
     TradeDealHandlerBase, TradeOrderHandlerBase, TrdAccType, \
     TrdEnv, TrdSide
 
+from engines.trade_ledger import TradeLedger
 from util import logger
-from util.global_vars import ORDER_RETRY_MAX
+from util.global_vars import ORDER_RETRY_MAX, PATH_TRADING_REPORT
 
 
 class OnOrderClass(TradeOrderHandlerBase):
@@ -34,10 +37,14 @@ class OnOrderClass(TradeOrderHandlerBase):
 
 
 class OnFillClass(TradeDealHandlerBase):
+    def __init__(self, order_engine):
+        super(OnFillClass, self).__init__()
+        self.order_engine = order_engine
+
     def on_recv_rsp(self, rsp_pb):
         ret, data = super(OnFillClass, self).on_recv_rsp(rsp_pb)
         if ret == RET_OK:
-            OrderEngine.on_fill(data)
+            self.order_engine.on_fill(data)
 
 
 class OrderEngine:
@@ -46,17 +53,33 @@ class OrderEngine:
         self.default_logger = logger.get_logger('trading_util')
         self.quote_ctx = quote_ctx
         self.trade_ctx = trade_ctx
+        # Fills pushed by FutuOpenD (e.g., paper trading in TrdEnv.SIMULATE) are recorded in the ledger
+        self.ledger = TradeLedger.from_config()
+        self.ledger_lock = threading.Lock()
         self.trade_ctx.set_handler(OnOrderClass())
-        self.trade_ctx.set_handler(OnFillClass())
+        self.trade_ctx.set_handler(OnFillClass(self))
         self.trd_env = trd_env
         self.acc_type = acc_type
         self.acc_id = self.__get_acc_list()['acc_id'].values[0]
         self.status_filter_list = [OrderStatus.WAITING_SUBMIT, OrderStatus.SUBMITTING,
                                    OrderStatus.SUBMITTED, OrderStatus.FILLED_PART]
 
-    @staticmethod
-    def on_fill(data):
-        pass
+    def on_fill(self, data):
+        with self.ledger_lock:
+            for index, row in data[data['status'] == DealStatus.OK].iterrows():
+                realized_pnl = self.ledger.add_fill(row['create_time'], row['code'], float(row['price']),
+                                                    float(row['qty']), row['trd_side'])
+                self.default_logger.info(f"FILLED {row['trd_side']} ORDER for {row['code']} with QTY {row['qty']} "
+                                         f"using PRICE {row['price']}, Realized P&L: {realized_pnl}")
+
+    def save_ledger(self) -> None:
+        """
+            Save the fills of this session (if any) to ./trading_report
+        """
+        with self.ledger_lock:
+            if len(self.ledger):
+                time_key = datetime.now().strftime("%Y_%m_%d-%I_%M_%S_%p")
+                self.ledger.save(PATH_TRADING_REPORT / f'{time_key}_Fills.parquet')
 
     @staticmethod
     def on_order_status(data):
@@ -0,0 +1,343 @@
+#  Futu Algo: Algorithmic High-Frequency Trading Framework
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#  Written by Bill Chan <billpwchan@hotmail.com>, 2021
+#  Copyright (c)  billpwchan - All Rights Reserved
+
+
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import NamedTuple
+
+import numpy as np
+import openpyxl
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from util import logger
+from util.global_vars import *
+
+
+class SecuritySnapshot(NamedTuple):
+    """
+        Immutable state of a loaded security master. It is replaced as a whole on reload, so a reader that takes the
+        snapshot once never mixes the positions of one load with the arrays of another
+    """
+    security_df: pd.DataFrame
+    positions: dict
+    board_lots: np.ndarray
+    names: np.ndarray
+    categories: np.ndarray
+    source_signature: str
+
+
+class SecurityMaster:
+    """
+        Typed table of the HKEX List of Securities, indexed by Futu stock code (e.g., HK.00001).
+        The HKEX list (data/Stock_Pool/ListOfSecurities.xlsx) is parsed once into
+        data/Stock_Pool/security_master.parquet, which is only regenerated when the content (SHA-1) of the source file
+        changes. Lookups by stock code are O(1) dictionary lookups and the bulk accessors are vectorized over the whole
+        table.
+    """
+    default_logger = logger.get_logger("security_master")
+    # HKEX column name: (column name, type)
+    COLUMNS = {
+        'Stock Code':                          ('stock_code', 'string'),
+        'Name of Securities':                  ('name', 'string'),
+        'Category':                            ('category', 'category'),
+        'Sub-Category':                        ('sub_category', 'category'),
+        'Board Lot':                           ('board_lot', 'int'),
+        'Par Value':                           ('par_value', 'string'),
+        'ISIN':                                ('isin', 'string'),
+        'Expiry Date':                         ('expiry_date', 'string'),
+        'Subject to Stamp Duty':               ('stamp_duty', 'flag'),
+        'Shortsell Eligible':                  ('shortsell_eligible', 'flag'),
+        'CAS Eligible':                        ('cas_eligible', 'flag'),
+        'VCM Eligible':                        ('vcm_eligible', 'flag'),
+        'Admitted to Stock Options':           ('stock_options', 'flag'),
+        'Admitted to Stock Futures':           ('stock_futures', 'flag'),
+        'Admitted to CCASS':                   ('ccass', 'flag'),
+        'ETF / Fund Manager':                  ('fund_manager', 'string'),
+        'Debt Securities Board Lot (Nominal)': ('debt_board_lot', 'string'),
+        'Debt Securities Investor Type':       ('debt_investor_type', 'string'),
+        'POS Eligble':                         ('pos_eligible', 'flag'),
+        'Spread Table':                        ('spread_table', 'int'),
+    }
+    # Min. seconds between two checks of the source file by shared()
+    SHARED_REFRESH_INTERVAL = 60
+    __shared_master = None
+    __shared_checked = 0.0
+    __shared_lock = threading.Lock()
+
+    def __init__(self, source_path: Path = PATH_DATA / 'Stock_Pool' / 'ListOfSecurities.xlsx',
+                 master_path: Path = PATH_DATA / 'Stock_Pool' / 'security_master.parquet'):
+        """
+        :param source_path: HKEX List of Securities (XLSX as downloaded, or CSV)
+        :param master_path: Typed security master (Parquet)
+        """
+        self.source_path = Path(source_path)
+        self.master_path = Path(master_path)
+        self.source_stat = None
+        self.snapshot = None
+        self.set_security_df(SecurityMaster.get_empty_df(), None)
+        self.lock = threading.RLock()
+        self.refresh()
+
+    @staticmethod
+    def shared():
+        """
+            The security master shared by all callers in the current process. The source file is checked for changes
+            at most once per SHARED_REFRESH_INTERVAL seconds
+        """
+        with SecurityMaster.__shared_lock:
+            if SecurityMaster.__shared_master is None:
+                SecurityMaster.__shared_master = SecurityMaster()
+                SecurityMaster.__shared_checked = time.monotonic()
+            elif time.monotonic() - SecurityMaster.__shared_checked >= SecurityMaster.SHARED_REFRESH_INTERVAL:
+                SecurityMaster.__shared_master.refresh()
+                SecurityMaster.__shared_checked = time.monotonic()
+            return SecurityMaster.__shared_master
+
+    @staticmethod
+    def set_shared(security_master=None) -> None:
+        """
+            Replace the shared security master (e.g., with one in a temporary folder). None = Default paths on next use
+        """
+        with SecurityMaster.__shared_lock:
+            SecurityMaster.__shared_master = security_master
+            SecurityMaster.__shared_checked = time.monotonic()
+
+    @staticmethod
+    def get_empty_df() -> pd.DataFrame:
+        """
+            Security master without any security, with the typed columns
+        """
+        dtypes = {'int': 'int64', 'flag': 'bool', 'category': 'category', 'string': object}
+        return pd.DataFrame({column: pd.Series(dtype=dtypes[column_type]) for column, column_type in
+                             SecurityMaster.COLUMNS.values()}, index=pd.Index([], dtype=object, name='code'))
+
+    @property
+    def security_df(self) -> pd.DataFrame:
+        return self.snapshot.security_df
+
+    @property
+    def source_signature(self):
+        return self.snapshot.source_signature
+
+    def get_snapshot(self) -> SecuritySnapshot:
+        """
+            Current snapshot of the security master
+        :raise FileNotFoundError: Neither the source file nor the Parquet master could be loaded
+        """
+        snapshot = self.snapshot
+        if snapshot.security_df.empty:
+            raise FileNotFoundError(f'HKEX List of Securities not found ({self.source_path} / {self.master_path}). '
+                                    f'Run python main_backend.py -u to download it')
+        return snapshot
+
+    @staticmethod
+    def get_signature(content: bytes) -> str:
+        return hashlib.sha1(content).hexdigest()
+
+    @staticmethod
+    def parse_security_df(input_df: pd.DataFrame) -> pd.DataFrame:
+        """
+            Convert the raw HKEX List of Securities (header row already applied) into the typed security master
+        :param input_df: Raw Dataframe with the HKEX column names
+        :return: Dataframe indexed by Futu stock code (e.g., HK.00001)
+        """
+        input_df = input_df.rename(columns=lambda column: 'Spread Table' if str(column).startswith('Spread Table')
+                                   else str(column).strip())
+        input_df = input_df.dropna(subset=['Stock Code'])
+        output_df = pd.DataFrame(index=pd.Index('HK.' + input_df['Stock Code'].astype(str).str.zfill(5), name='code'))
+        for source_column, (column, column_type) in SecurityMaster.COLUMNS.items():
+            values = input_df[source_column] if source_column in input_df.columns else \
+                pd.Series(None, index=input_df.index, dtype=object)
+            values = values.set_axis(output_df.index)
+            if column_type == 'int':
+                output_df[column] = pd.to_numeric(values.astype(str).str.replace(',', '', regex=False).str.strip(),
+                                                  errors='coerce').fillna(0).astype('int64')
+            elif column_type == 'flag':
+                output_df[column] = values.astype(str).str.strip().eq('Y')
+            elif column_type == 'category':
+                output_df[column] = values.astype('category')
+            else:
+                output_df[column] = values.where(values.notna(), None).astype(object)
+        output_df['stock_code'] = output_df['stock_code'].astype(str).str.zfill(5)
+        return output_df[~output_df.index.duplicated(keep='first')]
+
+    @staticmethod
+    def read_security_csv(input_path: Path) -> pd.DataFrame:
+        """
+            Read the HKEX List of Securities CSV (2 title rows before the header row)
+        """
+        return SecurityMaster.parse_security_df(pd.read_csv(input_path, index_col=None, skiprows=2, dtype=str))
+
+    @staticmethod
+    def read_security_xlsx(input_path: Path) -> pd.DataFrame:
+        """
+            Stream the HKEX List of Securities workbook in read-only mode (rows are never held as cell objects).
+            The title rows before the header row (starting with Stock Code) are skipped
+        """
+        workbook = openpyxl.load_workbook(input_path, read_only=True, data_only=True)
+        try:
+            worksheet = workbook.active
+            # The HKEX workbook declares a wrong sheet dimension, which truncates read-only iteration
+            worksheet.reset_dimensions()
+            rows = worksheet.iter_rows(values_only=True)
+            header = next(row for row in rows if row and row[0] == 'Stock Code')
+            input_df = pd.DataFrame.from_records(rows, columns=[str(column) for column in header])
+        finally:
+            workbook.close()
+        return SecurityMaster.parse_security_df(input_df)
+
+    @staticmethod
+    def read_security_file(input_path: Path) -> pd.DataFrame:
+        return SecurityMaster.read_security_xlsx(input_path) if Path(input_path).suffix == '.xlsx' else \
+            SecurityMaster.read_security_csv(input_path)
+
+    def write_master(self, security_df: pd.DataFrame, source_signature: str) -> None:
+        """
+            Write the typed security master atomically, tagged with the signature of its source
+        """
+        table = pa.Table.from_pandas(security_df, preserve_index=True)
+        table = table.replace_schema_metadata({**table.schema.metadata,
+                                               b'source_signature': json.dumps(source_signature).encode()})
+        self.master_path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = self.master_path.with_suffix('.parquet.tmp')
+        pq.write_table(table, temp_path)
+        os.replace(temp_path, self.master_path)
+
+    def read_master(self):
+        """
+            Read the stored security master
+        :return: (Dataframe, source signature) or (None, None) if it does not exist
+        """
+        if not self.master_path.is_file():
+            return None, None
+        table = pq.read_table(self.master_path)
+        source_signature = (table.schema.metadata or {}).get(b'source_signature')
+        return table.to_pandas(), json.loads(source_signature) if source_signature else None
+
+    def set_security_df(self, security_df: pd.DataFrame, source_signature) -> None:
+        # Published in a single assignment
+        self.snapshot = SecuritySnapshot(security_df, {code: i for i, code in enumerate(security_df.index)},
+                                         security_df['board_lot'].to_numpy(), security_df['name'].to_numpy(),
+                                         security_df['category'].to_numpy(), source_signature)
+
+    def refresh(self) -> bool:
+        """
+            Reload the security master if the source file changed since it was loaded.
+            The Parquet master is regenerated only if it was built from a different content of the source file
+        :return: True if reloaded
+        """
+        with self.lock:
+            return self.__refresh()
+
+    def __refresh(self) -> bool:
+        if not self.source_path.is_file():
+            if self.source_signature is None:
+                security_df, source_signature = self.read_master()
+                if security_df is not None:
+                    self.set_security_df(security_df, source_signature)
+                    return True
+            return False
+        file_stat = self.source_path.stat()
+        source_stat = (file_stat.st_mtime_ns, file_stat.st_size)
+        if source_stat == self.source_stat:
+            return False
+        self.source_stat = source_stat
+        source_signature = self.get_signature(self.source_path.read_bytes())
+        if source_signature == self.source_signature:
+            return False
+        security_df, stored_signature = self.read_master()
+        if security_df is None or stored_signature != source_signature:
+            security_df = self.read_security_file(self.source_path)
+            self.write_master(security_df, source_signature)
+            self.default_logger.info(f'Security master regenerated with {len(security_df)} securities: '
+                                     f'{self.master_path}')
+        self.set_security_df(security_df, source_signature)
+        return True
+
+    def update_source(self, content: bytes) -> bool:
+        """
+            Replace the source file with a new download. Nothing is regenerated if the content is identical with the
+            source of the current security master
+        :param content: Downloaded HKEX List of Securities
+        :return: True if the security master is regenerated
+        """
+        source_signature = self.get_signature(content)
+        with self.lock:
+            if source_signature == self.source_signature and self.source_path.is_file():
+                self.default_logger.info(f'HKEX List of Securities unchanged (SHA-1 {source_signature})')
+                return False
+            self.source_path.parent.mkdir(parents=True, exist_ok=True)
+            temp_path = self.source_path.with_suffix(f'{self.source_path.suffix}.tmp')
+            temp_path.write_bytes(content)
+            os.replace(temp_path, self.source_path)
+            return self.__refresh()
+
+    def get_board_lot(self, stock_code: str, default: int = None):
+        """
+            Board Lot Size (Minimum Trading Unit) of a stock (e.g., HK.00001 -> 500)
+        """
+        snapshot = self.get_snapshot()
+        position = snapshot.positions.get(stock_code)
+        return int(snapshot.board_lots[position]) if position is not None else default
+
+    def get_name(self, stock_code: str, default: str = None):
+        snapshot = self.get_snapshot()
+        position = snapshot.positions.get(stock_code)
+        return snapshot.names[position] if position is not None else default
+
+    def get_category(self, stock_code: str, default: str = None):
+        snapshot = self.get_snapshot()
+        position = snapshot.positions.get(stock_code)
+        return snapshot.categories[position] if position is not None else default
+
+    def get_board_lots(self, stock_list: list, default: int = 0) -> np.ndarray:
+        """
+            Board Lot Sizes of a list of stocks in one vectorized lookup
+        """
+        security_df = self.get_snapshot().security_df
+        return security_df['board_lot'].reindex(stock_list).fillna(default).to_numpy(dtype='int64')
+
+    def get_security_df(self, category: str = None) -> pd.DataFrame:
+        """
+            Copy of the security master, optionally filtered by category (e.g., Equity)
+        """
+        security_df = self.get_snapshot().security_df
+        if category is None:
+            return security_df.copy()
+        return security_df[security_df['category'] == category].copy()
+
+    def get_hkex_df(self) -> pd.DataFrame:
+        """
+            Security master with the HKEX column names (e.g., Stock Code = 00001, Board Lot), in the HKEX order
+        """
+        return self.get_snapshot().security_df.reset_index(drop=True).rename(
+            columns={column: source_column for source_column, (column, column_type) in SecurityMaster.COLUMNS.items()})
+
+    def get_stock_list(self, category: str = 'Equity') -> list:
+        security_df = self.get_snapshot().security_df
+        return security_df.index[security_df['category'] == category].tolist()
+
+    def get_board_lot_map(self, category: str = 'Equity') -> dict:
+        security_df = self.get_snapshot().security_df
+        security_df = security_df[security_df['category'] == category]
+        return dict(zip(security_df.index, security_df['board_lot'].tolist()))
@@ -14,28 +14,43 @@
 #
 #  Written by Bill Chan <billpwchan@hotmail.com>, 2021
 #  Copyright (c)  billpwchan - All Rights Reserved
-from datetime import date
-from multiprocessing import Pool, cpu_count
+from datetime import date, timedelta
 
 import pandas as pd
 from tqdm import tqdm
 
-from engines.data_engine import TuShareInterface, YahooFinanceInterface
+from engines.data_engine import DataProcessingInterface, TuShareInterface, YahooFinanceInterface
+from engines.fundamentals_store import FundamentalsStore
+from engines.history_cache import YahooHistoryCache
 from util import logger
 from util.global_vars import *
 
 
 class StockFilter:
-    def __init__(self, stock_filters: list, full_equity_list: list):
+    def __init__(self, stock_filters: list, full_equity_list: list, history_cache: YahooHistoryCache = None,
+                 data_source: str = 'yahoo', fundamentals: FundamentalsStore = None):
+        """
+        :param stock_filters: List of Filters
+        :param full_equity_list: Stock List in Futu Format (e.g., [HK.00001, HK.00002])
+        :param history_cache: Local store of Yahoo Finance daily bars
+        :param data_source: 'yahoo' (Yahoo Finance daily bars, cached locally) or 'local' (1D K-line data downloaded
+                            from Futu, falls back to Yahoo Finance for stocks without local data)
+        :param fundamentals: Stored fundamentals passed to the filters as info_data (Default = Local store)
+        """
         self.default_logger = logger.get_logger("stock_filter")
         self.config = config
         self.full_equity_list = full_equity_list
         self.stock_filters = stock_filters
+        self.history_cache = history_cache or YahooHistoryCache()
+        self.data_source = data_source
+        self.fundamentals = fundamentals or FundamentalsStore()
         self.default_logger.info(f'Stock Filter initialized ({len(full_equity_list)}: {full_equity_list}')
 
-    def validate_stock(self, equity_code):
+    def validate_stock(self, equity_code, quant_data: pd.DataFrame = None):
         try:
-            if 'HK' in equity_code or 'US' in equity_code:
+            if quant_data is not None:
+                quant_data = quant_data.copy()
+            elif 'HK' in equity_code or 'US' in equity_code:
                 quant_data = YahooFinanceInterface.get_stock_history(equity_code)
             elif 'SZ' in equity_code or 'SH' in equity_code:
                 quant_data = TuShareInterface.get_stock_history(equity_code)
@@ -45,22 +60,21 @@ class StockFilter:
             # self.default_logger.error(f'Exception Happened: {e}')
             return None
         quant_data.columns = [item.lower().strip() for item in quant_data]
-        # info_data = YahooFinanceInterface.get_stock_info(equity_code)
-        info_data = {}
+        info_data = self.fundamentals.get_info(equity_code)
         if all([stock_filter.validate(quant_data, info_data) for stock_filter in self.stock_filters]):
             self.default_logger.info(
                 f"{equity_code} is selected based on stock filter {[type(stock_filter).__name__ for stock_filter in self.stock_filters]}")
             return equity_code
         return None
 
-    def validate_stock_individual(self, equity_code):
+    def validate_stock_individual(self, equity_code, quant_data: pd.DataFrame = None):
         try:
-            quant_data = YahooFinanceInterface.get_stock_history(equity_code)
+            quant_data = quant_data.copy() if quant_data is not None else \
+                YahooFinanceInterface.get_stock_history(equity_code)
         except Exception as e:
             self.default_logger.error(f'Exception Happened: {e}')
         quant_data.columns = [item.lower().strip() for item in quant_data]
-        # info_data = YahooFinanceInterface.get_stock_info(equity_code)
-        info_data = {}
+        info_data = self.fundamentals.get_info(equity_code)
         output_list = []
         for stock_filter in self.stock_filters:
             if stock_filter.validate(quant_data, info_data):
@@ -69,18 +83,45 @@ class StockFilter:
                 output_list.append((type(stock_filter).__name__, equity_code))
         return output_list
 
+    def get_local_history_dict(self) -> dict:
+        """
+            Load the 1D K-line data of the full equity list from the local data folder in bulk
+        :return: Dictionary in Format {'HK.00001': pd.Dataframe indexed by date}. Stocks without local data are omitted
+        """
+        start_date = date.today() - timedelta(days=self.history_cache.history_days)
+        input_dict = DataProcessingInterface.get_1D_data_dict(self.full_equity_list, start_date=start_date)
+        return {equity_code: input_df.set_index('time_key') for equity_code, input_df in input_dict.items() if
+                not input_df.empty}
+
+    def get_history_dict(self) -> dict:
+        """
+            Daily history of the full equity list, either from the local 1D data or from Yahoo Finance.
+            Yahoo Finance daily bars are updated in batches (only for the stocks without local data in local mode),
+            then loaded in bulk
+        :return: Dictionary in Format {'HK.00001': pd.Dataframe, 'HK.00002': pd.Dataframe}
+        """
+        history_dict = self.get_local_history_dict() if self.data_source == 'local' else {}
+        missing_list = [equity_code for equity_code in self.full_equity_list if equity_code not in history_dict]
+        if self.data_source == 'local':
+            self.default_logger.info(f'Local 1D data found for {len(history_dict)} stocks. '
+                                     f'Downloading {len(missing_list)} stocks from Yahoo Finance')
+        if missing_list:
+            self.history_cache.update(missing_list)
+            history_dict.update(self.history_cache.get_history_dict(missing_list))
+        return {equity_code: history_dict.get(equity_code, pd.DataFrame(columns=YahooHistoryCache.COLUMNS)) for
+                equity_code in self.full_equity_list}
+
     def get_filtered_equity_pools(self) -> list:
         """
             Use User-Defined Filters to filter bad equities away.
-            Based on history data extracted from Yahoo Finance
+            Based on history data extracted from Yahoo Finance (cached locally) / TuShare
         :return: Filtered Stock Code List in Futu Stock Code Format
         """
         filtered_stock_list = []
         if 'HK' in self.full_equity_list[0] or 'US' in self.full_equity_list[0]:
-            pool = Pool(min(len(self.full_equity_list), cpu_count()))
-            filtered_stock_list = pool.map(self.validate_stock, self.full_equity_list)
-            pool.close()
-            pool.join()
+            history_dict = self.get_history_dict()
+            filtered_stock_list = [self.validate_stock(equity_code, quant_data) for equity_code, quant_data in
+                                   history_dict.items()]
         else:
             for stock_code in tqdm(self.full_equity_list):
                 result = self.validate_stock(stock_code)
@@ -97,10 +138,9 @@ class StockFilter:
            Based on history data extracted from Yahoo Finance
        :return: Filtered Stock Code List in Futu Stock Code Format
        """
-        pool = Pool(cpu_count())
-        filtered_stock_list = pool.map(self.validate_stock_individual, self.full_equity_list)
-        pool.close()
-        pool.join()
+        history_dict = self.get_history_dict()
+        filtered_stock_list = [self.validate_stock_individual(equity_code, quant_data) for equity_code, quant_data in
+                               history_dict.items()]
 
         filtered_stock_df = pd.DataFrame([], columns=['filter', 'code'])
 
@@ -0,0 +1,202 @@
+#  Futu Algo: Algorithmic High-Frequency Trading Framework
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#  Written by Bill Chan <billpwchan@hotmail.com>, 2021
+#  Copyright (c)  billpwchan - All Rights Reserved
+
+
+import os
+
+import numpy as np
+import pandas as pd
+
+from util import logger
+from util.global_vars import *
+
+
+class TradeLedger:
+    """
+        Columnar ledger of the fills, realized P&L and positions of a backtesting / paper trading run.
+        Stock codes and time keys are stored as integer indices, and every fill is written into pre-allocated NumPy
+        arrays (doubled when full), so recording a fill is O(1). DataFrames are only created when the run finishes
+        (get_transactions_df, get_returns_df, save).
+        Positions use the average cost. Commission (FixedCharge per fill + PercCharge % of half the fill value) is
+        deducted from the realized P&L when a position is closed, including the commission of its buy fills.
+    """
+    default_logger = logger.get_logger("trade_ledger")
+    FILL_COLUMNS = {'time_index': np.int64, 'symbol_index': np.int32, 'side': np.int8, 'price': np.float64,
+                    'quantity': np.float64, 'commission': np.float64, 'realized_pnl': np.float64}
+    POSITION_COLUMNS = {'quantity': np.float64, 'average_cost': np.float64, 'open_commission': np.float64,
+                        'realized_pnl': np.float64}
+    BUY_SIDES = {'BUY', 'BUY_BACK'}
+    SELL_SIDES = {'SELL', 'SELL_SHORT'}
+
+    def __init__(self, fixed_charge: float = 0, perc_charge: float = 0, capacity: int = 1024):
+        """
+        :param fixed_charge: Commission per fill (e.g., 15.5 HKD)
+        :param perc_charge: Commission in % of half the fill value (e.g., 0.1097)
+        :param capacity: Initial number of fills
+        """
+        self.fixed_charge = fixed_charge
+        self.perc_charge = perc_charge
+        self.num_fills = 0
+        self.fills = {column: np.zeros(max(capacity, 1), dtype=dtype) for column, dtype in
+                      TradeLedger.FILL_COLUMNS.items()}
+        self.positions = {column: np.zeros(16, dtype=dtype) for column, dtype in
+                          TradeLedger.POSITION_COLUMNS.items()}
+        self.symbols = []
+        self.symbol_indices = {}
+        self.times = []
+        self.time_indices = {}
+
+    @staticmethod
+    def from_config():
+        """
+            Ledger with the commission of the HK market as defined in config.ini
+        """
+        return TradeLedger(config.getfloat('Backtesting.Commission.HK', 'FixedCharge', fallback=0),
+                           config.getfloat('Backtesting.Commission.HK', 'PercCharge', fallback=0))
+
+    def __len__(self) -> int:
+        return self.num_fills
+
+    def get_symbol_index(self, stock_code: str) -> int:
+        symbol_index = self.symbol_indices.get(stock_code)
+        if symbol_index is None:
+            symbol_index = self.symbol_indices[stock_code] = len(self.symbols)
+            self.symbols.append(stock_code)
+            if symbol_index == len(self.positions['quantity']):
+                self.positions = {column: np.concatenate([array, np.zeros_like(array)]) for column, array in
+                                  self.positions.items()}
+        return symbol_index
+
+    def get_time_index(self, time_key: str) -> int:
+        time_index = self.time_indices.get(time_key)
+        if time_index is None:
+            time_index = self.time_indices[time_key] = len(self.times)
+            self.times.append(time_key)
+        return time_index
+
+    def get_commission(self, price: float, quantity: float) -> float:
+        return self.fixed_charge + price * quantity * self.perc_charge / 100 / 2
+
+    def add_fill(self, time_key: str, stock_code: str, price: float, quantity: float, trd_side: str) -> float:
+        """
+            Record a fill and update the position of the stock
+        :param time_key: Time of the fill (e.g., 2022-04-12 09:31:00)
+        :param stock_code: Stock Code with Format (e.g., HK.00001)
+        :param price: Fill price
+        :param quantity: Fill quantity (positive)
+        :param trd_side: BUY / SELL (BUY_BACK / SELL_SHORT for short positions)
+        :return: Realized P&L of the fill (0 if it does not close a position)
+        """
+        if trd_side not in TradeLedger.BUY_SIDES | TradeLedger.SELL_SIDES:
+            raise ValueError(f'Unknown trade side {trd_side} of {stock_code}')
+        side = 1 if trd_side in TradeLedger.BUY_SIDES else -1
+        symbol_index = self.get_symbol_index(stock_code)
+        commission = self.get_commission(price, quantity)
+
+        # Average cost of the position (the commission is kept until the position is closed)
+        position_qty = self.positions['quantity'][symbol_index]
+        average_cost = self.positions['average_cost'][symbol_index]
+        open_commission = self.positions['open_commission'][symbol_index]
+        realized_pnl = 0.0
+        if position_qty == 0 or np.sign(position_qty) == side:
+            average_cost = (average_cost * abs(position_qty) + price * quantity) / (abs(position_qty) + quantity)
+            open_commission += commission
+        else:
+            closed_qty = min(quantity, abs(position_qty))
+            closed_commission = open_commission * closed_qty / abs(position_qty)
+            realized_pnl = np.sign(position_qty) * (price - average_cost) * closed_qty - closed_commission - \
+                           commission * closed_qty / quantity
+            open_commission -= closed_commission
+            if quantity > closed_qty:
+                # The position is reversed
+                average_cost, open_commission = price, commission * (quantity - closed_qty) / quantity
+        position_qty += side * quantity
+        if position_qty == 0:
+            average_cost, open_commission = 0.0, 0.0
+        self.positions['quantity'][symbol_index] = position_qty
+        self.positions['average_cost'][symbol_index] = average_cost
+        self.positions['open_commission'][symbol_index] = open_commission
+        self.positions['realized_pnl'][symbol_index] += realized_pnl
+
+        if self.num_fills == len(self.fills['price']):
+            self.fills = {column: np.concatenate([array, np.zeros_like(array)]) for column, array in
+                          self.fills.items()}
+        for column, value in [('time_index', self.get_time_index(time_key)), ('symbol_index', symbol_index),
+                              ('side', side), ('price', price), ('quantity', quantity), ('commission', commission),
+                              ('realized_pnl', realized_pnl)]:
+            self.fills[column][self.num_fills] = value
+        self.num_fills += 1
+        return realized_pnl
+
+    def get_position(self, stock_code: str) -> float:
+        """
+            Holding quantity of a stock (negative for short positions)
+        """
+        symbol_index = self.symbol_indices.get(stock_code)
+        return 0.0 if symbol_index is None else float(self.positions['quantity'][symbol_index])
+
+    def get_fills_df(self) -> pd.DataFrame:
+        """
+            All fills (time_key, code, price, quantity, trd_side, commission, realized_pnl) in recorded order
+        """
+        fills = {column: array[:self.num_fills] for column, array in self.fills.items()}
+        return pd.DataFrame({'time_key':     np.array(self.times, dtype=object)[fills['time_index']],
+                             'code':         np.array(self.symbols, dtype=object)[fills['symbol_index']],
+                             'price':        fills['price'], 'quantity': fills['quantity'],
+                             'trd_side':     np.where(fills['side'] == 1, 'BUY', 'SELL').astype(object),
+                             'commission':   fills['commission'], 'realized_pnl': fills['realized_pnl']})
+
+    def get_transactions_df(self) -> pd.DataFrame:
+        """
+            Fills in the format of the backtesting Transactions report
+        """
+        return self.get_fills_df()[['time_key', 'code', 'price', 'quantity', 'trd_side']]
+
+    def get_positions_df(self) -> pd.DataFrame:
+        """
+            Positions of all stocks traded (quantity, average_cost, open_commission, realized_pnl) indexed by code
+        """
+        num_symbols = len(self.symbols)
+        return pd.DataFrame({column: array[:num_symbols] for column, array in self.positions.items()},
+                            index=pd.Index(self.symbols, name='code'))
+
+    def get_returns_df(self, date_range: list, stock_list: list) -> pd.DataFrame:
+        """
+            Realized P&L per day & stock (on the day of the closing fill)
+        :param date_range: Dates in Format %Y-%m-%d
+        :param stock_list: Stock List in Futu Format (e.g., [HK.00001, HK.00002])
+        """
+        time_index = self.fills['time_index'][:self.num_fills]
+        dates = pd.Index(date_range).get_indexer([time_key[:10] for time_key in self.times])[time_index] if \
+            self.times else np.array([], dtype=int)
+        columns = pd.Index(stock_list).get_indexer(self.symbols)[self.fills['symbol_index'][:self.num_fills]] if \
+            self.symbols else np.array([], dtype=int)
+        valid = (dates >= 0) & (columns >= 0)
+        returns = np.zeros((len(date_range), len(stock_list)))
+        np.add.at(returns, (dates[valid], columns[valid]), self.fills['realized_pnl'][:self.num_fills][valid])
+        return pd.DataFrame(returns, index=date_range, columns=stock_list)
+
+    def save(self, file_path: Path) -> None:
+        """
+            Save all fills as Parquet
+        """
+        file_path = Path(file_path)
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = file_path.with_suffix('.parquet.tmp')
+        self.get_fills_df().to_parquet(temp_path, index=False)
+        os.replace(temp_path, file_path)
+        self.default_logger.info(f'Saved {self.num_fills} fills of {len(self.symbols)} stocks to {file_path}')
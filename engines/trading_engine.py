@@ -21,8 +21,8 @@ import json
 import pathlib
 import platform
 import subprocess
+import threading
 from datetime import date, datetime, timedelta
-from multiprocessing import Pool, cpu_count
 
 import pandas as pd
 import psutil
@@ -31,10 +31,14 @@ from futu import AccumulateFilter, AuType, Currency, KLType, KL_FIELD, Market, M
     Plate, RET_ERROR, RET_OK, \
     SecurityReferenceType, \
     SecurityType, \
-    SimpleFilter, SortDir, StockField, SubType, TradeDateMarket, TrdEnv, SysConfig
+    SimpleFilter, SortDir, StockField, SubType, TradeDateMarket, TradeDateType, TrdEnv, SysConfig
 
 import engines
-from engines import DataProcessingInterface, HKEXInterface, YahooFinanceInterface
+from engines import DataProcessingInterface, HKEXInterface
+from engines.bar_cache import BarCache
+from engines.data_store import PartitionedDataStore
+from engines.download_scheduler import TokenBucket
+from engines.fundamentals_store import FundamentalsStore
 from util import logger
 from util.global_vars import *
 
@@ -69,6 +73,10 @@ class FutuTrade:
                                    SecurityType.IDX, SecurityType.ETF, SecurityType.FUTURE, SecurityType.PLATE,
                                    SecurityType.PLATESET]
         self.reference_type_list = [SecurityReferenceType.WARRANT, SecurityReferenceType.FUTURE]
+        # Shared by all download threads (max. 60 history K-line requests per 30 seconds)
+        self.history_rate_limiter = TokenBucket.from_config()
+        # OpenQuoteContext is not documented as thread-safe: the requests of the download workers are serialized
+        self.quote_lock = threading.Lock()
 
     def __del__(self):
         """
@@ -79,6 +87,14 @@ class FutuTrade:
         self.default_logger.info("Deleting Trade_CTX Connection")
         self.trade_ctx.close()  # 关闭当条连接，FutuOpenD会在1分钟后自动取消相应股票相应类型的订阅
 
+    def close(self):
+        """
+            End of a trading session. Save the fills to ./trading_report & Disconnect all Quote & Trade Connections
+        """
+        self.trading_util.save_ledger()
+        self.quote_ctx.close()
+        self.trade_ctx.close()
+
     def __init_futu_client(self):
         os_type = platform.system()
         if os_type == 'Windows' and 'FutuOpenD.exe' not in (p.name() for p in psutil.process_iter()):
@@ -224,64 +240,140 @@ class FutuTrade:
                 self.default_logger.error(f'Cannot get Real-time K-line data: {data}')
         return input_data
 
-    def update_1M_data(self, stock_code: str, years=2, force_update: bool = False, default_days: int = 30):
+    def get_data_warmup(self, stock_list: list, sub_type: SubType = SubType.K_1M, kline_num: int = 1000) -> dict:
+        """
+        Initial technical indicators observations for day trading.
+        If the Customized-Interval bars are materialized (see BarCache), previous trading days are loaded from the
+        cache and only today's K-line data is requested from OpenD. Otherwise fall back to get_data_realtime.
+        :param stock_list: List of selected stocks ['HK.00009', 'HK.00001']
+        :param sub_type: Futu subscription type
+        :param kline_num: Number of observations (i.e., default to 1000)
+        :return: dictionary of k-line data
+        """
+        custom_interval = {SubType.K_3M: 3, SubType.K_5M: 5, SubType.K_15M: 15, SubType.K_30M: 30,
+                           SubType.K_60M: 60}.get(sub_type)
+        if custom_interval not in BarCache.get_materialized_intervals():
+            return self.get_data_realtime(stock_list, sub_type, kline_num)
+
+        # A full trading day has 330 1M bars. Add a buffer for weekends and holidays
+        bars_per_day = -(-330 // custom_interval)
+        num_days = -(-kline_num // bars_per_day) * 7 // 5 + 7
+        date_range = pd.date_range(end=datetime.today() - timedelta(days=1), periods=num_days, freq='d').strftime(
+            DATETIME_FORMAT_DW).tolist()
+        cached_data = BarCache().get_custom_interval_data_range(date_range, custom_interval, stock_list)
+
+        input_data = self.get_data_realtime([stock_code for stock_code in stock_list if stock_code not in cached_data],
+                                            sub_type, kline_num)
+        today_data = self.get_data_realtime([stock_code for stock_code in stock_list if stock_code in cached_data],
+                                            sub_type, bars_per_day)
+        for stock_code, today_df in today_data.items():
+            input_df = pd.concat([cached_data[stock_code], today_df], ignore_index=True)
+            input_df.drop_duplicates(subset=['time_key'], keep='last', inplace=True)
+            input_data[stock_code] = input_df.iloc[-kline_num:].reset_index(drop=True)
+        return input_data
+
+    def __request_history_kline(self, stock_code: str, **kwargs) -> tuple:
+        """
+            Request history K-line within the OpenD rate limit (blocks until a request token is available)
+        :return: (ret, data, page_req_key)
+        """
+        self.history_rate_limiter.acquire()
+        with self.quote_lock:
+            return self.quote_ctx.request_history_kline(stock_code, **kwargs)
+
+    def __request_history_kline_1M(self, stock_code: str, start_date: str, end_date: str):
+        """
+            Request all pages of 1M history K-line between start_date and end_date (inclusive)
+        :return: pd.DataFrame or None if any request fails
+        """
+        column_names = json.loads(self.config.get('FutuOpenD.DataFormat', 'HistoryDataFormat'))
+        # Pages are accumulated and concatenated once at the end
+        history_dfs = [pd.DataFrame(columns=column_names)]
+        page_req_key = None
+        while True:
+            ret, data, page_req_key = self.__request_history_kline(stock_code, start=start_date, end=end_date,
+                                                                   ktype=KLType.K_1M, autype=AuType.QFQ,
+                                                                   fields=[KL_FIELD.ALL], max_count=1000,
+                                                                   page_req_key=page_req_key, extended_time=False)
+            if ret != RET_OK:
+                # Nothing is saved from an incomplete download. The scheduler retries the whole range
+                self.default_logger.error(f'Cannot get Historical 1M K-line data: {data}')
+                return None
+            history_dfs.append(data)
+            # 请求后面的所有结果
+            if page_req_key is None:
+                break
+        return pd.concat(history_dfs, ignore_index=True)
+
+    def update_1M_data(self, stock_code: str, years=2, force_update: bool = False, default_days: int = 30,
+                       trading_days: list = None):
         """
             Update 1M Data to ./data/{stock_code} folders for max. 2-years duration
             Assume today is 2022-04-17, the oldest data that can be downloaded is 2020-04-17
+            Only the trading days without stored 1M data are requested (in as few consecutive ranges as possible),
+            so a stock that is already up-to-date costs no request at all
         :param stock_code: Stock Code with Format (e.g., HK.00001)
         :param years: 2 years
-        :param default_days:
-        :param force_update:
+        :param default_days: Number of days to download for a stock without any 1M data
+        :param force_update: Re-download all 2-years 1M data
+        :param trading_days: Trading calendar (YYYY-MM-DD) of the stock's market covering the last 2 years
+                             (Default = Request from OpenD)
+        :return: False if any request fails
         """
-        column_names = json.loads(self.config.get('FutuOpenD.DataFormat', 'HistoryDataFormat'))
-        history_df = pd.DataFrame(columns=column_names)
-        # If force update, update all 2-years 1M data. Otherwise only update the last week's data
-        start_date = str((datetime.today() - timedelta(days=round(365 * years))).date()) if force_update else str(
-            (datetime.today() - timedelta(days=default_days)).date())
-        end_date = str(datetime.today().date())
-        # This will give a list of dates between 2-years range
-        date_range = pd.date_range(start_date, end_date, freq='d').strftime(DATETIME_FORMAT_DW).tolist()
-        # Retrieve the first page
-        ret, data, page_req_key = self.quote_ctx.request_history_kline(stock_code,
-                                                                       start=start_date,
-                                                                       end=end_date,
-                                                                       ktype=KLType.K_1M, autype=AuType.QFQ,
-                                                                       fields=[KL_FIELD.ALL],
-                                                                       max_count=1000, page_req_key=None,
-                                                                       extended_time=False)
-        if ret == RET_OK:
-            history_df = pd.concat([history_df, data], ignore_index=True)
+        market = stock_code.split('.')[0]
+        oldest_date = str((datetime.today() - timedelta(days=round(365 * years))).date())
+        end_date = self.get_last_completed_trading_date(market)
+        trading_days = trading_days if trading_days is not None else self.get_trading_days(oldest_date, end_date,
+                                                                                            market)
+        trading_days = [trading_day for trading_day in trading_days if oldest_date <= trading_day <= end_date]
+        if not trading_days:
+            return True
+
+        if force_update:
+            # If force update, update all 2-years 1M data
+            date_ranges = [(trading_days[0], trading_days[-1])]
         else:
-            self.default_logger.error(f'Cannot get Historical 1M K-line data: {data}')
-            return
-
-        # 请求后面的所有结果
-        while page_req_key is not None:
-            # The inner loop is to ensure that whenever there is an error, we can re-try until it success
-            while True:
-                original_page_req_key = page_req_key
-                ret, data, page_req_key = self.quote_ctx.request_history_kline(stock_code,
-                                                                               start=start_date,
-                                                                               end=end_date,
-                                                                               ktype=KLType.K_1M, autype=AuType.QFQ,
-                                                                               fields=[KL_FIELD.ALL],
-                                                                               max_count=1000,
-                                                                               page_req_key=page_req_key,
-                                                                               extended_time=False)
-                if ret == RET_OK:
-                    history_df = pd.concat([history_df, data], ignore_index=True)
-                    break
-                self.default_logger.error(f'Cannot get Historical 1M K-line data: {data}')
-                # Revert to previous page req key and re-try again
-                page_req_key = original_page_req_key
-                time.sleep(1)
-
-        for input_date in date_range:
-            output_path = PATH_DATA / stock_code / f'{stock_code}_{input_date}_1M.parquet'
-            output_df = history_df[history_df['time_key'].str.contains(input_date)]
-            if DataProcessingInterface.save_stock_df_to_file(output_df, output_path):
+            stored_dates = DataProcessingInterface.get_1M_trading_dates(stock_code)
+            # Fill the gaps since the first stored day. Stocks without any data start from the last default_days
+            start_date = max(stored_dates[0], oldest_date) if stored_dates else str(
+                (datetime.today() - timedelta(days=default_days)).date())
+            # Days already known to have no data (e.g., suspension) are not requested again
+            date_ranges = DataProcessingInterface.get_missing_date_ranges(
+                [trading_day for trading_day in trading_days if trading_day >= start_date],
+                set(stored_dates) | DataProcessingInterface.get_empty_1M_dates(stock_code))
+        if not date_ranges:
+            self.default_logger.info(f'1M K-line data of {stock_code} is up-to-date')
+            return True
+
+        # Recent days may be missing only because the provider lags behind, so they are not recorded as empty yet
+        empty_end_date = str((pd.Timestamp(end_date) - timedelta(
+            days=DataProcessingInterface.get_empty_day_grace_days())).date())
+        for start_date, end_date in date_ranges:
+            history_df = self.__request_history_kline_1M(stock_code, start_date, end_date)
+            if history_df is None:
+                return False
+
+            # The trading calendar does not exclude suspensions & temporary closures, which have no 1M data
+            returned_dates = set(history_df['time_key'].astype(str).str[:10])
+            DataProcessingInterface.add_empty_1M_dates(stock_code, [
+                trading_day for trading_day in trading_days if
+                start_date <= trading_day <= min(end_date, empty_end_date) and trading_day not in returned_dates])
+
+            if PartitionedDataStore.is_enabled():
+                PartitionedDataStore().write_stock_df(stock_code, history_df)
+                continue
+
+            for output_path in DataProcessingInterface.save_1M_data_by_day(stock_code, history_df):
                 self.default_logger.info(f'Saved 1M K-line data to {output_path}')
-        time.sleep(0.5)
+        return True
+
+    @staticmethod
+    def get_DW_years(years=10, force_update: bool = False) -> list:
+        """
+            Years of the 1D / 1W files to update (one file per year), from the current year backwards
+        """
+        num_years = 11 if force_update else years + 1
+        return [(datetime.today() - timedelta(days=i * 365)).year for i in range(num_years)]
 
     def update_DW_data(self, stock_code: str, years=10, force_update: bool = False, k_type: KLType = KLType.K_DAY):
         """
@@ -290,38 +382,44 @@ class FutuTrade:
         :param stock_code: Stock Code with Format (e.g., HK.00001)
         :param years: 10 years
         :param k_type: Futu K-Line Type
+        :return: False if any request fails
         """
-        for i in range(0, 11 if force_update else (years + 1)):
-            start_date = date((datetime.today() - timedelta(days=i * 365)).year, 1, 1)
+        return all([self.update_DW_data_year(stock_code, year, k_type) for year in
+                    self.get_DW_years(years, force_update)])
 
-            DataProcessingInterface.validate_dir(PATH_DATA / stock_code)
+    def update_DW_data_year(self, stock_code: str, year: int, k_type: KLType = KLType.K_DAY) -> bool:
+        """
+            Update the 1D / 1W file of one year (the data since the start of the year), so that a failed request can
+            be retried for this year only
+        :param stock_code: Stock Code with Format (e.g., HK.00001)
+        :param year: Year of the file (e.g., 2022)
+        :param k_type: Futu K-Line Type
+        :return: False if the request fails
+        """
+        DataProcessingInterface.validate_dir(PATH_DATA / stock_code)
 
-            if k_type == KLType.K_DAY:
-                output_path = PATH_DATA / stock_code / f'{stock_code}_{start_date.year}_1D.parquet'
-            elif k_type == KLType.K_WEEK:
-                output_path = PATH_DATA / stock_code / f'{stock_code}_{start_date.year}_1W.parquet'
-            else:
-                self.default_logger.error('Unsupported KLType. Please try it later.')
-                return False
+        if k_type == KLType.K_DAY:
+            output_path = PATH_DATA / stock_code / f'{stock_code}_{year}_1D.parquet'
+        elif k_type == KLType.K_WEEK:
+            output_path = PATH_DATA / stock_code / f'{stock_code}_{year}_1W.parquet'
+        else:
+            self.default_logger.error('Unsupported KLType. Please try it later.')
+            return False
 
-            # Request Historical K-line Data (Daily)
-            start_date = start_date.strftime(DATETIME_FORMAT_DW)
-            while True:
-                ret, data, page_req_key = self.quote_ctx.request_history_kline(stock_code, start=start_date,
-                                                                               end=None,
-                                                                               ktype=k_type, autype=AuType.QFQ,
-                                                                               fields=[KL_FIELD.ALL],
-                                                                               max_count=1000, page_req_key=None,
-                                                                               extended_time=False)
-                if ret == RET_OK:
-                    if DataProcessingInterface.save_stock_df_to_file(data, output_path):
-                        self.default_logger.info(f'Saved {k_type} K-line data to {output_path}')
-                    # Probably empty data during a non-trading date
-                    break
-                # Retry Storing Data due to too frequent requests (max. 60 requests per 30 seconds)
-                time.sleep(1)
-                self.default_logger.error(f'{k_type} Historical KLine Store Error: {data}')
-            time.sleep(0.6)
+        # Request Historical K-line Data (Daily)
+        start_date = date(year, 1, 1).strftime(DATETIME_FORMAT_DW)
+        ret, data, page_req_key = self.__request_history_kline(stock_code, start=start_date, end=None,
+                                                               ktype=k_type, autype=AuType.QFQ,
+                                                               fields=[KL_FIELD.ALL], max_count=1000,
+                                                               page_req_key=None, extended_time=False)
+        if ret != RET_OK:
+            # The scheduler retries the year with backoff
+            self.default_logger.error(f'{k_type} Historical KLine Store Error: {data}')
+            return False
+        # Probably empty data during a non-trading date
+        if DataProcessingInterface.save_stock_df_to_file(data, output_path):
+            self.default_logger.info(f'Saved {k_type} K-line data to {output_path}')
+        return True
 
     def update_plate_list(self):
         output_df = pd.DataFrame()
@@ -379,22 +477,12 @@ class FutuTrade:
         else:
             self.default_logger.error(f'Cannot get Stock Basic Info of {market} - {stock_type}: {data}')
 
-    def update_stock_fundamentals(self):
+    def update_stock_fundamentals(self, max_age_days: int = 7):
         """
         Update stock fundamentals information for all equities in Hong Kong stock market.
+        Only the equities without fundamentals or older than max_age_days are requested.
         """
-        pool = Pool(cpu_count())
-        output_list = pool.map(YahooFinanceInterface.parse_stock_info, HKEXInterface.get_equity_list_full())
-        pool.close()
-        pool.join()
-
-        output_dict = {}
-        for record in output_list:
-            output_dict[record[0]] = output_dict.get(record[0], record[1])
-            self.default_logger.info(f"Updated Stock Fundamentals for {record[0]}")
-
-        with open(PATH_DATA / 'Stock_Pool' / 'stock_fundamentals.json', 'w') as f:
-            json.dump(output_dict, f)
+        FundamentalsStore().update(HKEXInterface.get_equity_list_full(), max_age_days=max_age_days)
 
     def cur_kline_evaluate(self, stock_list: list, strategy_map: dict, sub_type: SubType = SubType.K_1M):
         """
@@ -426,14 +514,56 @@ class FutuTrade:
         if ret == RET_OK:
             self.default_logger.info(f'Historical K-line Quota: \n{data}')
 
-    def request_trading_days(self, start_date: str, end_date: str) -> dict:
+    def get_trading_days(self, start_date: str, end_date: str, market: str = 'HK') -> list:
+        """
+            Trading calendar of a market between start_date and end_date (inclusive)
+            Weekdays are used if the trading calendar cannot be retrieved from OpenD
+        :param market: Market Prefix of Stock Code (e.g., HK, US, SH, SZ)
+        :return: Sorted list of Date in String Format (YYYY-MM-DD)
+        """
+        trading_days = self.request_trading_days(start_date, end_date, market)
+        if not trading_days:
+            self.default_logger.warning('Cannot get the trading calendar. Assume all weekdays are trading days.')
+            return pd.bdate_range(start_date, end_date).strftime(DATETIME_FORMAT_DW).tolist()
+        return sorted(item['time'] for item in trading_days)
+
+    def get_half_trading_days(self, start_date: str, end_date: str) -> list:
+        """
+            Half trading days (morning session only, e.g., Lunar New Year's Eve) of HK market between start_date and
+            end_date (inclusive). Christmas Eve & New Year's Eve are used if the trading calendar cannot be retrieved
+        :return: Sorted list of Date in String Format (YYYY-MM-DD)
+        """
+        trading_days = self.request_trading_days(start_date, end_date)
+        if not trading_days:
+            return DataProcessingInterface.get_half_days(
+                pd.bdate_range(start_date, end_date).strftime(DATETIME_FORMAT_DW).tolist())
+        return sorted(item['time'] for item in trading_days if item['trade_date_type'] == TradeDateType.MORNING)
+
+    @staticmethod
+    def get_last_completed_trading_date(market: str = 'HK') -> str:
+        """
+            Today if the market is already closed (i.e., after the end of the last trading session). Otherwise yesterday
+            (in the market's local time, regardless of the local time zone)
+        :param market: Market Prefix of Stock Code (e.g., HK, US, SH, SZ)
+        """
+        time_zone, session_end = MARKET_SESSION_END.get(market, MARKET_SESSION_END['HK'])
+        now = pd.Timestamp.now(tz=time_zone)
+        if now.strftime('%H:%M') >= session_end:
+            return now.strftime(DATETIME_FORMAT_DW)
+        return (now - timedelta(days=1)).strftime(DATETIME_FORMAT_DW)
+
+    def request_trading_days(self, start_date: str, end_date: str, market: str = 'HK') -> dict:
         """
         请求交易日，注意该交易日是通过自然日剔除周末和节假日得到，未剔除临时休市数据。
         :param start_date:
         :param end_date:
+        :param market: Market Prefix of Stock Code (e.g., HK, US, SH, SZ)
         :return: [{'time': '2020-04-01', 'trade_date_type': 'WHOLE'}, ...]
         """
-        ret, data = self.quote_ctx.request_trading_days(TradeDateMarket.HK, start=start_date, end=end_date)
+        trade_date_market = {'US': TradeDateMarket.US, 'SH': TradeDateMarket.CN, 'SZ': TradeDateMarket.CN}.get(
+            market, TradeDateMarket.HK)
+        with self.quote_lock:
+            ret, data = self.quote_ctx.request_trading_days(trade_date_market, start=start_date, end=end_date)
         if ret == RET_OK:
             self.default_logger.info(f'Trading Days: {data}')
             return data
@@ -243,7 +243,7 @@ class MainWindow(QMainWindow):
                 row_number = self.ui.stockTradingTable.rowCount()
                 self.ui.stockTradingTable.insertRow(row_number)
                 for column_number, column_name in enumerate(headers):
-                    self.ui.stockTradingTable.setItem(row_number, column_number, QTableWidgetItem(stock[column_name]))
+                    self.ui.stockTradingTable.setItem(row_number, column_number, QTableWidgetItem(str(stock[column_name])))
 
         self.ui.stockTradingTable.resizeColumnsToContents()
 
@@ -597,6 +597,7 @@ class MainWindow(QMainWindow):
 
     def exit_app(self):
         global futu_trade
+        futu_trade.close()
         del futu_trade
         self.close()
 
@@ -20,7 +20,8 @@ import argparse
 import importlib
 import json
 import sys
-from datetime import datetime
+from datetime import datetime, timedelta
+from functools import partial
 from math import ceil
 
 from futu import KLType, Market, SecurityType, SubType
@@ -60,23 +61,40 @@ def daily_update_data(futu_trade, stock_list: list, force_update: bool = False):
 
     # Identify the last update date of the data
     default_days = max([DataProcessingInterface.get_num_days_to_update(stock_code) for stock_code in stock_list])
-
-    # Update historical k-line
+    # 1M data is updated per stock based on its own missing trading days, using one trading calendar per market
+    trading_days = {market: futu_trade.get_trading_days(str((datetime.today() - timedelta(days=365 * 2)).date()),
+                                                        futu_trade.get_last_completed_trading_date(market), market)
+                    for market in {stock_code.split('.')[0] for stock_code in stock_list}}
+
+    # Update historical k-line. The request rate is limited by the OpenD quota instead of fixed sleeps
+    # One task per yearly 1D / 1W file, so that only the failed years are retried
+    years = futu_trade.get_DW_years(years=ceil(default_days / 365), force_update=force_update)
+    tasks = []
     for stock_code in stock_list:
-        futu_trade.update_DW_data(stock_code, years=ceil(default_days / 365), force_update=force_update,
-                                  k_type=KLType.K_DAY)
-        futu_trade.update_DW_data(stock_code, years=ceil(default_days / 365), force_update=force_update,
-                                  k_type=KLType.K_WEEK)
-        futu_trade.update_1M_data(stock_code, force_update=force_update, default_days=default_days)
+        for year in years:
+            tasks.extend([
+                (f'{stock_code} 1D {year}', partial(futu_trade.update_DW_data_year, stock_code, year, KLType.K_DAY)),
+                (f'{stock_code} 1W {year}', partial(futu_trade.update_DW_data_year, stock_code, year, KLType.K_WEEK))])
+        tasks.append((f'{stock_code} 1M', partial(futu_trade.update_1M_data, stock_code, force_update=force_update,
+                                                  trading_days=trading_days[stock_code.split('.')[0]])))
+    DownloadScheduler(rate_limiter=futu_trade.history_rate_limiter).run(tasks)
+
+    # Materialize Customized-Interval bars (e.g., 5M) for the days with changed 1M data
+    if BarCache.get_materialized_intervals():
+        BarCache().update(stock_list)
 
     # Clean non-trading days data (Obsoleted)
     # DataProcessingInterface.clear_empty_data()
 
 
-def __dynamic_instantiation(prefix: str, module_name: str, optional_parameter=None):
+def __get_class(prefix: str, module_name: str):
     filter_module = importlib.import_module(f"{prefix}.{module_name}")
     # Assume the class name is identical with the file name except for the underscore _
-    class_ = getattr(filter_module, module_name.replace("_", ""))
+    return getattr(filter_module, module_name.replace("_", ""))
+
+
+def __dynamic_instantiation(prefix: str, module_name: str, optional_parameter=None):
+    class_ = __get_class(prefix, module_name)
     if optional_parameter is not None:
         return class_(optional_parameter)
     else:
@@ -108,17 +126,22 @@ def __init_filter(filter_list: list) -> list:
     return [__dynamic_instantiation(prefix="filters", module_name=filter_name) for filter_name in filter_list]
 
 
-def init_backtesting(strategy_name: str):
+def init_backtesting(strategy_name: str, vectorized: bool = False):
     start_date = datetime(2019, 3, 20).date()
     end_date = datetime(2021, 3, 23).date()
     stock_list = YahooFinanceInterface.get_top_30_hsi_constituents()
     bt = BacktestingEngine(stock_list=stock_list, start_date=start_date, end_date=end_date, observation=100)
-    bt.prepare_input_data_file_custom_M(custom_interval=5)
-    # bt.prepare_input_data_file_1M()
+    # Only the columns read by the strategy are loaded
+    required_columns = __get_class(prefix="strategies", module_name=strategy_name).REQUIRED_COLUMNS
+    bt.prepare_input_data_file_custom_M(custom_interval=5, columns=required_columns)
+    # bt.prepare_input_data_file_1M(columns=required_columns)
     strategy = __dynamic_instantiation(prefix="strategies", module_name=strategy_name,
                                        optional_parameter=bt.get_backtesting_init_data())
     bt.init_strategy(strategy)
-    bt.calculate_return()
+    if vectorized:
+        bt.calculate_return_vectorized()
+    else:
+        bt.calculate_return()
     # bt.create_tear_sheet()
 
 
@@ -127,19 +150,24 @@ def init_day_trading(futu_trade: trading_engine.FutuTrade, stock_list: list, str
     # Subscribe to the stock list first
     if futu_trade.kline_subscribe(stock_list, sub_type=sub_type):
         # Subscription Success -> Get Real Time Data
-        input_data = futu_trade.get_data_realtime(stock_list, sub_type=sub_type, kline_num=1000)
+        input_data = futu_trade.get_data_warmup(stock_list, sub_type=sub_type, kline_num=1000)
         # strategy_map = dict object {'HK.00001', MACD_Cross(), 'HK.00002', MACD_Cross()...}
         strategy_map = {stock_code: __init_strategy(strategy_name=stock_strategy_dict.get(stock_code, strategy_name),
                                                     input_data=input_data) for stock_code in stock_list}
-        while True:
-            futu_trade.cur_kline_evaluate(stock_list=stock_list, strategy_map=strategy_map, sub_type=sub_type)
+        try:
+            while True:
+                futu_trade.cur_kline_evaluate(stock_list=stock_list, strategy_map=strategy_map, sub_type=sub_type)
+        finally:
+            # Save the fills of the session (e.g., when interrupted)
+            futu_trade.close()
     else:
         sys.exit(1)
 
 
-def init_stock_filter(filter_list: list, full_equity_list: list) -> list:
+def init_stock_filter(filter_list: list, full_equity_list: list, data_source: str = 'yahoo') -> list:
     filters = __init_filter(filter_list)
-    stock_filter = StockFilter(stock_filters=filters, full_equity_list=full_equity_list.copy())
+    stock_filter = StockFilter(stock_filters=filters, full_equity_list=full_equity_list.copy(),
+                               data_source=data_source)
     return stock_filter.get_filtered_equity_pools()
 
 
@@ -152,6 +180,15 @@ def main():
                         action="store_true")
     parser.add_argument("-fu", "--force_update",
                         help="Force Update All Data Up to Max. Allowed Years (USE WITH CAUTION)", action="store_true")
+    parser.add_argument("--migrate_data",
+                        help="Convert per-day 1M data files into the partitioned (year/month) data store",
+                        action="store_true")
+    parser.add_argument("--rebuild_catalog",
+                        help="Build the data catalog (index of all K-line files) by scanning the data folder",
+                        action="store_true")
+    parser.add_argument("--scan_data", type=str, nargs="?", const="report", choices=["report", "quarantine", "delete"],
+                        help="Scan all K-line files for empty / truncated / schema-mismatched / out-of-range files "
+                             "(Report in ./data_report, optionally quarantine or delete them)")
 
     # Trading Related Arguments
     strategy_list = [file_name.name[:-3] for file_name in PATH_STRATEGIES.rglob("*.py") if
@@ -166,18 +203,36 @@ def main():
     # Backtesting Related Arguments
     parser.add_argument("-b", "--backtesting", type=str, choices=strategy_list,
                         help="Backtesting a Pre-defined Strategy")
+    parser.add_argument("--vectorized", help="Backtesting with the pre-computed signals of the strategy (Faster)",
+                        action="store_true")
 
     # Retrieve file names for all strategies as the argument option
     filter_list = [file_name.name[:-3] for file_name in PATH_FILTERS.rglob("*.py") if
                    "__init__" not in file_name.name and "Filters" not in file_name.name]
     parser.add_argument("-f", "--filter", type=str, choices=filter_list, nargs="+",
                         help="Filter Stock List based on Pre-defined Filters")
+    parser.add_argument("--filter_source", type=str, choices=['yahoo', 'local'], default='yahoo',
+                        help="Daily data used by the filters (local = Downloaded 1D data, Yahoo Finance for the rest)")
     parser.add_argument("-en", "--email_name", type=str, help="Name of the applied stock filtering techniques")
     parser.add_argument("-m", "--market", type=str, choices=['HK', 'CHINA', 'US'], nargs="+", help="Available Market")
 
     # Evaluate Arguments
     args = parser.parse_args()
 
+    if args.migrate_data:
+        # Per-day files are kept so the old layout stays readable
+        PartitionedDataStore().migrate_all(remove_source=False)
+
+    if args.rebuild_catalog:
+        DataCatalog().rebuild()
+
+    if args.scan_data:
+        DataProcessingInterface.scan_data_files(action=None if args.scan_data == 'report' else args.scan_data)
+
+    # Maintenance commands do not require FutuOpenD
+    if args.migrate_data or args.rebuild_catalog or args.scan_data:
+        sys.exit(0)
+
     # Initialization Connection
     futu_trade = trading_engine.FutuTrade()
     email_handler = email_engine.EmailEngine()
@@ -196,7 +251,7 @@ def main():
                 market_code = Market.HK if market == 'HK' else Market.US
                 full_equity_list.extend(
                     futu_trade.get_stock_basicinfo(market_code, SecurityType.STOCK)['code'].tolist())
-                filtered_stock_list = init_stock_filter(args.filter, full_equity_list)
+                filtered_stock_list = init_stock_filter(args.filter, full_equity_list, args.filter_source)
                 filtered_stock_dict = YahooFinanceInterface.get_stocks_email(filtered_stock_list)
 
             if 'CHINA' in args.market:
@@ -222,9 +277,8 @@ def main():
 
     if args.update or args.force_update:
         # Daily Update Data based on all available time files in the data folder
-        stock_list.extend(
-            [stock_code.name for stock_code in PATH_DATA.iterdir() if
-             stock_code.is_dir() and stock_code.name not in stock_list])
+        stock_list.extend([stock_code.name for stock_code in PATH_DATA.iterdir() if
+                           stock_code.is_dir() and stock_code.name not in stock_list])
         if 'Stock_Pool' in stock_list: stock_list.remove('Stock_Pool')
         daily_update_data(futu_trade=futu_trade, stock_list=stock_list, force_update=args.force_update)
 
@@ -240,9 +294,10 @@ def main():
             init_day_trading(futu_trade, stock_list, args.strategy, stock_strategy_map, sub_type=args.time_interval)
 
     if args.backtesting:
-        init_backtesting(args.backtesting)
+        init_backtesting(args.backtesting, vectorized=args.vectorized)
 
     futu_trade.display_quota()
+    DataFrameCache.shared().log_stats()
 
 
 if __name__ == '__main__':
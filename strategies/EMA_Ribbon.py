@@ -20,91 +20,113 @@ import pandas as pd
 
 from strategies.Strategies import Strategies
 from util import logger
+from util.indicators import EMA
 
 pd.options.mode.chained_assignment = None  # default='warn'
 
 
 class EMARibbon(Strategies):
-    def __init__(self, input_data: dict, ema_fast=5, ema_slow=8, ema_supp=13, observation=100):
+    def __init__(self, input_data: dict, ema_fast=5, ema_slow=8, ema_supp=13, observation=100, incremental=False):
         self.EMA_FAST = ema_fast
         self.EMA_SLOW = ema_slow
         self.EMA_SUPP = ema_supp
         self.OBSERVATION = observation
         self.default_logger = logger.get_logger("ema_ribbon")
 
-        super().__init__(input_data)
+        super().__init__(input_data, incremental, observation)
         self.parse_data()
 
     def parse_data(self, stock_list: list = None, latest_data: pd.DataFrame = None, backtesting: bool = False):
-        # Received New Data => Parse it Now to input_data
+        # Received New Data => Update the indicators incrementally
+        if latest_data is not None and self.incremental:
+            self.update_latest_data(latest_data, backtesting, self.OBSERVATION)
+            return
+        # Received New Data => Append it to the bars (a bar with the same time_key replaces the still-forming bar)
         if latest_data is not None:
-            # Only need to update MACD for the stock_code with new data
-            stock_list = [latest_data['code'][0]]
-
-            # Remove records with duplicate time_key. Always use the latest data to override
-            time_key = latest_data['time_key'][0]
-            self.input_data[stock_list[0]].drop(
-                self.input_data[stock_list[0]][self.input_data[stock_list[0]].time_key == time_key].index,
-                inplace=True)
-            # Append empty columns and concat at the bottom
-            latest_data = pd.concat([latest_data, pd.DataFrame(columns=['EMA_fast', 'EMA_slow', 'EMA_supp'])])
-            self.input_data[stock_list[0]] = pd.concat([self.input_data[stock_list[0]], latest_data])
+            # Only need to update the stock_code with new data
+            stock_list = self.append_latest_data(latest_data, backtesting)
         elif stock_list is not None:
             # Override Updated Stock List
             stock_list = stock_list
         else:
-            stock_list = self.input_data.keys()
+            stock_list = list(self.bars.keys())
 
         # Calculate EMA for the stock_list
         for stock_code in stock_list:
+            bars = self.bars[stock_code]
             # Need to truncate to a maximum length for low-latency
             if not backtesting:
-                self.input_data[stock_code] = self.input_data[stock_code].iloc[
-                                              -min(self.OBSERVATION, self.input_data[stock_code].shape[0]):]
-            self.input_data[stock_code][['open', 'close', 'high', 'low']] = self.input_data[stock_code][
-                ['open', 'close', 'high', 'low']].apply(pd.to_numeric)
-
-            self.input_data[stock_code]['EMA_fast'] = self.input_data[stock_code]['close'].ewm(span=self.EMA_FAST,
-                                                                                               adjust=False).mean()
-            self.input_data[stock_code]['EMA_slow'] = self.input_data[stock_code]['close'].ewm(span=self.EMA_SLOW,
-                                                                                               adjust=False).mean()
-            self.input_data[stock_code]['EMA_supp'] = self.input_data[stock_code]['close'].ewm(span=self.EMA_SUPP,
-                                                                                               adjust=False).mean()
-
-            self.input_data[stock_code].reset_index(drop=True, inplace=True)
+                bars.truncate(self.OBSERVATION)
+            if self.incremental:
+                self.prime_indicators(stock_code)
+                continue
+
+            for column, values in self.calculate_indicators(bars.price_df()).items():
+                bars.set_column(column, values)
+
+    def create_indicators(self):
+        return EMA(self.EMA_FAST), EMA(self.EMA_SLOW), EMA(self.EMA_SUPP)
+
+    def update_indicators(self, indicators: tuple, record: dict, replace: bool) -> dict:
+        ema_fast, ema_slow, ema_supp = indicators
+        return {'EMA_fast': ema_fast.update(record['close'], replace),
+                'EMA_slow': ema_slow.update(record['close'], replace),
+                'EMA_supp': ema_supp.update(record['close'], replace)}
+
+    def calculate_indicators(self, input_df: pd.DataFrame) -> pd.DataFrame:
+        close = input_df['close']
+        return pd.DataFrame({'EMA_fast': close.ewm(span=self.EMA_FAST, adjust=False).mean(),
+                             'EMA_slow': close.ewm(span=self.EMA_SLOW, adjust=False).mean(),
+                             'EMA_supp': close.ewm(span=self.EMA_SUPP, adjust=False).mean()})
+
+    def get_signals(self, input_df: pd.DataFrame) -> pd.DataFrame:
+        output_df = self.calculate_indicators(self.to_numeric_prices(input_df))
+        previous = output_df.shift(1)
+        fast, slow, supp = output_df['EMA_fast'], output_df['EMA_slow'], output_df['EMA_supp']
+        previous_fast, previous_slow, previous_supp = previous['EMA_fast'], previous['EMA_slow'], previous['EMA_supp']
+        # Crossover of EMA Fast with other two EMAs (same rules as buy() / sell(), evaluated on the last bar)
+        output_df['buy'] = ((fast > slow) & (fast > supp)) & ((previous_fast <= previous_slow) |
+                                                              (previous_fast <= previous_supp))
+        output_df['sell'] = ((fast < slow) | (fast < supp)) & ((previous_fast >= previous_slow) &
+                                                               (previous_fast >= previous_supp))
+        # No signal before the third bar, as for the other strategies
+        output_df.loc[output_df.index[:2], ['buy', 'sell']] = False
+        return output_df
 
     def buy(self, stock_code) -> bool:
         # Crossover of EMA Fast with other two EMAs
-        current_record = self.input_data[stock_code].iloc[-1]
-        previous_record = self.input_data[stock_code].iloc[-2]
-        # Buy Decision based on EMA-Fast exceeds both other two EMAs (e.g., 5-bar > 8-bar and 13-bar)
+        current_record = self.bars[stock_code].record(-1)
+        previous_record = self.bars[stock_code].record(-2)
+        # Buy Decision based on EMA-Fast exceeds both other two EMAs (e.g., 5-bar > 8-bar and 13-bar),
+        # while it did not exceed both in the previous bar
         buy_decision = (
                                float(current_record['EMA_fast']) > float(current_record['EMA_slow']) and
                                float(current_record['EMA_fast']) > float(current_record['EMA_supp'])
                        ) and (
-                               float(current_record['EMA_fast']) <= float(current_record['EMA_slow']) or
-                               float(current_record['EMA_fast']) <= float(current_record['EMA_supp'])
+                               float(previous_record['EMA_fast']) <= float(previous_record['EMA_slow']) or
+                               float(previous_record['EMA_fast']) <= float(previous_record['EMA_supp'])
                        )
 
         if buy_decision:
             self.default_logger.info(
-                f"Buy Decision: {current_record['time_key']} based on \n {pd.concat([previous_record.to_frame().transpose(), current_record.to_frame().transpose()], axis=0)}")
+                f"Buy Decision: {current_record['time_key']} based on \n {self.records_to_df(previous_record, current_record)}")
 
         return buy_decision
 
     def sell(self, stock_code) -> bool:
         # Crossover of EMA Fast with other two EMAs
-        current_record = self.input_data[stock_code].iloc[-1]
-        previous_record = self.input_data[stock_code].iloc[-2]
-        # Sell Decision based on EMA-Fast drops below either of the two other EMAs(e.g., 5-bar < 8-bar or 13-bar)
+        current_record = self.bars[stock_code].record(-1)
+        previous_record = self.bars[stock_code].record(-2)
+        # Sell Decision based on EMA-Fast drops below either of the two other EMAs(e.g., 5-bar < 8-bar or 13-bar),
+        # while it was above both in the previous bar
         sell_decision = (
                                 float(current_record['EMA_fast']) < float(current_record['EMA_slow']) or
                                 float(current_record['EMA_fast']) < float(current_record['EMA_supp'])
                         ) and (
-                                float(current_record['EMA_fast']) >= float(current_record['EMA_slow']) and
-                                float(current_record['EMA_fast']) >= float(current_record['EMA_supp'])
+                                float(previous_record['EMA_fast']) >= float(previous_record['EMA_slow']) and
+                                float(previous_record['EMA_fast']) >= float(previous_record['EMA_supp'])
                         )
         if sell_decision:
             self.default_logger.info(
-                f"Sell Decision: {current_record['time_key']} based on \n {pd.concat([previous_record.to_frame().transpose(), current_record.to_frame().transpose()], axis=0)}")
+                f"Sell Decision: {current_record['time_key']} based on \n {self.records_to_df(previous_record, current_record)}")
         return sell_decision
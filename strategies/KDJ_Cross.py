@@ -20,12 +20,14 @@ import pandas as pd
 
 from strategies.Strategies import Strategies
 from util import logger
+from util.indicators import KDJ
 
 pd.options.mode.chained_assignment = None  # default='warn'
 
 
 class KDJCross(Strategies):
-    def __init__(self, input_data: dict, fast_k=9, slow_k=3, slow_d=3, over_buy=80, over_sell=20, observation=100):
+    def __init__(self, input_data: dict, fast_k=9, slow_k=3, slow_d=3, over_buy=80, over_sell=20, observation=100,
+                 incremental=False):
         """
         Initialize KDJ-Cross Strategy Instance
         :param input_data:
@@ -44,51 +46,66 @@ class KDJCross(Strategies):
         self.OBSERVATION = observation
         self.default_logger = logger.get_logger("kdj_cross")
 
-        super().__init__(input_data)
+        super().__init__(input_data, incremental, observation)
         self.parse_data()
 
     def parse_data(self, stock_list: list = None, latest_data: pd.DataFrame = None, backtesting: bool = False):
-        # Received New Data => Parse it Now to input_data
+        # Received New Data => Update the indicators incrementally
+        if latest_data is not None and self.incremental:
+            self.update_latest_data(latest_data, backtesting, self.OBSERVATION)
+            return
+        # Received New Data => Append it to the bars (a bar with the same time_key replaces the still-forming bar)
         if latest_data is not None:
-            # Only need to update MACD for the stock_code with new data
-            stock_list = [latest_data['code'][0]]
-
-            # Remove records with duplicate time_key. Always use the latest data to override
-            time_key = latest_data['time_key'][0]
-            self.input_data[stock_list[0]].drop(
-                self.input_data[stock_list[0]][self.input_data[stock_list[0]].time_key == time_key].index,
-                inplace=True)
-            # Append empty columns and concat at the bottom
-            latest_data = pd.concat([latest_data, pd.DataFrame(columns=['%k', '%d', '%j'])])
-            self.input_data[stock_list[0]] = pd.concat([self.input_data[stock_list[0]], latest_data])
+            # Only need to update the stock_code with new data
+            stock_list = self.append_latest_data(latest_data, backtesting)
         elif stock_list is not None:
             # Override Updated Stock List
             stock_list = stock_list
         else:
-            stock_list = self.input_data.keys()
+            stock_list = list(self.bars.keys())
 
         # Calculate EMA for the stock_list
         for stock_code in stock_list:
+            bars = self.bars[stock_code]
             # Need to truncate to a maximum length for low-latency
             if not backtesting:
-                self.input_data[stock_code] = self.input_data[stock_code].iloc[
-                                              -min(self.OBSERVATION, self.input_data[stock_code].shape[0]):]
-            self.input_data[stock_code][['open', 'close', 'high', 'low']] = self.input_data[stock_code][
-                ['open', 'close', 'high', 'low']].apply(pd.to_numeric)
-
-            low = self.input_data[stock_code]['low'].rolling(self.FAST_K, min_periods=self.FAST_K).min()
-            low.fillna(value=self.input_data[stock_code]['low'].expanding().min(), inplace=True)
-            high = self.input_data[stock_code]['high'].rolling(self.FAST_K, min_periods=self.FAST_K).max()
-            high.fillna(value=self.input_data[stock_code]['high'].expanding().max(), inplace=True)
-            rsv = (self.input_data[stock_code]['close'] - low) / (high - low) * 100
-            # Com = Specify decay in terms of center of mass, α=1/(1+com), for com≥0.
-            # For common KDJ 9-3-3, the com option should be set as 3 - 1 = 2
-            self.input_data[stock_code]['%k'] = pd.DataFrame(rsv).ewm(com=self.SLOW_K - 1).mean()
-            self.input_data[stock_code]['%d'] = self.input_data[stock_code]['%k'].ewm(com=self.SLOW_D - 1).mean()
-            self.input_data[stock_code]['%j'] = 3 * self.input_data[stock_code]['%k'] - \
-                                                2 * self.input_data[stock_code]['%d']
-
-            self.input_data[stock_code].reset_index(drop=True, inplace=True)
+                bars.truncate(self.OBSERVATION)
+            if self.incremental:
+                self.prime_indicators(stock_code)
+                continue
+
+            for column, values in self.calculate_indicators(bars.price_df()).items():
+                bars.set_column(column, values)
+
+    def create_indicators(self):
+        return KDJ(self.FAST_K, self.SLOW_K, self.SLOW_D)
+
+    def update_indicators(self, indicators: KDJ, record: dict, replace: bool) -> dict:
+        k, d, j = indicators.update(record['high'], record['low'], record['close'], replace)
+        return {'%k': k, '%d': d, '%j': j}
+
+    def calculate_indicators(self, input_df: pd.DataFrame) -> pd.DataFrame:
+        low = input_df['low'].rolling(self.FAST_K, min_periods=self.FAST_K).min()
+        low.fillna(value=input_df['low'].expanding().min(), inplace=True)
+        high = input_df['high'].rolling(self.FAST_K, min_periods=self.FAST_K).max()
+        high.fillna(value=input_df['high'].expanding().max(), inplace=True)
+        rsv = (input_df['close'] - low) / (high - low) * 100
+        # Com = Specify decay in terms of center of mass, α=1/(1+com), for com≥0.
+        # For common KDJ 9-3-3, the com option should be set as 3 - 1 = 2
+        k = rsv.ewm(com=self.SLOW_K - 1).mean()
+        d = k.ewm(com=self.SLOW_D - 1).mean()
+        return pd.DataFrame({'%k': k, '%d': d, '%j': 3 * k - 2 * d})
+
+    def get_signals(self, input_df: pd.DataFrame) -> pd.DataFrame:
+        output_df = self.calculate_indicators(self.to_numeric_prices(input_df))
+        current, previous = output_df.shift(1), output_df.shift(2)
+        output_df['buy'] = (self.OVER_SELL > current['%d']) & (current['%d'] > previous['%d']) & \
+                           (previous['%d'] > previous['%k']) & (current['%k'] > previous['%k']) & \
+                           (current['%k'] > current['%d'])
+        output_df['sell'] = (self.OVER_BUY < current['%d']) & (current['%d'] < previous['%d']) & \
+                            (previous['%d'] < previous['%k']) & (current['%k'] < previous['%k']) & \
+                            (current['%k'] < current['%d'])
+        return output_df
 
     def buy(self, stock_code) -> bool:
 
@@ -100,7 +117,7 @@ class KDJCross(Strategies):
 
         if buy_decision:
             self.default_logger.info(
-                f"Buy Decision: {current_record['time_key']} based on \n {pd.concat([previous_record.to_frame().transpose(), current_record.to_frame().transpose()], axis=0)}")
+                f"Buy Decision: {current_record['time_key']} based on \n {self.records_to_df(previous_record, current_record)}")
 
         return buy_decision
 
@@ -114,5 +131,5 @@ class KDJCross(Strategies):
 
         if sell_decision:
             self.default_logger.info(
-                f"Sell Decision: {current_record['time_key']} based on \n {pd.concat([previous_record.to_frame().transpose(), current_record.to_frame().transpose()], axis=0)}")
+                f"Sell Decision: {current_record['time_key']} based on \n {self.records_to_df(previous_record, current_record)}")
         return sell_decision
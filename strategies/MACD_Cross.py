@@ -20,61 +20,75 @@ import pandas as pd
 
 from strategies.Strategies import Strategies
 from util import logger
+from util.indicators import MACD
 
 pd.options.mode.chained_assignment = None  # default='warn'
 
 
 class MACDCross(Strategies):
-    def __init__(self, input_data: dict, fast_period=12, slow_period=26, signal_period=9, observation=100):
+    def __init__(self, input_data: dict, fast_period=12, slow_period=26, signal_period=9, observation=100,
+                 incremental=False):
         self.MACD_FAST = fast_period
         self.MACD_SLOW = slow_period
         self.MACD_SIGNAL = signal_period
         self.OBSERVATION = observation
         self.default_logger = logger.get_logger("macd_cross")
 
-        super().__init__(input_data)
+        super().__init__(input_data, incremental, observation)
         self.parse_data()
 
     def parse_data(self, stock_list: list = None, latest_data: pd.DataFrame = None, backtesting: bool = False):
-        # Received New Data => Parse it Now to input_data
+        # Received New Data => Update the indicators incrementally
+        if latest_data is not None and self.incremental:
+            self.update_latest_data(latest_data, backtesting, self.OBSERVATION)
+            return
+        # Received New Data => Append it to the bars (a bar with the same time_key replaces the still-forming bar)
         if latest_data is not None:
-            # Only need to update MACD for the stock_code with new data
-            stock_list = [latest_data['code'][0]]
-
-            # Remove records with duplicate time_key. Always use the latest data to override
-            time_key = latest_data['time_key'][0]
-            self.input_data[stock_list[0]].drop(
-                self.input_data[stock_list[0]][self.input_data[stock_list[0]].time_key == time_key].index,
-                inplace=True)
-            # Append empty columns and concat at the bottom
-            latest_data = pd.concat([latest_data, pd.DataFrame(columns=['MACD', 'MACD_signal', 'MACD_hist'])])
-            self.input_data[stock_list[0]] = pd.concat([self.input_data[stock_list[0]], latest_data])
+            # Only need to update the stock_code with new data
+            stock_list = self.append_latest_data(latest_data, backtesting)
         elif stock_list is not None:
             # Override Updated Stock List
             stock_list = stock_list
         else:
-            stock_list = self.input_data.keys()
+            stock_list = list(self.bars.keys())
 
         # Calculate MACD for the stock_list
         for stock_code in stock_list:
+            bars = self.bars[stock_code]
             # Need to truncate to a maximum length for low-latency
             if not backtesting:
-                self.input_data[stock_code] = self.input_data[stock_code].iloc[
-                                              -min(self.OBSERVATION, self.input_data[stock_code].shape[0]):]
-            self.input_data[stock_code][['open', 'close', 'high', 'low']] = self.input_data[stock_code][
-                ['open', 'close', 'high', 'low']].apply(pd.to_numeric)
-
-            # MACD = EMA-Fast - EMA-Slow. Signal = EMA(MACD, Smooth-period)
-            ema_fast = self.input_data[stock_code]['close'].ewm(span=self.MACD_FAST, adjust=False).mean()
-            ema_slow = self.input_data[stock_code]['close'].ewm(span=self.MACD_SLOW, adjust=False).mean()
-            self.input_data[stock_code]['MACD'] = ema_fast - ema_slow
-            self.input_data[stock_code]['MACD_signal'] = self.input_data[stock_code]['MACD'].ewm(span=self.MACD_SIGNAL,
-                                                                                                 adjust=False).mean()
-            # MACD_hist = (MACD - MACD_signal) * 2
-            self.input_data[stock_code]['MACD_hist'] = (self.input_data[stock_code]['MACD'] -
-                                                        self.input_data[stock_code]['MACD_signal']) * 2
-
-            self.input_data[stock_code].reset_index(drop=True, inplace=True)
+                bars.truncate(self.OBSERVATION)
+            if self.incremental:
+                self.prime_indicators(stock_code)
+                continue
+
+            for column, values in self.calculate_indicators(bars.price_df()).items():
+                bars.set_column(column, values)
+
+    def create_indicators(self):
+        return MACD(self.MACD_FAST, self.MACD_SLOW, self.MACD_SIGNAL)
+
+    def update_indicators(self, indicators: MACD, record: dict, replace: bool) -> dict:
+        macd, macd_signal, macd_hist = indicators.update(record['close'], replace)
+        # MACD_hist = (MACD - MACD_signal) * 2
+        return {'MACD': macd, 'MACD_signal': macd_signal, 'MACD_hist': macd_hist * 2}
+
+    def calculate_indicators(self, input_df: pd.DataFrame) -> pd.DataFrame:
+        """
+        MACD = EMA-Fast - EMA-Slow. Signal = EMA(MACD, Smooth-period). MACD_hist = (MACD - MACD_signal) * 2
+        """
+        close = input_df['close']
+        macd = close.ewm(span=self.MACD_FAST, adjust=False).mean() - close.ewm(span=self.MACD_SLOW, adjust=False).mean()
+        macd_signal = macd.ewm(span=self.MACD_SIGNAL, adjust=False).mean()
+        return pd.DataFrame({'MACD': macd, 'MACD_signal': macd_signal, 'MACD_hist': (macd - macd_signal) * 2})
+
+    def get_signals(self, input_df: pd.DataFrame) -> pd.DataFrame:
+        output_df = self.calculate_indicators(self.to_numeric_prices(input_df))
+        current, previous = output_df.shift(1), output_df.shift(2)
+        # Crossover between MACD and Signal (Single Point Determined)
+        output_df['buy'] = (current['MACD'] > current['MACD_signal']) & (previous['MACD'] <= previous['MACD_signal'])
+        output_df['sell'] = (current['MACD'] < current['MACD_signal']) & (previous['MACD'] >= previous['MACD_signal'])
+        return output_df
 
     # @timeit
     def buy(self, stock_code) -> bool:
@@ -84,7 +98,7 @@ class MACDCross(Strategies):
             previous_record['MACD']) <= float(previous_record['MACD_signal'])
         if buy_decision:
             self.default_logger.info(
-                f"Buy Decision: {current_record['time_key']} based on \n {pd.concat([previous_record.to_frame().transpose(), current_record.to_frame().transpose()], axis=0)}")
+                f"Buy Decision: {current_record['time_key']} based on \n {self.records_to_df(previous_record, current_record)}")
 
         return buy_decision
 
@@ -96,6 +110,6 @@ class MACDCross(Strategies):
             previous_record['MACD']) >= float(previous_record['MACD_signal'])
         if sell_decision:
             self.default_logger.info(
-                f"Sell Decision: {current_record['time_key']} based on \n {pd.concat([previous_record.to_frame().transpose(), current_record.to_frame().transpose()], axis=0)}")
+                f"Sell Decision: {current_record['time_key']} based on \n {self.records_to_df(previous_record, current_record)}")
 
         return sell_decision
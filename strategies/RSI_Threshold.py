@@ -20,12 +20,14 @@ import pandas as pd
 
 from strategies.Strategies import Strategies
 from util import logger
+from util.indicators import RSI
 
 pd.options.mode.chained_assignment = None  # default='warn'
 
 
 class RSIThreshold(Strategies):
-    def __init__(self, input_data: dict, rsi_1=6, rsi_2=12, rsi_3=24, lower_rsi=30, upper_rsi=70, observation=100):
+    def __init__(self, input_data: dict, rsi_1=6, rsi_2=12, rsi_3=24, lower_rsi=30, upper_rsi=70, observation=100,
+                 incremental=False):
         """
         Initialize RSI-Threshold Strategy Instance
         :param input_data:
@@ -44,11 +46,12 @@ class RSIThreshold(Strategies):
         self.OBSERVATION = observation
         self.default_logger = logger.get_logger("rsi_threshold")
 
-        super().__init__(input_data)
+        super().__init__(input_data, incremental, observation)
         self.parse_data()
 
-    def __compute_RSI(self, stock_code, time_window):
-        diff = self.input_data[stock_code]['close'].diff(1).dropna()  # diff in one field(one day)
+    @staticmethod
+    def __compute_RSI(close: pd.Series, time_window: int) -> pd.Series:
+        diff = close.diff(1).dropna()  # diff in one field(one day)
 
         # this preservers dimensions off diff values
         up_chg = 0 * diff
@@ -69,42 +72,57 @@ class RSIThreshold(Strategies):
 
         rs = abs(up_chg_avg / down_chg_avg)
         rsi = 100 - 100 / (1 + rs)
-        return rsi
+        return rsi.reindex(close.index)
 
     def parse_data(self, stock_list: list = None, latest_data: pd.DataFrame = None, backtesting: bool = False):
-        # Received New Data => Parse it Now to input_data
+        # Received New Data => Update the indicators incrementally
+        if latest_data is not None and self.incremental:
+            self.update_latest_data(latest_data, backtesting, self.OBSERVATION)
+            return
+        # Received New Data => Append it to the bars (a bar with the same time_key replaces the still-forming bar)
         if latest_data is not None:
-            # Only need to update MACD for the stock_code with new data
-            stock_list = [latest_data['code'][0]]
-
-            # Remove records with duplicate time_key. Always use the latest data to override
-            time_key = latest_data['time_key'][0]
-            self.input_data[stock_list[0]].drop(
-                self.input_data[stock_list[0]][self.input_data[stock_list[0]].time_key == time_key].index,
-                inplace=True)
-            # Append empty columns and concat at the bottom
-            latest_data = pd.concat([latest_data, pd.DataFrame(columns=['rsi_1', 'rsi_2', 'rsi_3'])])
-            self.input_data[stock_list[0]] = pd.concat([self.input_data[stock_list[0]], latest_data])
+            # Only need to update the stock_code with new data
+            stock_list = self.append_latest_data(latest_data, backtesting)
         elif stock_list is not None:
             # Override Updated Stock List
             stock_list = stock_list
         else:
-            stock_list = self.input_data.keys()
+            stock_list = list(self.bars.keys())
 
         # Calculate EMA for the stock_list
         for stock_code in stock_list:
+            bars = self.bars[stock_code]
             # Need to truncate to a maximum length for low-latency
             if not backtesting:
-                self.input_data[stock_code] = self.input_data[stock_code].iloc[
-                                              -min(self.OBSERVATION, self.input_data[stock_code].shape[0]):]
-            self.input_data[stock_code][['open', 'close', 'high', 'low']] = self.input_data[stock_code][
-                ['open', 'close', 'high', 'low']].apply(pd.to_numeric)
-
-            self.input_data[stock_code]['rsi_1'] = self.__compute_RSI(stock_code=stock_code, time_window=self.RSI_1)
-            self.input_data[stock_code]['rsi_2'] = self.__compute_RSI(stock_code=stock_code, time_window=self.RSI_2)
-            self.input_data[stock_code]['rsi_3'] = self.__compute_RSI(stock_code=stock_code, time_window=self.RSI_3)
-
-            self.input_data[stock_code].reset_index(drop=True, inplace=True)
+                bars.truncate(self.OBSERVATION)
+            if self.incremental:
+                self.prime_indicators(stock_code)
+                continue
+
+            for column, values in self.calculate_indicators(bars.price_df()).items():
+                bars.set_column(column, values)
+
+    def create_indicators(self):
+        return RSI(self.RSI_1), RSI(self.RSI_2), RSI(self.RSI_3)
+
+    def update_indicators(self, indicators: tuple, record: dict, replace: bool) -> dict:
+        rsi_1, rsi_2, rsi_3 = indicators
+        return {'rsi_1': rsi_1.update(record['close'], replace),
+                'rsi_2': rsi_2.update(record['close'], replace),
+                'rsi_3': rsi_3.update(record['close'], replace)}
+
+    def calculate_indicators(self, input_df: pd.DataFrame) -> pd.DataFrame:
+        close = input_df['close']
+        return pd.DataFrame({'rsi_1': self.__compute_RSI(close, time_window=self.RSI_1),
+                             'rsi_2': self.__compute_RSI(close, time_window=self.RSI_2),
+                             'rsi_3': self.__compute_RSI(close, time_window=self.RSI_3)})
+
+    def get_signals(self, input_df: pd.DataFrame) -> pd.DataFrame:
+        output_df = self.calculate_indicators(self.to_numeric_prices(input_df))
+        current, previous = output_df['rsi_1'].shift(1), output_df['rsi_1'].shift(2)
+        output_df['buy'] = (current < self.LOWER_RSI) & (self.LOWER_RSI < previous)
+        output_df['sell'] = (current > self.UPPER_RSI) & (self.UPPER_RSI > previous)
+        return output_df
 
     def buy(self, stock_code) -> bool:
         current_record, previous_record = self.get_current_and_previous_record(stock_code)
@@ -113,7 +131,7 @@ class RSIThreshold(Strategies):
 
         if buy_decision:
             self.default_logger.info(
-                f"Buy Decision: {current_record['time_key']} based on \n {pd.concat([previous_record.to_frame().transpose(), current_record.to_frame().transpose()], axis=0)}")
+                f"Buy Decision: {current_record['time_key']} based on \n {self.records_to_df(previous_record, current_record)}")
 
         return buy_decision
 
@@ -124,5 +142,5 @@ class RSIThreshold(Strategies):
 
         if sell_decision:
             self.default_logger.info(
-                f"Sell Decision: {current_record['time_key']} based on \n {pd.concat([previous_record.to_frame().transpose(), current_record.to_frame().transpose()], axis=0)}")
+                f"Sell Decision: {current_record['time_key']} based on \n {self.records_to_df(previous_record, current_record)}")
         return sell_decision
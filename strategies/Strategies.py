@@ -20,10 +20,27 @@ from abc import ABC, abstractmethod
 
 import pandas as pd
 
+from util.bar_buffer import BarBuffer, BarRecord
+
 
 class Strategies(ABC):
-    def __init__(self, input_data: dict):
-        self.input_data = input_data
+    # K-line columns read by the strategies (other columns are not loaded for backtesting)
+    REQUIRED_COLUMNS = ['code', 'time_key', 'open', 'close', 'high', 'low', 'volume']
+
+    def __init__(self, input_data: dict, incremental: bool = False, observation: int = 100):
+        """
+        :param input_data: K-line Dataframe of each stock
+        :param incremental: Update the technical indicators incrementally (O(1) per new bar, see util.indicators)
+                            instead of recalculating them over the whole observation window
+        :param observation: Observation window (capacity of the bar buffer of each stock)
+        """
+        self.incremental = incremental
+        self.observation = observation
+        # Bars & indicator outputs of each stock (see util.bar_buffer)
+        self.bars = {}
+        # Incremental indicators of each stock
+        self.indicators = {}
+        self.set_input_data(input_data)
         super().__init__()
 
     @abstractmethod
@@ -46,17 +63,132 @@ class Strategies(ABC):
     def sell(self, stock_code) -> bool:
         pass
 
+    def calculate_indicators(self, input_df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Technical indicators over all bars of a K-line Dataframe (vectorized)
+        :return: Dataframe of the indicator columns aligned with input_df
+        """
+        raise NotImplementedError(f'{type(self).__name__} does not support vectorized indicators')
+
+    def get_signals(self, input_df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Vectorized entry point for a whole history (e.g., backtesting), instead of calling buy() / sell() bar by bar
+        :param input_df: K-line Dataframe of one stock (ordered by time_key)
+        :return: Indicator columns with boolean buy / sell columns aligned with input_df. Row t is the decision of
+                 buy() / sell() with bar t as the last bar
+        """
+        raise NotImplementedError(f'{type(self).__name__} does not support vectorized signals')
+
+    def create_indicators(self):
+        """
+        Incremental indicators of a stock (see util.indicators). Required by the incremental mode
+        """
+        raise NotImplementedError(f'{type(self).__name__} does not support incremental indicators')
+
+    def update_indicators(self, indicators, record: dict, replace: bool) -> dict:
+        """
+        Update the incremental indicators of a stock with a new bar. Required by the incremental mode
+        :param indicators: Incremental indicators of the stock (from create_indicators)
+        :param record: New bar (e.g., {'time_key': '2022-04-13 09:31:00', 'open': 100.0, ...})
+        :param replace: True if the bar replaces the last bar (same time_key)
+        :return: Indicator values of the bar (e.g., {'MACD': 0.01, 'MACD_signal': -0.02, 'MACD_hist': 0.06})
+        """
+        raise NotImplementedError(f'{type(self).__name__} does not support incremental indicators')
+
+    def get_bars(self, stock_code: str) -> BarBuffer:
+        if stock_code not in self.bars:
+            self.bars[stock_code] = BarBuffer(self.observation, stock_code)
+        return self.bars[stock_code]
+
+    def prime_indicators(self, stock_code: str) -> None:
+        """
+        Build the incremental indicators of a stock from its bars, and write the indicator columns
+        """
+        bars = self.get_bars(stock_code)
+        indicators = self.indicators[stock_code] = self.create_indicators()
+        columns = ['time_key'] + BarBuffer.PRICE_COLUMNS
+        output_df = pd.DataFrame([self.update_indicators(indicators, dict(zip(columns, values)), False) for values in
+                                  zip(*[bars.window(column) for column in columns])])
+        for column in output_df.columns:
+            bars.set_column(column, output_df[column])
+
+    def update_latest_data(self, latest_data: pd.DataFrame, backtesting: bool = False,
+                           observation: int = None) -> None:
+        """
+        Append new bars with incrementally updated indicators. A bar with the same time_key as the last bar (i.e., the
+        still-forming bar of a subscription) replaces it
+        :param latest_data: New bars (ordered by time_key)
+        :param backtesting: Keep all bars (Otherwise, truncated to the observation window)
+        :param observation: Observation window
+        """
+        for record in latest_data.to_dict('records'):
+            stock_code = record['code']
+            if stock_code not in self.indicators:
+                self.prime_indicators(stock_code)
+            bars = self.bars[stock_code]
+            for column in BarBuffer.PRICE_COLUMNS:
+                record[column] = float(record[column])
+            replace = bars.update(record, grow=backtesting)
+            for column, value in self.update_indicators(self.indicators[stock_code], record, replace).items():
+                bars.set(column, value)
+            if not backtesting and observation is not None:
+                bars.truncate(observation)
+
+    def append_latest_data(self, latest_data: pd.DataFrame, backtesting: bool = False) -> list:
+        """
+        Append new bars (without indicators). A bar with the same time_key as the last bar replaces it
+        :return: Stock List with new bars
+        """
+        stock_list = []
+        for stock_code, stock_df in latest_data.groupby('code', sort=False):
+            self.get_bars(stock_code).extend(stock_df, grow=backtesting)
+            stock_list.append(stock_code)
+        return stock_list
+
+    @staticmethod
+    def to_numeric_prices(input_df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Convert the OHLC columns to numeric. Typed K-line data (e.g., loaded from Parquet) is returned as it is.
+        :param input_df: K-line Dataframe
+        :return: K-line Dataframe with numeric OHLC columns
+        """
+        columns = [column for column in ['open', 'close', 'high', 'low'] if
+                   not pd.api.types.is_numeric_dtype(input_df[column])]
+        if columns:
+            input_df = input_df.copy()
+            input_df[columns] = input_df[columns].apply(pd.to_numeric)
+        return input_df
+
     def get_current_and_previous_record(self, stock_code: str) -> tuple:
-        return self.input_data[stock_code].iloc[-2], self.input_data[stock_code].iloc[-3]
+        """
+        Scalar accessors of the last completed bar and the bar before it (the last bar may still be forming)
+        """
+        return self.bars[stock_code].record(-2), self.bars[stock_code].record(-3)
+
+    @staticmethod
+    def records_to_df(*records: BarRecord) -> pd.DataFrame:
+        return pd.DataFrame([record.to_dict() for record in records])
+
+    @property
+    def input_data(self) -> dict:
+        """
+        K-line Dataframe (with the indicator columns) of each stock, exported from the bar buffers
+        """
+        return self.get_input_data()
 
     def get_input_data(self) -> dict:
-        return self.input_data.copy()
+        return {stock_code: bars.to_df() for stock_code, bars in self.bars.items()}
 
     def get_input_data_stock_code(self, stock_code: str) -> pd.DataFrame:
-        return self.input_data[stock_code].copy()
+        return self.bars[stock_code].to_df()
 
     def set_input_data(self, input_data: dict) -> None:
-        self.input_data = input_data.copy()
+        self.bars = {}
+        self.indicators.clear()
+        for stock_code, input_df in input_data.items():
+            self.set_input_data_stock_code(stock_code, input_df)
 
     def set_input_data_stock_code(self, stock_code: str, input_df: pd.DataFrame) -> None:
-        self.input_data[stock_code] = input_df.copy()
+        self.bars[stock_code] = BarBuffer.from_df(input_df, self.observation)
+        self.bars[stock_code].code = stock_code
+        self.indicators.pop(stock_code, None)
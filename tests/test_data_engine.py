@@ -15,12 +15,40 @@
 #  Written by Bill Chan <billpwchan@hotmail.com>, 2022
 #  Copyright (c)  billpwchan - All Rights Reserved
 import datetime
+import json
+import shutil
+import tempfile
+import time
 import unittest
 from pathlib import Path
+from types import SimpleNamespace
 
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import yfinance as yf
 
-from engines import DataProcessingInterface, YahooFinanceInterface
+from engines import BarCache, DataCatalog, DataFrameCache, DataProcessingInterface, DownloadScheduler, \
+    FundamentalsStore, HKEXInterface, KLineSchema, PartitionedDataStore, SecurityMaster, StockFilter, TokenBucket, \
+    TradeLedger, TuShareInterface, YahooFinanceInterface, YahooHistoryCache
+
+
+def get_ticker_factory(requests: list, get_symbol_modules, not_found_symbol: str):
+    """
+        Stand-in for yahooquery.Ticker. Every get_modules call is recorded in requests as (symbols, modules), and
+        not_found_symbol is returned as an error message like Yahoo Finance does for symbols without data
+    """
+
+    def ticker_factory(symbols, **kwargs):
+        def get_modules(modules):
+            requests.append((tuple(symbols), tuple(modules)))
+            return {symbol: f'Quote not found for ticker symbol: {symbol}' if symbol == not_found_symbol else
+                    get_symbol_modules(symbol) for symbol in symbols}
+
+        return SimpleNamespace(get_modules=get_modules)
+
+    return ticker_factory
 
 
 class TestYahooFinanceInterface(unittest.TestCase):
@@ -58,9 +86,194 @@ class TestDataProcessingInterface(unittest.TestCase):
         self.assertIsInstance(output_dict, dict)
         self.assertCountEqual(output_dict.keys(), stock_list)
 
+    def test_save_1M_data_by_day(self):
+        date_range = ['2022-04-11', '2022-04-12', '2022-04-13']
+        history_df = DataProcessingInterface.get_1M_data_range(date_range, ['HK.09988'])['HK.09988']
+        data_root = Path(tempfile.mkdtemp())
+        try:
+            output_paths = DataProcessingInterface.save_1M_data_by_day('HK.09988', history_df, root=data_root)
+            self.assertListEqual([output_path.name for output_path in output_paths],
+                                 [f'HK.09988_{input_date}_1M.parquet' for input_date in date_range])
+            for input_date, output_path in zip(date_range, output_paths):
+                pd.testing.assert_frame_equal(
+                    DataProcessingInterface.get_stock_df_from_file(output_path),
+                    DataProcessingInterface.get_stock_df_from_file(
+                        Path.cwd() / 'data' / 'HK.09988' / f'HK.09988_{input_date}_1M.parquet'))
+        finally:
+            shutil.rmtree(data_root)
+
+    def test_scan_data_files(self):
+        data_root = Path(tempfile.mkdtemp())
+        try:
+            shutil.copytree(Path.cwd() / 'data' / 'HK.09988', data_root / 'HK.09988')
+            input_paths = sorted((data_root / 'HK.09988').glob('*_1M.parquet'))
+            # Truncated, empty and out-of-range (data of 2022-04-13 stored as 2022-04-14) files
+            input_paths[0].write_bytes(input_paths[0].read_bytes()[:-100])
+            empty_df = DataProcessingInterface.get_stock_df_from_file(input_paths[1]).iloc[:0]
+            pq.write_table(KLineSchema.to_table(empty_df), input_paths[1])
+            input_paths.append(input_paths[2].with_name('HK.09988_2022-04-14_1M.parquet'))
+            shutil.copy(input_paths[2], input_paths[3])
+
+            output_df = DataProcessingInterface.scan_data_files(input_paths, action='delete',
+                                                                statuses=['empty', 'truncated'],
+                                                                report_path=data_root / 'report.csv')
+            self.assertListEqual(output_df['status'].tolist(), ['truncated', 'empty', 'ok', 'out_of_range'])
+            self.assertListEqual(output_df['action'].tolist(), ['deleted', 'deleted', '', ''])
+            self.assertListEqual([input_path.is_file() for input_path in input_paths], [False, False, True, True])
+            self.assertEqual(output_df.loc[2, 'num_rows'], 331)
+            self.assertEqual(output_df.loc[2, 'start_time'][:10], '2022-04-13')
+            self.assertEqual(len(pd.read_csv(data_root / 'report.csv')), 4)
+        finally:
+            shutil.rmtree(data_root)
+
+    def test_validate_1M_data(self):
+        date_range = ['2022-04-11', '2022-04-12', '2022-04-13']
+        data_root = Path(tempfile.mkdtemp())
+        try:
+            output_df = DataProcessingInterface.validate_1M_data(date_range, ['HK.09988'],
+                                                                 trading_days=date_range + ['2022-04-14'],
+                                                                 output_path=data_root / 'report.parquet')
+            pd.testing.assert_frame_equal(output_df, pd.read_parquet(data_root / 'report.parquet'))
+        finally:
+            shutil.rmtree(data_root)
+        self.assertListEqual(output_df['date'].tolist(), date_range + ['2022-04-14'])
+        self.assertListEqual(output_df['num_rows'].tolist(), [331, 331, 331, 0])
+        self.assertListEqual(output_df['missing_minutes'].tolist(), [0, 0, 0, 331])
+        self.assertListEqual(output_df['is_valid'].tolist(), [True, True, True, False])
+
+        input_df = DataProcessingInterface.get_1M_data_range(date_range[:1], ['HK.09988'],
+                                                             parse_dates=True)['HK.09988']
+        # Missing minutes, a duplicate, swapped records, an inconsistent bar and a zero-volume gap
+        input_df = input_df.drop(index=[10, 11]).reset_index(drop=True)
+        input_df = pd.concat([input_df, input_df.iloc[[20]]], ignore_index=True)
+        input_df.iloc[[30, 31]] = input_df.iloc[[31, 30]].to_numpy()
+        input_df.loc[40, 'high'] = input_df.loc[40, 'low'] - 1
+        input_df.loc[50:54, 'volume'] = 0
+        output_df = DataProcessingInterface.get_1M_data_quality(input_df)
+        self.assertDictEqual(output_df.drop(columns=['code', 'date']).iloc[0].to_dict(),
+                             {'num_rows': 330, 'missing_minutes': 2, 'off_session_rows': 0, 'duplicates': 1,
+                              'non_monotonic': 2, 'ohlc_errors': 1, 'zero_volume': 5, 'max_zero_volume_run': 5,
+                              'is_valid': False})
+
+        # Half trading day (morning session only) & zero-volume threshold
+        input_df = DataProcessingInterface.get_1M_data_range(date_range[:1], ['HK.09988'],
+                                                             parse_dates=True)['HK.09988']
+        input_df = input_df[input_df['time_key'].dt.hour < 13].reset_index(drop=True)
+        self.assertFalse(DataProcessingInterface.get_1M_data_quality(input_df).loc[0, 'is_valid'])
+        output_df = DataProcessingInterface.get_1M_data_quality(input_df, half_days=date_range[:1])
+        self.assertEqual(output_df.loc[0, 'missing_minutes'], 0)
+        self.assertTrue(output_df.loc[0, 'is_valid'])
+        self.assertListEqual(DataProcessingInterface.get_half_days(['2021-12-23', '2021-12-24', '2021-12-31']),
+                             ['2021-12-24', '2021-12-31'])
+        input_df.loc[50:54, 'volume'] = 0
+        self.assertTrue(DataProcessingInterface.get_1M_data_quality(input_df, half_days=date_range[:1],
+                                                                    max_zero_volume_run=5).loc[0, 'is_valid'])
+        self.assertFalse(DataProcessingInterface.get_1M_data_quality(input_df, half_days=date_range[:1],
+                                                                     max_zero_volume_run=4).loc[0, 'is_valid'])
+
+    def test_get_1D_data_dict(self):
+        stock_list = ['HK.09988', 'HK.00700', 'HK.99999']
+        output_dict = DataProcessingInterface.get_1D_data_dict(stock_list, start_date='2021-06-01')
+        self.assertListEqual(list(output_dict), stock_list)
+        self.assertTrue(output_dict['HK.99999'].empty)
+        input_df = DataProcessingInterface.get_stock_df_from_file(
+            Path.cwd() / 'data' / 'HK.09988' / 'HK.09988_2021_1D.parquet', parse_dates=True)
+        pd.testing.assert_frame_equal(output_dict['HK.09988'],
+                                      input_df[input_df['time_key'] >= '2021-06-01'].reset_index(drop=True))
+        self.assertTrue(DataProcessingInterface.get_1D_data_dict(stock_list, end_date='2020-12-31')['HK.09988'].empty)
+
+    def test_get_missing_date_ranges(self):
+        trading_days = ['2022-04-08', '2022-04-11', '2022-04-12', '2022-04-13', '2022-04-14', '2022-04-19']
+        self.assertListEqual(DataProcessingInterface.get_1M_trading_dates('HK.09988'),
+                             ['2022-04-11', '2022-04-12', '2022-04-13'])
+        self.assertListEqual(DataProcessingInterface.get_missing_date_ranges(
+            trading_days, set(DataProcessingInterface.get_1M_trading_dates('HK.09988'))),
+            [('2022-04-08', '2022-04-08'), ('2022-04-14', '2022-04-19')])
+        self.assertListEqual(DataProcessingInterface.get_missing_date_ranges(trading_days, {'2022-04-12'}),
+                             [('2022-04-08', '2022-04-11'), ('2022-04-13', '2022-04-19')])
+        self.assertListEqual(DataProcessingInterface.get_missing_date_ranges(trading_days, set(trading_days)), [])
+
+        # Days recorded as empty (e.g., suspension) are not requested again
+        temp_dir = Path(tempfile.mkdtemp())
+        try:
+            self.assertSetEqual(DataProcessingInterface.get_empty_1M_dates('HK.09988', temp_dir), set())
+            DataProcessingInterface.add_empty_1M_dates('HK.09988', ['2022-04-14'], temp_dir)
+            DataProcessingInterface.add_empty_1M_dates('HK.09988', ['2022-04-08', '2022-04-14'], temp_dir)
+            empty_dates = DataProcessingInterface.get_empty_1M_dates('HK.09988', temp_dir)
+            self.assertSetEqual(empty_dates, {'2022-04-08', '2022-04-14'})
+            self.assertListEqual(DataProcessingInterface.get_missing_date_ranges(
+                trading_days, {'2022-04-11', '2022-04-12', '2022-04-13'} | empty_dates),
+                [('2022-04-19', '2022-04-19')])
+
+            # Checks expire after the retry window, so that the days are requested again
+            DataProcessingInterface.add_empty_1M_dates('HK.09988', ['2022-04-19'], temp_dir,
+                                                       checked_at='2022-04-20T16:30:00')
+            self.assertNotIn('2022-04-19', DataProcessingInterface.get_empty_1M_dates('HK.09988', temp_dir))
+            self.assertIn('2022-04-19', DataProcessingInterface.get_empty_1M_dates('HK.09988', temp_dir,
+                                                                                   retry_days=365 * 100))
+            self.assertEqual(DataProcessingInterface.read_empty_1M_dates('HK.09988', temp_dir)['2022-04-19'],
+                             '2022-04-20T16:30:00')
+
+            # Days recorded without a check time (older format) are requested again
+            with open(temp_dir / 'HK.09988' / 'HK.09988_empty_1M.json', 'w') as output_file:
+                json.dump(['2022-04-08'], output_file)
+            self.assertSetEqual(DataProcessingInterface.get_empty_1M_dates('HK.09988', temp_dir), set())
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    def test_get_1M_data_range_parallel(self):
+        date_range = ['2022-04-11', '2022-04-12', '2022-04-13']
+        stock_list = ['HK.09988', 'HK.00700']
+        serial_dict = DataProcessingInterface.get_1M_data_range(date_range, stock_list, max_workers=1)
+        parallel_dict = DataProcessingInterface.get_1M_data_range(date_range, stock_list, max_workers=4)
+        for stock_code in stock_list:
+            pd.testing.assert_frame_equal(parallel_dict[stock_code], serial_dict[stock_code])
+
+        output_df = DataProcessingInterface.get_1M_data_range(date_range, stock_list, columns=['close'],
+                                                              combined=True)
+        self.assertListEqual(output_df.index.names, ['code', 'time_key'])
+        self.assertTrue(output_df.index.is_unique)
+        self.assertListEqual(output_df.loc['HK.00700', 'close'].tolist(), serial_dict['HK.00700']['close'].tolist())
+
+    def test_get_1M_data_range_pushdown(self):
+        date_range = ['2022-04-11', '2022-04-12', '2022-04-13']
+        stock_list = ['HK.09988']
+        full_df = DataProcessingInterface.get_1M_data_range(date_range, stock_list)[stock_list[0]]
+        output_df = DataProcessingInterface.get_1M_data_range(date_range, stock_list, columns=['close', 'volume'],
+                                                              start_time='2022-04-11 15:30:00',
+                                                              end_time='2022-04-12 10:00:00')[stock_list[0]]
+        self.assertCountEqual(output_df.columns, ['close', 'volume', 'time_key'])
+        self.assertEqual(output_df['time_key'].min(), '2022-04-11 15:30:00')
+        self.assertEqual(output_df['time_key'].max(), '2022-04-12 10:00:00')
+        reference_df = full_df[(full_df['time_key'] >= '2022-04-11 15:30:00') &
+                               (full_df['time_key'] <= '2022-04-12 10:00:00')]
+        self.assertListEqual(output_df['close'].tolist(), reference_df['close'].tolist())
+
+        # A time range cannot be applied to files without time_key
+        temp_dir = Path(tempfile.mkdtemp())
+        try:
+            pd.DataFrame({'close': [1.0]}).to_parquet(temp_dir / 'no_time_key.parquet')
+            with self.assertRaises(ValueError):
+                DataProcessingInterface.get_stock_df_from_file(temp_dir / 'no_time_key.parquet',
+                                                               start_time='2022-04-11')
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    def test_get_custom_interval_data_pushdown(self):
+        date_range = ['2022-04-11', '2022-04-12']
+        stock_list = ['HK.09988']
+        columns = ['time_key', 'close', 'change_rate']
+        full_df = DataProcessingInterface.get_custom_interval_data_range(date_range, 15, stock_list)[stock_list[0]]
+        output_df = DataProcessingInterface.get_custom_interval_data_range(
+            date_range, 15, stock_list, columns=columns, start_time='2022-04-11 14:00:00',
+            end_time=datetime.datetime(2022, 4, 12, 11, 0))[stock_list[0]]
+        reference_df = full_df[(full_df['time_key'] >= '2022-04-11 14:00:00') &
+                               (full_df['time_key'] <= '2022-04-12 11:00:00')].reset_index(drop=True)
+        pd.testing.assert_frame_equal(output_df[columns], reference_df[columns])
+
     def test_get_custom_interval_data(self):
         target_date = datetime.datetime(2022, 4, 11)
-        custom_intervals = [3, 5, 15, 30]
+        custom_intervals = [3, 5, 15, 30, 60]
         stock_list = ['HK.09988']
         for custom_interval in custom_intervals:
             output_df = DataProcessingInterface.get_custom_interval_data(target_date, custom_interval, stock_list)[
@@ -87,6 +300,22 @@ class TestDataProcessingInterface(unittest.TestCase):
                 self.assertAlmostEqual(row['last_close'], reference_df.loc[index, 'last_close'], places=2,
                                        msg=f"{index} last_close")
 
+    def test_resample_custom_interval(self):
+        date_range = ['2022-04-11', '2022-04-12', '2022-04-13']
+        stock_list = ['HK.09988', 'HK.00700']
+        input_df = pd.concat(DataProcessingInterface.get_1M_data_range(date_range, stock_list).values(),
+                             ignore_index=True)
+        for custom_interval in [3, 5, 15, 30, 60]:
+            # Resampling many days and stocks at once must reproduce the golden output of the day-by-day algorithm
+            output_df = DataProcessingInterface.resample_custom_interval(input_df, custom_interval)
+            reference_df = DataProcessingInterface.get_stock_df_from_file(
+                Path.cwd() / 'tests' / 'test_data' / f'HK.09988_2022-04-11_{custom_interval}M.parquet')
+            output_daily_df = output_df[(output_df['code'] == 'HK.09988') &
+                                        (output_df['time_key'].str[:10] == '2022-04-11')].reset_index(drop=True)
+            pd.testing.assert_frame_equal(output_daily_df[reference_df.columns].astype({'code': str}),
+                                          reference_df.astype({'code': str}), check_dtype=False,
+                                          obj=f'{custom_interval}M')
+
     # def test_convert_day_interval_to_weekly(self):
     #     input_df = yf.Ticker("0700.HK").history(start="2023-01-02", end="2023-02-02", interval="1d")
     #     DataProcessingInterface.convert_day_interval_to_weekly(input_df)
@@ -102,8 +331,654 @@ class TestDataProcessingInterface(unittest.TestCase):
     #                                msg=f"{index} volume")
 
 
+class TestTuShareInterface(unittest.TestCase):
+    def setUp(self):
+        self.data_root = Path(tempfile.mkdtemp())
+        self.stock_list = [f'SZ.{i:06d}' for i in range(1, 46)]
+        trade_dates = pd.bdate_range(end=datetime.date.today(), periods=5).strftime('%Y%m%d')
+        # Stand-in for TuShare pro.daily(), newest trading day first
+        self.daily_df = pd.DataFrame([{'ts_code': f'{i:06d}.SZ', 'trade_date': trade_date, 'open': i, 'close': i + 1,
+                                       'vol': 100 * i, 'amount': 1000 * i} for i in range(1, 46)
+                                      for trade_date in reversed(trade_dates)])
+        self.requests = []
+        self.pro = TuShareInterface.pro
+        TuShareInterface.pro = SimpleNamespace(daily=self.daily)
+
+    def tearDown(self):
+        TuShareInterface.pro = self.pro
+        TuShareInterface.set_output_df(pd.DataFrame(columns=['code', 'time_key']))
+        shutil.rmtree(self.data_root)
+
+    def daily(self, ts_code, start_date, end_date):
+        self.requests.append(ts_code.split(','))
+        return self.daily_df[self.daily_df['ts_code'].isin(ts_code.split(','))]
+
+    def test_update_stocks_history(self):
+        cache_path = self.data_root / 'tushare.parquet'
+        TuShareInterface.update_stocks_history(self.stock_list[:30], cache_path)
+        self.assertListEqual([len(item) for item in self.requests], [20, 10])
+        output_df = TuShareInterface.get_stock_history('SZ.000007')
+        self.assertListEqual(output_df['code'].unique().tolist(), ['000007.SZ'])
+        self.assertTrue(output_df['time_key'].is_monotonic_increasing)
+        self.assertListEqual(output_df['volume'].tolist(), [700] * 5)
+        self.assertTrue(TuShareInterface.get_stock_history('SZ.000040').empty)
+
+        # Reruns on the same day only request the missing stocks
+        self.requests.clear()
+        TuShareInterface.set_output_df(pd.DataFrame(columns=['code', 'time_key']))
+        TuShareInterface.update_stocks_history(self.stock_list, cache_path)
+        self.assertListEqual(self.requests, [[f'{i:06d}.SZ' for i in range(31, 46)]])
+        self.requests.clear()
+        TuShareInterface.update_stocks_history(self.stock_list, cache_path)
+        self.assertListEqual(self.requests, [])
+        for stock_code in ['SZ.000001', 'SZ.000030', 'SZ.000045']:
+            input_df = TuShareInterface.output_df
+            pd.testing.assert_frame_equal(TuShareInterface.get_stock_history(stock_code),
+                                          input_df[input_df['code'] == stock_code[3:] + '.SZ'].reset_index(drop=True))
+
+
+class TestYahooFinanceReport(unittest.TestCase):
+    def setUp(self):
+        self.data_root = Path(tempfile.mkdtemp())
+        self.stock_list = [f'HK.{i:05d}' for i in range(1, 121)]
+        self.requests = []
+        self.ticker_factory = get_ticker_factory(self.requests, lambda symbol: {
+            'price':         {'shortName': symbol, 'longName': 'Holdings', 'regularMarketDayHigh': 10.5,
+                              'regularMarketPrice': 10.2, 'regularMarketChangePercent': 0.0123},
+            'summaryDetail': {'currency': 'HKD', 'previousClose': 10.0, 'volume': 1234567,
+                              'fiftyTwoWeekLow': 8, 'fiftyTwoWeekHigh': 12, 'trailingPE': 9.5},
+            'assetProfile':  {'sector': 'Industrials'}}, '0013.HK')
+
+    def tearDown(self):
+        shutil.rmtree(self.data_root)
+
+    def test_get_stocks_email(self):
+        cache_path = self.data_root / 'report.json'
+        output_dict = YahooFinanceInterface.get_stocks_email(self.stock_list, self.ticker_factory, cache_path)
+        # Multi-symbol calls for all modules at once
+        self.assertListEqual(sorted(len(symbols) for symbols, modules in self.requests), [20, 50, 50])
+        self.assertSetEqual({modules for symbols, modules in self.requests}, {('price', 'summaryDetail',
+                                                                               'assetProfile')})
+        self.assertEqual(len(output_dict), 119)
+        self.assertNotIn('0013.HK', output_dict)
+        self.assertDictEqual(output_dict['0001.HK'], {
+            'Company Name':         '0001.HK Holdings',
+            'Sector':               'Industrials',
+            'Last Close':           'HKD 10.000',
+            'Open':                 'HKD 10.500',
+            'Close':                'HKD 10.200',
+            '% Change':             '1.23%',
+            'Volume':               'HKD 1.2 million',
+            '52 Week Range':        'HKD 8-12',
+            'PE(Trailing/Forward)': '9.5 / N/A'})
+
+        # Cached for the day. Only the symbols without data are requested again
+        self.requests.clear()
+        cached_dict = YahooFinanceInterface.get_stocks_email(self.stock_list[:20], self.ticker_factory, cache_path)
+        self.assertEqual(len(cached_dict), 19)
+        self.assertDictEqual(cached_dict['0001.HK'], output_dict['0001.HK'])
+        self.assertListEqual([symbols for symbols, modules in self.requests], [('0013.HK',)])
+
+
+class TestFundamentalsStore(unittest.TestCase):
+    def setUp(self):
+        self.data_root = Path(tempfile.mkdtemp())
+        self.stock_list = [f'HK.{i:05d}' for i in range(1, 8)]
+        self.requests = []
+        self.ticker_factory = get_ticker_factory(self.requests, lambda symbol: {
+            'price':                {'shortName': symbol, 'currency': 'HKD', 'marketCap': 1e9},
+            'summaryDetail':        {'trailingPE': 9.5, 'forwardPE': 'Infinity', 'marketCap': None},
+            'defaultKeyStatistics': {'priceToBook': 0.8, 'floatShares': {}},
+            'assetProfile':         {'sector': 'Industrials'}}, '0003.HK')
+        self.fundamentals = FundamentalsStore(self.data_root / 'fundamentals.parquet',
+                                              ticker_factory=self.ticker_factory, chunk_size=3)
+
+    def tearDown(self):
+        shutil.rmtree(self.data_root)
+
+    def test_update(self):
+        self.assertEqual(self.fundamentals.update(self.stock_list), 6)
+        self.assertListEqual(sorted(len(symbols) for symbols, modules in self.requests), [1, 3, 3])
+        fundamentals_df = self.fundamentals.get_fundamentals_df()
+        self.assertEqual(fundamentals_df['marketCap'].dtype, np.float64)
+        self.assertTrue(np.isnan(fundamentals_df.loc['HK.00001', 'floatShares']))
+        self.assertDictEqual({field: self.fundamentals.get_info('HK.00001')[field] for field in
+                              ['shortName', 'marketCap', 'trailingPE', 'priceToBook', 'sector']},
+                             {'shortName': '0001.HK', 'marketCap': 1e9, 'trailingPE': 9.5, 'priceToBook': 0.8,
+                              'sector': 'Industrials'})
+        self.assertDictEqual(self.fundamentals.get_info('HK.00003'), {})
+        self.assertEqual(self.fundamentals.get_full_info('HK.00002')['forwardPE'], 'Infinity')
+
+        # Only the missing / outdated stocks are requested again
+        self.requests.clear()
+        self.assertEqual(FundamentalsStore(self.fundamentals.store_path, ticker_factory=self.ticker_factory).update(
+            self.stock_list + ['HK.00008']), 1)
+        self.assertListEqual([symbols for symbols, modules in self.requests], [('0003.HK', '0008.HK')])
+        self.requests.clear()
+        self.assertEqual(self.fundamentals.update(self.stock_list[:2], max_age_days=0), 2)
+        self.assertListEqual([symbols for symbols, modules in self.requests], [('0001.HK', '0002.HK')])
+
+    def test_stock_filter(self):
+        self.fundamentals.update(self.stock_list)
+        info_datas = []
+        stock_filter = SimpleNamespace(validate=lambda quant_data, info_data: info_datas.append(info_data) or True)
+        history_df = pd.DataFrame({'open': [10.0], 'high': [10.0], 'low': [10.0], 'close': [10.0], 'volume': [1e6]},
+                                  index=pd.DatetimeIndex(['2022-04-29'], name='date'))
+        StockFilter([stock_filter], self.stock_list, fundamentals=self.fundamentals).validate_stock('HK.00001',
+                                                                                                    history_df)
+        self.assertEqual(info_datas[0]['trailingPE'], 9.5)
+
+
+class TestDataCatalog(unittest.TestCase):
+    def setUp(self):
+        self.data_root = Path(tempfile.mkdtemp())
+        self.stock_code = 'HK.09988'
+        shutil.copytree(Path.cwd() / 'data' / self.stock_code, self.data_root / self.stock_code)
+        self.data_catalog = DataCatalog(root=self.data_root)
+
+    def tearDown(self):
+        self.data_catalog.close()
+        shutil.rmtree(self.data_root)
+
+    def test_rebuild(self):
+        self.assertFalse(self.data_catalog.is_available())
+        # Writers do nothing until the catalog is built
+        self.assertFalse(self.data_catalog.record_file(
+            self.data_root / self.stock_code / f'{self.stock_code}_2022-04-11_1M.parquet'))
+        num_files = len(list((self.data_root / self.stock_code).glob('*.parquet')))
+        self.assertEqual(self.data_catalog.rebuild(), num_files)
+        self.assertListEqual(self.data_catalog.get_stock_list(), [self.stock_code])
+
+        output_df = self.data_catalog.get_files(self.stock_code, '1M', '2022-04-12', '2022-04-12')
+        self.assertEqual(len(output_df), 1)
+        self.assertEqual(output_df.loc[0, 'path'].name, f'{self.stock_code}_2022-04-12_1M.parquet')
+        self.assertEqual(output_df.loc[0, 'num_rows'], 331)
+        self.assertEqual(output_df.loc[0, 'num_bytes'], output_df.loc[0, 'path'].stat().st_size)
+        self.assertListEqual(list(self.data_catalog.get_daily_dates(self.stock_code)),
+                             ['2022-04-11', '2022-04-12', '2022-04-13'])
+        self.assertFalse(self.data_catalog.has_partitions(self.stock_code))
+
+    def test_record_file(self):
+        self.data_catalog.rebuild()
+        PartitionedDataStore(root=self.data_root).migrate_stock(self.stock_code, remove_source=True)
+        self.assertTrue(self.data_catalog.has_partitions(self.stock_code))
+        self.assertDictEqual(self.data_catalog.get_daily_dates(self.stock_code), {})
+        output_df = self.data_catalog.get_files(self.stock_code, '1M')
+        self.assertListEqual(output_df[['start_date', 'end_date', 'num_rows']].values.tolist(),
+                             [['2022-04-11', '2022-04-13', 993]])
+        # Writers only record size & mtime. The checksum is computed when the catalog is rebuilt
+        self.assertIsNone(output_df.loc[0, 'checksum'])
+        self.assertTrue(self.data_catalog.is_current(self.stock_code))
+        self.data_catalog.rebuild()
+        output_df = self.data_catalog.get_files(self.stock_code, '1M')
+        self.assertEqual(output_df.loc[0, 'checksum'], DataCatalog.get_checksum(output_df.loc[0, 'path']))
+
+    def test_is_current(self):
+        self.assertFalse(self.data_catalog.is_current(self.stock_code))
+        self.data_catalog.rebuild()
+        self.assertTrue(self.data_catalog.is_current(self.stock_code))
+        # A file written without maintaining the catalog makes it stale for the stock
+        time.sleep(0.05)
+        stock_dir = self.data_root / self.stock_code
+        shutil.copy(stock_dir / f'{self.stock_code}_2022-04-11_1M.parquet',
+                    stock_dir / f'{self.stock_code}_2022-04-14_1M.parquet')
+        self.assertFalse(self.data_catalog.is_current(self.stock_code))
+        self.data_catalog.record_file(stock_dir / f'{self.stock_code}_2022-04-14_1M.parquet')
+        self.assertTrue(self.data_catalog.is_current(self.stock_code))
+        self.assertIn('2022-04-14', self.data_catalog.get_daily_dates(self.stock_code))
+
+    def test_is_current_daily_update(self):
+        self.data_catalog.rebuild()
+        stock_dir = self.data_root / self.stock_code
+        # Writes of a daily update: 1M data, days without data, then the materialized bars & their manifest
+        time.sleep(0.05)
+        input_df = DataProcessingInterface.get_stock_df_from_file(
+            stock_dir / f'{self.stock_code}_2022-04-11_1M.parquet')
+        input_df['time_key'] = input_df['time_key'].str.replace('2022-04-11', '2022-04-14')
+        DataProcessingInterface.save_stock_df_to_file(input_df, stock_dir / f'{self.stock_code}_2022-04-14_1M.parquet')
+        DataProcessingInterface.add_empty_1M_dates(self.stock_code, ['2022-04-15'], root=self.data_root)
+        self.assertGreater(BarCache(root=self.data_root, intervals=[5]).update_stock(self.stock_code), 0)
+        self.assertTrue(self.data_catalog.is_current(self.stock_code))
+        self.assertIn('2022-04-14', self.data_catalog.get_daily_dates(self.stock_code, '5M'))
+
+        # A file written without maintaining the catalog still makes it stale, also across a later manifest write
+        time.sleep(0.05)
+        shutil.copy(stock_dir / f'{self.stock_code}_2022-04-11_1M.parquet',
+                    stock_dir / f'{self.stock_code}_2022-04-18_1M.parquet')
+        DataProcessingInterface.add_empty_1M_dates(self.stock_code, ['2022-04-19'], root=self.data_root)
+        self.assertFalse(self.data_catalog.is_current(self.stock_code))
+
+
+class TestSecurityMaster(unittest.TestCase):
+    def setUp(self):
+        self.data_root = Path(tempfile.mkdtemp())
+        self.source_path = self.data_root / 'ListOfSecurities.csv'
+        self.master_path = self.data_root / 'security_master.parquet'
+        shutil.copy(Path.cwd() / 'data' / 'Stock_Pool' / 'ListOfSecurities.csv', self.source_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.data_root)
+
+    def test_lookup(self):
+        security_master = SecurityMaster(self.source_path, self.master_path)
+        self.assertTrue(self.master_path.is_file())
+        self.assertEqual(security_master.get_board_lot('HK.00001'), 500)
+        self.assertEqual(security_master.get_board_lot('HK.00003'), 1000)
+        self.assertEqual(security_master.get_name('HK.00001'), 'CKH HOLDINGS')
+        self.assertEqual(security_master.get_category('HK.00001'), 'Equity')
+        self.assertIsNone(security_master.get_board_lot('HK.99999'))
+        self.assertListEqual(security_master.get_board_lots(['HK.00003', 'HK.99999', 'HK.00001']).tolist(),
+                             [1000, 0, 500])
+
+        # Identical with parsing the HKEX list row by row
+        input_csv = pd.read_csv(self.source_path, skiprows=2, dtype={'Stock Code': str}).dropna(subset=['Stock Code'])
+        equity_csv = input_csv[input_csv['Category'] == 'Equity']
+        self.assertDictEqual(security_master.get_board_lot_map('Equity'),
+                             {('HK.' + row['Stock Code']): int(row['Board Lot'].replace(',', '')) for index, row in
+                              equity_csv.iterrows()})
+
+    def test_refresh(self):
+        security_master = SecurityMaster(self.source_path, self.master_path)
+        self.assertFalse(security_master.refresh())
+        # A new instance loads the stored master instead of parsing the source again
+        master_mtime = self.master_path.stat().st_mtime_ns
+        pd.testing.assert_frame_equal(SecurityMaster(self.source_path, self.master_path).security_df,
+                                      security_master.security_df)
+        self.assertEqual(self.master_path.stat().st_mtime_ns, master_mtime)
+
+        lines = self.source_path.read_text(encoding='utf-8').splitlines(keepends=True)
+        self.source_path.write_text(''.join(line.replace('CKH HOLDINGS', 'CK HUTCHISON') for line in lines),
+                                    encoding='utf-8')
+        snapshot = security_master.snapshot
+        self.assertTrue(security_master.refresh())
+        self.assertEqual(security_master.get_name('HK.00001'), 'CK HUTCHISON')
+        # Readers holding the previous snapshot are not affected by the reload
+        self.assertEqual(snapshot.names[snapshot.positions['HK.00001']], 'CKH HOLDINGS')
+
+    def test_missing_source(self):
+        security_master = SecurityMaster(self.data_root / 'ListOfSecurities.xlsx', self.master_path)
+        self.assertListEqual(security_master.security_df.columns.tolist(),
+                             [column for column, column_type in SecurityMaster.COLUMNS.values()])
+        with self.assertRaises(FileNotFoundError):
+            security_master.get_board_lot('HK.00001', 0)
+        with self.assertRaises(FileNotFoundError):
+            security_master.get_stock_list()
+
+    def test_update_security_list_full(self):
+        xlsx_content = (Path.cwd() / 'data' / 'Stock_Pool' / 'ListOfSecurities.xlsx').read_bytes()
+        requested_urls = []
+
+        def http_get(url):
+            requested_urls.append(url)
+            return SimpleNamespace(content=xlsx_content, raise_for_status=lambda: None)
+
+        security_master = SecurityMaster(self.data_root / 'ListOfSecurities.xlsx', self.master_path)
+        self.assertTrue(HKEXInterface.update_security_list_full(http_get, security_master))
+        self.assertEqual(len(requested_urls), 1)
+        # The streamed workbook gives the same security master as the CSV export
+        pd.testing.assert_frame_equal(security_master.security_df,
+                                      SecurityMaster.read_security_csv(self.source_path))
+        master_mtime = self.master_path.stat().st_mtime_ns
+        # Identical download, nothing is regenerated
+        self.assertFalse(HKEXInterface.update_security_list_full(http_get, security_master))
+        self.assertEqual(self.master_path.stat().st_mtime_ns, master_mtime)
+
+    def test_get_security_df_full(self):
+        SecurityMaster.set_shared(SecurityMaster(self.source_path, self.master_path))
+        try:
+            output_df = HKEXInterface.get_security_df_full()
+            self.assertListEqual(HKEXInterface.get_equity_list_full()[:2], ['HK.00001', 'HK.00002'])
+        finally:
+            SecurityMaster.set_shared(None)
+        # Same shape as the HKEX list (without the legend of the Spread Table header)
+        input_csv = pd.read_csv(self.source_path, skiprows=2, dtype={'Stock Code': str}).dropna(subset=['Stock Code'])
+        input_csv.drop(input_csv.columns[-1], axis=1, inplace=True)
+        self.assertListEqual(output_df.columns.tolist(), [column.split('\n')[0] for column in input_csv.columns])
+        self.assertListEqual(output_df['Stock Code'].tolist(), input_csv['Stock Code'].tolist())
+        self.assertEqual(output_df.loc[0, 'Board Lot'], 500)
+
+
+class TestYahooHistoryCache(unittest.TestCase):
+    def setUp(self):
+        self.data_root = Path(tempfile.mkdtemp())
+        self.stock_list = ['HK.00001', 'HK.00700', 'HK.09988']
+        dates = pd.bdate_range('2022-01-03', '2022-04-29', name='Date')
+        # Stand-in for the Yahoo Finance history of every ticker in yf.download(group_by='ticker') format
+        self.history_df = pd.concat({YahooFinanceInterface.futu_code_to_yfinance_code(stock_code): pd.DataFrame({
+            'Open':         np.linspace(10, 20, len(dates)) * (i + 1),
+            'High':         np.linspace(11, 21, len(dates)) * (i + 1),
+            'Low':          np.linspace(9, 19, len(dates)) * (i + 1),
+            'Close':        np.linspace(10, 20, len(dates)) * (i + 1),
+            'Volume':       np.arange(len(dates)) * 1000 + 1000,
+            'Dividends':    0.0,
+            'Stock Splits': 0.0}, index=dates) for i, stock_code in enumerate(self.stock_list)}, axis=1)
+        self.requests = []
+        self.history_cache = YahooHistoryCache(self.data_root / 'history.parquet', downloader=self.download,
+                                               chunk_size=2, history_days=30)
+
+    def tearDown(self):
+        shutil.rmtree(self.data_root)
+
+    def download(self, yfinance_codes, start_date, end_date):
+        self.requests.append((tuple(yfinance_codes), start_date))
+        yfinance_codes = [yfinance_code for yfinance_code in yfinance_codes if
+                          yfinance_code in self.history_df.columns.get_level_values(0)]
+        return self.history_df.loc[pd.Timestamp(start_date):pd.Timestamp(end_date) - pd.Timedelta(days=1),
+                                   yfinance_codes]
+
+    def test_update(self):
+        self.assertEqual(self.history_cache.update(self.stock_list, datetime.date(2022, 3, 31)), 3 * 23)
+        self.assertListEqual(self.requests, [(('0001.HK', '0700.HK'), datetime.date(2022, 3, 1)),
+                                             (('9988.HK',), datetime.date(2022, 3, 1))])
+        history_df = self.history_cache.get_history('HK.00700')
+        self.assertListEqual(list(history_df.columns), YahooHistoryCache.COLUMNS)
+        self.assertEqual(history_df.index[-1], pd.Timestamp('2022-03-31'))
+        self.assertAlmostEqual(history_df['close'].iloc[-1], self.history_df.loc['2022-03-31', ('0700.HK', 'Close')])
+
+        # Only the bars since the last cached date are downloaded, and the bars older than 30 days are dropped
+        self.requests.clear()
+        self.assertEqual(self.history_cache.update(self.stock_list, datetime.date(2022, 4, 5)), 3 * 4)
+        self.assertSetEqual({start_date for yfinance_codes, start_date in self.requests}, {datetime.date(2022, 3, 31)})
+        history_df = self.history_cache.get_history_dict(self.stock_list)['HK.09988']
+        self.assertEqual(len(history_df), 22)
+        self.assertEqual(history_df.index[0], pd.Timestamp('2022-03-07'))
+
+        # A new dividend triggers a full download of the adjusted history
+        self.requests.clear()
+        self.history_df.loc['2022-04-06', ('0001.HK', 'Dividends')] = 1.0
+        self.history_df.loc[:, ('0001.HK', 'Close')] -= 1
+        self.history_cache.update(self.stock_list, datetime.date(2022, 4, 6))
+        self.assertIn((('0001.HK',), datetime.date(2022, 3, 7)), self.requests)
+        history_df = self.history_cache.get_history('HK.00001')
+        pd.testing.assert_series_equal(history_df['close'], self.history_df.loc['2022-03-07':'2022-04-06',
+                                                                                ('0001.HK', 'Close')],
+                                       check_names=False, check_freq=False, check_index_type=False)
+
+        # A stock without Yahoo Finance data is only requested again since the last request
+        self.requests.clear()
+        self.assertEqual(self.history_cache.update(['HK.00005'], datetime.date(2022, 4, 6)), 0)
+        self.assertDictEqual(self.history_cache.get_empty_dates(), {'HK.00005': '2022-04-06'})
+        self.history_cache.update(['HK.00005'], datetime.date(2022, 4, 8))
+        self.assertListEqual(self.requests, [(('0005.HK',), datetime.date(2022, 3, 7)),
+                                             (('0005.HK',), datetime.date(2022, 4, 6))])
+        self.assertDictEqual(self.history_cache.get_empty_dates(), {'HK.00005': '2022-04-08'})
+
+    def test_stock_filter(self):
+        from filters.Price_Threshold import PriceThreshold
+        # Keep the bars of 2022 in the store
+        self.history_cache.history_days = (datetime.date.today() - datetime.date(2022, 3, 1)).days
+        self.history_cache.update(self.stock_list, datetime.date(2022, 4, 29))
+        self.requests.clear()
+        # The filters run against the cached bars (only the last cached bar is downloaded again)
+        stock_filter = StockFilter([PriceThreshold(price_threshold=40)], self.stock_list,
+                                   history_cache=self.history_cache)
+        self.assertListEqual(stock_filter.get_filtered_equity_pools(), ['HK.09988'])
+        self.assertSetEqual({start_date for yfinance_codes, start_date in self.requests}, {datetime.date(2022, 4, 29)})
+
+    def test_stock_filter_local(self):
+        from filters.Price_Threshold import PriceThreshold
+        # Covers the local 1D data of 2021
+        self.history_cache.history_days = (datetime.date.today() - datetime.date(2021, 1, 1)).days
+        stock_filter = StockFilter([PriceThreshold(price_threshold=0)], self.stock_list,
+                                   history_cache=self.history_cache, data_source='local')
+        history_dict = stock_filter.get_history_dict()
+        # Only the stock without local 1D data is downloaded
+        self.assertListEqual(self.requests, [(('0001.HK',), self.requests[0][1])])
+        self.assertEqual(history_dict['HK.09988'].index[-1], pd.Timestamp('2021-12-31'))
+        self.assertEqual(history_dict['HK.00001'].index[-1], pd.Timestamp('2022-04-29'))
+        self.assertListEqual(stock_filter.get_filtered_equity_pools(), self.stock_list)
+
+
+class TestDownloadScheduler(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+
+    def clock(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+    def test_token_bucket(self):
+        rate_limiter = TokenBucket(capacity=60, period=30, clock=self.clock, sleep=self.sleep)
+        request_times = []
+        for i in range(150):
+            rate_limiter.acquire()
+            request_times.append(self.now)
+        # The full budget is used immediately, then one token is refilled 30s after each request
+        self.assertEqual(request_times[59], 0)
+        self.assertEqual(request_times[60], 30)
+        self.assertEqual(request_times[149], 60)
+        # Never more than 60 requests within any 30 seconds
+        for i in range(60, len(request_times)):
+            self.assertGreaterEqual(request_times[i] - request_times[i - 60], 30)
+
+    def test_run(self):
+        attempts = {}
+
+        def task(task_name, num_failures):
+            attempts[task_name] = attempts.get(task_name, 0) + 1
+            if attempts[task_name] <= num_failures:
+                raise ConnectionError('Too frequent requests')
+            return True
+
+        delays = []
+        scheduler = DownloadScheduler(max_workers=2, max_retries=2, backoff=1, sleep=delays.append)
+        output_dict = scheduler.run([('HK.00001', lambda: task('HK.00001', 0)),
+                                     ('HK.00002', lambda: task('HK.00002', 2)),
+                                     ('HK.00003', lambda: False)])
+        self.assertCountEqual(output_dict['completed'], ['HK.00001', 'HK.00002'])
+        self.assertListEqual(output_dict['failed'], ['HK.00003'])
+        self.assertEqual(attempts['HK.00002'], 3)
+        # Exponential backoff (2 retries for each of HK.00002 and HK.00003)
+        self.assertCountEqual(delays, [1, 2, 1, 2])
+
+
+class TestDataFrameCache(unittest.TestCase):
+    def setUp(self):
+        self.data_root = Path(tempfile.mkdtemp())
+        self.input_path = self.data_root / 'HK.09988_2022-04-11_1M.parquet'
+        shutil.copy(Path.cwd() / 'data' / 'HK.09988' / self.input_path.name, self.input_path)
+        self.cache = DataFrameCache(memory_budget=10 * 1024 ** 2)
+
+    def tearDown(self):
+        shutil.rmtree(self.data_root)
+
+    def load(self):
+        return pd.read_parquet(self.input_path)
+
+    def test_get(self):
+        output_df = self.cache.get(self.input_path, self.load)
+        self.assertEqual(self.cache.get_stats()['misses'], 1)
+        # Returned DataFrames are copies of the cached one
+        output_df.loc[0, 'close'] = -1
+        pd.testing.assert_frame_equal(self.cache.get(self.input_path, self.load), self.load())
+        self.assertEqual(self.cache.get_stats()['hits'], 1)
+        # Different loader options are cached separately
+        self.cache.get(self.input_path, lambda: self.load()[['close']], options=('close',))
+        self.assertEqual(self.cache.get_stats()['entries'], 2)
+
+    def test_invalidation(self):
+        self.cache.get(self.input_path, self.load)
+        input_df = self.load().iloc[:-1]
+        input_df.to_parquet(self.input_path, index=False)
+        self.assertEqual(self.cache.get(self.input_path, self.load).shape[0], input_df.shape[0])
+        self.assertEqual(self.cache.get_stats()['misses'], 2)
+
+    def test_eviction(self):
+        memory_usage = int(self.load().memory_usage(index=True, deep=True).sum())
+        self.cache = DataFrameCache(memory_budget=int(memory_usage * 1.5))
+        other_path = self.data_root / 'HK.09988_2022-04-12_1M.parquet'
+        shutil.copy(self.input_path, other_path)
+        self.cache.get(self.input_path, self.load)
+        self.cache.get(other_path, lambda: pd.read_parquet(other_path))
+        stats = self.cache.get_stats()
+        self.assertEqual((stats['entries'], stats['evictions']), (1, 1))
+        self.assertLessEqual(stats['memory_usage'], stats['memory_budget'])
+        # The least recently used entry is evicted
+        self.cache.get(other_path, lambda: pd.read_parquet(other_path))
+        self.assertEqual(self.cache.get_stats()['hits'], 1)
+
+
+class TestKLineSchema(unittest.TestCase):
+    def setUp(self):
+        self.data_root = Path(tempfile.mkdtemp())
+        self.source_path = Path.cwd() / 'data' / 'HK.09988' / 'HK.09988_2022-04-11_1M.parquet'
+
+    def tearDown(self):
+        shutil.rmtree(self.data_root)
+
+    def test_round_trip(self):
+        # Legacy files (string time_key) are read into the same typed Dataframe
+        source_df = DataProcessingInterface.get_stock_df_from_file(self.source_path)
+        self.assertIsInstance(source_df['code'].dtype, pd.CategoricalDtype)
+        self.assertTrue(all(pd.api.types.is_numeric_dtype(source_df[column]) for column in KLineSchema.PRICE_COLUMNS))
+
+        output_path = self.data_root / self.source_path.name
+        DataProcessingInterface.save_stock_df_to_file(source_df, output_path)
+        self.assertTrue(pa.types.is_timestamp(pq.read_schema(output_path).field('time_key').type))
+        self.assertLess(output_path.stat().st_size, self.source_path.stat().st_size)
+        pd.testing.assert_frame_equal(DataProcessingInterface.get_stock_df_from_file(output_path), source_df)
+
+        output_df = DataProcessingInterface.get_stock_df_from_file(output_path, parse_dates=True)
+        self.assertTrue(pd.api.types.is_datetime64_dtype(output_df['time_key']))
+        self.assertEqual(output_df['time_key'].iloc[0], pd.Timestamp(source_df['time_key'].iloc[0]))
+
+    def test_get_empty_df(self):
+        output_df = KLineSchema.get_empty_df()
+        self.assertTrue(output_df.empty)
+        self.assertEqual(output_df['volume'].dtype, 'int64')
+        self.assertEqual(output_df['close'].dtype, 'float64')
+
+
+class TestPartitionedDataStore(unittest.TestCase):
+    def setUp(self):
+        self.data_root = Path(tempfile.mkdtemp())
+        self.stock_code = 'HK.09988'
+        shutil.copytree(Path.cwd() / 'data' / self.stock_code, self.data_root / self.stock_code)
+        self.data_store = PartitionedDataStore(root=self.data_root)
+
+    def tearDown(self):
+        shutil.rmtree(self.data_root)
+
+    def test_migrate_stock(self):
+        self.assertEqual(self.data_store.migrate_stock(self.stock_code), 3)
+        partition_list = self.data_store.get_partition_list(self.stock_code)
+        self.assertEqual(len(partition_list), 1)
+        # Per-day files are kept after migration
+        self.assertTrue((self.data_root / self.stock_code / f'{self.stock_code}_2022-04-11_1M.parquet').is_file())
+
+        self.assertEqual(pq.ParquetFile(partition_list[0][2]).metadata.num_row_groups, 3)
+
+    def test_read_stock_df(self):
+        self.data_store.migrate_stock(self.stock_code)
+        reference_df = DataProcessingInterface.get_stock_df_from_file(
+            self.data_root / self.stock_code / f'{self.stock_code}_2022-04-12_1M.parquet')
+
+        output_df = self.data_store.read_stock_df(self.stock_code, '2022-04-12', '2022-04-12')
+        self.assertEqual(output_df.shape, reference_df.shape)
+        self.assertListEqual(output_df['time_key'].tolist(), reference_df['time_key'].tolist())
+        self.assertListEqual(output_df['close'].tolist(), reference_df['close'].tolist())
+
+        output_df = self.data_store.read_stock_df(self.stock_code, '2022-04-12 10:00:00', '2022-04-13 10:00:00',
+                                                  columns=['time_key', 'close'])
+        self.assertListEqual(list(output_df.columns), ['time_key', 'close'])
+        self.assertEqual(output_df['time_key'].min(), '2022-04-12 10:00:00')
+        self.assertEqual(output_df['time_key'].max(), '2022-04-13 10:00:00')
+
+        self.assertTrue(self.data_store.read_stock_df(self.stock_code, '2022-05-01', '2022-05-31').empty)
+
+
+class TestBarCache(unittest.TestCase):
+    def setUp(self):
+        self.data_root = Path(tempfile.mkdtemp())
+        self.stock_code = 'HK.09988'
+        shutil.copytree(Path.cwd() / 'data' / self.stock_code, self.data_root / self.stock_code)
+        self.bar_cache = BarCache(root=self.data_root, intervals=[5, 15])
+        self.date_range = ['2022-04-11', '2022-04-12', '2022-04-13']
+
+    def tearDown(self):
+        shutil.rmtree(self.data_root)
+
+    def test_update_stock(self):
+        self.assertEqual(self.bar_cache.update_stock(self.stock_code), 3)
+        self.assertTrue(self.bar_cache.get_bar_path(self.stock_code, '2022-04-11', 5).is_file())
+        self.assertTrue(self.bar_cache.is_valid(self.stock_code, '2022-04-12', 15))
+        # Nothing changed => Nothing to rebuild
+        self.assertEqual(self.bar_cache.update_stock(self.stock_code), 0)
+
+        # Rewritten but identical source => Only the manifest is refreshed
+        source_path = self.data_root / self.stock_code / f'{self.stock_code}_2022-04-12_1M.parquet'
+        source_df = DataProcessingInterface.get_stock_df_from_file(source_path)
+        DataProcessingInterface.save_stock_df_to_file(source_df, source_path)
+        self.assertEqual(self.bar_cache.update_stock(self.stock_code), 0)
+
+        # Modified source => Only that day is rebuilt
+        source_df.loc[source_df.index[-1], 'close'] += 1
+        DataProcessingInterface.save_stock_df_to_file(source_df, source_path)
+        self.assertFalse(self.bar_cache.is_valid(self.stock_code, '2022-04-12', 5))
+        self.assertEqual(self.bar_cache.update_stock(self.stock_code), 1)
+        self.assertEqual(DataProcessingInterface.get_stock_df_from_file(
+            self.bar_cache.get_bar_path(self.stock_code, '2022-04-12', 5))['close'].iloc[-1],
+                         source_df['close'].iloc[-1])
+
+    def test_get_custom_interval_data_range(self):
+        self.bar_cache.update_stock(self.stock_code, trading_dates=self.date_range[:2])
+        output_df = self.bar_cache.get_custom_interval_data_range(self.date_range, 5, [self.stock_code])[
+            self.stock_code]
+        reference_df = DataProcessingInterface.get_custom_interval_data_range(self.date_range, 5, [self.stock_code])[
+            self.stock_code]
+        pd.testing.assert_frame_equal(output_df, reference_df)
+
+
+class TestTradeLedger(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = Path(tempfile.mkdtemp())
+        self.ledger = TradeLedger(fixed_charge=15.5, perc_charge=0.1097, capacity=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def test_add_fill(self):
+        self.assertEqual(self.ledger.add_fill('2022-04-11 09:31:00', 'HK.00700', 350, 200, 'BUY'), 0)
+        self.assertEqual(self.ledger.add_fill('2022-04-11 09:32:00', 'HK.09988', 98, 200, 'BUY'), 0)
+        realized_pnl = self.ledger.add_fill('2022-04-11 15:00:00', 'HK.00700', 352, 200, 'SELL')
+        # Profit = EBIT - fixed charge * 2 - Percentage Charge (Buy Value + Sale Value)
+        self.assertAlmostEqual(realized_pnl, (352 - 350) * 200 - 2 * 15.5 - (350 + 352) * 200 * 0.1097 / 100 / 2)
+
+        # Partial close of a position with 2 buy fills (average cost), then a short position
+        self.ledger.add_fill('2022-04-12 09:31:00', 'HK.09988', 100, 200, 'BUY')
+        realized_pnl = self.ledger.add_fill('2022-04-12 10:00:00', 'HK.09988', 101, 200, 'SELL')
+        self.assertAlmostEqual(realized_pnl, (101 - 99) * 200 - 15.5 - (98 + 100) * 200 * 0.1097 / 100 / 2 / 2 -
+                               self.ledger.get_commission(101, 200))
+        self.assertEqual(self.ledger.get_position('HK.09988'), 200)
+        self.ledger.add_fill('2022-04-12 10:01:00', 'HK.09988', 102, 400, 'SELL')
+        self.assertEqual(self.ledger.get_position('HK.09988'), -200)
+        self.assertEqual(self.ledger.get_positions_df().at['HK.09988', 'average_cost'], 102)
+        self.assertEqual(self.ledger.get_position('HK.00001'), 0)
+        self.assertEqual(len(self.ledger), 6)
+        with self.assertRaises(ValueError):
+            self.ledger.add_fill('2022-04-12 10:02:00', 'HK.09988', 102, 400, 'HOLD')
+
+        transactions_df = self.ledger.get_transactions_df()
+        self.assertListEqual(transactions_df.columns.tolist(), ['time_key', 'code', 'price', 'quantity', 'trd_side'])
+        self.assertListEqual(transactions_df['trd_side'].tolist(), ['BUY', 'BUY', 'SELL', 'BUY', 'SELL', 'SELL'])
+        self.assertListEqual(transactions_df['code'].tolist()[:3], ['HK.00700', 'HK.09988', 'HK.00700'])
+
+        fills_df = self.ledger.get_fills_df()
+        returns_df = self.ledger.get_returns_df(['2022-04-11', '2022-04-12'], ['HK.00700', 'HK.09988'])
+        self.assertAlmostEqual(returns_df.at['2022-04-11', 'HK.00700'], fills_df['realized_pnl'].iloc[2])
+        self.assertAlmostEqual(returns_df.at['2022-04-12', 'HK.09988'], fills_df['realized_pnl'].iloc[4:].sum())
+        self.assertAlmostEqual(returns_df.to_numpy().sum(), self.ledger.get_positions_df()['realized_pnl'].sum())
+
+        self.ledger.save(self.temp_dir / 'fills.parquet')
+        pd.testing.assert_frame_equal(pd.read_parquet(self.temp_dir / 'fills.parquet'), fills_df)
+
+
 if __name__ == '__main__':
     suite_yahoo_finance = (unittest.TestLoader().loadTestsFromTestCase(TestYahooFinanceInterface))
     suite_data_processing = (unittest.TestLoader().loadTestsFromTestCase(TestDataProcessingInterface))
-    suite = unittest.TestSuite([suite_yahoo_finance, suite_data_processing])
+    suite_data_store = (unittest.TestLoader().loadTestsFromTestCase(TestPartitionedDataStore))
+    suite_bar_cache = (unittest.TestLoader().loadTestsFromTestCase(TestBarCache))
+    suite = unittest.TestSuite([suite_yahoo_finance, suite_data_processing, suite_data_store, suite_bar_cache])
     unittest.TextTestRunner(verbosity=2).run(suite)
@@ -16,12 +16,23 @@
 #  Copyright (c)  billpwchan - All Rights Reserved
 
 
+import datetime
+import shutil
+import tempfile
 import unittest
+from pathlib import Path
 
-from engines import DataProcessingInterface
+import numpy as np
+import pandas as pd
+
+from engines import BacktestingEngine, DataProcessingInterface, SecurityMaster
+from strategies.EMA_Ribbon import EMARibbon
 from strategies.KDJ_Cross import KDJCross
 from strategies.MACD_Cross import MACDCross
+from strategies.RSI_Threshold import RSIThreshold
+from util.bar_buffer import BarBuffer
 from util.global_vars import *
+from util.indicators import EMA, EWM, KDJ, MACD, RSI, SMA, RollingMax, RollingMin
 
 
 class TestStrategy(unittest.TestCase):
@@ -131,6 +142,219 @@ class TestStrategy(unittest.TestCase):
             if row['time_key'] in sell_decision_keys:
                 self.assertTrue(sell_decision)
 
+    def test_EMA_Ribbon_crossover(self):
+        strategy = EMARibbon({self.stock_code: self.preparation_data}, ema_fast=5, ema_slow=8, ema_supp=13,
+                             observation=100)
+        # Independent EMAs over the same bars: a buy is the first bar with EMA-Fast above both other EMAs, a sell the
+        # first bar with EMA-Fast below either of them
+        close = pd.to_numeric(pd.concat([self.preparation_data, self.target_data], ignore_index=True)['close'])
+        fast, slow, supp = [close.ewm(span=span, adjust=False).mean() for span in [5, 8, 13]]
+        above = (fast > slow) & (fast > supp)
+        below = (fast < slow) | (fast < supp)
+        expected_buy = (above & ~above.shift(1, fill_value=True)).iloc[len(self.preparation_data):]
+        expected_sell = (below & ~below.shift(1, fill_value=True)).iloc[len(self.preparation_data):]
+        self.assertTrue(expected_buy.any() and expected_sell.any())
+
+        buy_decisions, sell_decisions = [], []
+        for index, row in self.target_data.iterrows():
+            latest_data = row.to_frame().transpose()
+            latest_data.reset_index(drop=True, inplace=True)
+            strategy.parse_data(latest_data=latest_data)
+            buy_decisions.append(strategy.buy(self.stock_code))
+            sell_decisions.append(strategy.sell(self.stock_code))
+        self.assertListEqual(buy_decisions, expected_buy.tolist())
+        self.assertListEqual(sell_decisions, expected_sell.tolist())
+
+    def test_incremental(self):
+        strategy_samples = {
+            MACDCross:    {'2022-04-13 15:30:00': {'MACD': -0.063, 'MACD_signal': -0.023, 'MACD_hist': -0.079},
+                           '2022-04-13 16:00:00': {'MACD': 0.066, 'MACD_signal': -0.008, 'MACD_hist': 0.148}},
+            KDJCross:     {'2022-04-13 15:00:00': {'%k': 52.524, '%d': 53.634, '%j': 50.303},
+                           '2022-04-13 16:00:00': {'%k': 85.049, '%d': 74.249, '%j': 106.650}},
+            EMARibbon:    {},
+            RSIThreshold: {}
+        }
+        for strategy_class, samples in strategy_samples.items():
+            strategy = strategy_class({self.stock_code: self.preparation_data.copy()})
+            incremental_strategy = strategy_class({self.stock_code: self.preparation_data.copy()}, incremental=True)
+            pd.testing.assert_frame_equal(incremental_strategy.get_input_data_stock_code(self.stock_code),
+                                          strategy.get_input_data_stock_code(self.stock_code), check_dtype=False)
+            for index, row in self.target_data.iterrows():
+                latest_data = row.to_frame().transpose()
+                latest_data.reset_index(drop=True, inplace=True)
+                # The still-forming bar is replaced by the completed bar with the same time_key
+                forming_data = latest_data.copy()
+                forming_data['close'] = forming_data['high']
+                incremental_strategy.parse_data(latest_data=forming_data)
+                incremental_strategy.parse_data(latest_data=latest_data)
+                strategy.parse_data(latest_data=latest_data)
+
+                ta_calculations = incremental_strategy.get_input_data_stock_code(self.stock_code)
+                self.assertListEqual(ta_calculations['time_key'].tolist(),
+                                     strategy.get_input_data_stock_code(self.stock_code)['time_key'].tolist())
+                self.assertEqual(incremental_strategy.buy(self.stock_code), strategy.buy(self.stock_code))
+                self.assertEqual(incremental_strategy.sell(self.stock_code), strategy.sell(self.stock_code))
+                for key, value in samples.get(row['time_key'], {}).items():
+                    self.assertAlmostEqual(ta_calculations[key].iloc[-1], value, delta=0.0006)
+
+    def test_get_signals(self):
+        input_data = DataProcessingInterface.get_1M_data_range(['2022-04-11', '2022-04-12', '2022-04-13'],
+                                                              ['HK.00700', 'HK.09988'])
+        for strategy_class in [MACDCross, EMARibbon, KDJCross, RSIThreshold]:
+            strategy = strategy_class({stock_code: input_df.iloc[:100] for stock_code, input_df in input_data.items()})
+            for stock_code, input_df in input_data.items():
+                signals = strategy.get_signals(input_df)
+                self.assertTrue(signals.index.equals(input_df.index))
+
+                # Per-bar path of the backtesting engine: indicators over the full history, then buy() / sell() on a
+                # window ending at each bar
+                strategy.set_input_data_stock_code(stock_code, input_df.iloc[0:0])
+                strategy.parse_data(latest_data=input_df, backtesting=True)
+                ta_df = strategy.get_input_data_stock_code(stock_code)
+                for column in signals.columns.drop(['buy', 'sell']):
+                    np.testing.assert_allclose(signals[column], ta_df[column], rtol=0, atol=1e-9)
+                buy_decisions, sell_decisions = [], []
+                for index in range(2, input_df.shape[0]):
+                    strategy.set_input_data_stock_code(stock_code, ta_df.iloc[max(index - 100, 0):index + 1])
+                    buy_decisions.append(strategy.buy(stock_code))
+                    sell_decisions.append(strategy.sell(stock_code))
+                self.assertListEqual(signals['buy'].iloc[2:].tolist(), buy_decisions, strategy_class.__name__)
+                self.assertListEqual(signals['sell'].iloc[2:].tolist(), sell_decisions, strategy_class.__name__)
+                self.assertFalse(signals[['buy', 'sell']].iloc[:2].any(axis=None))
+
+
+class TestBacktestingEngine(unittest.TestCase):
+    def setUp(self):
+        self.report_path = Path(tempfile.mkdtemp())
+        # Keep the security master of the backtesting engine out of the data folder
+        shutil.copy(Path.cwd() / 'data' / 'Stock_Pool' / 'ListOfSecurities.csv', self.report_path)
+        SecurityMaster.set_shared(SecurityMaster(self.report_path / 'ListOfSecurities.csv',
+                                                 self.report_path / 'security_master.parquet'))
+
+    def tearDown(self):
+        SecurityMaster.set_shared(None)
+        shutil.rmtree(self.report_path, ignore_errors=True)
+
+    def get_backtesting_engine(self, strategy_class, initial_capital: int) -> BacktestingEngine:
+        bt = BacktestingEngine(stock_list=['HK.00700', 'HK.09988'], start_date=datetime.date(2022, 4, 11),
+                               end_date=datetime.date(2022, 4, 14), observation=100)
+        bt.INITIAL_CAPITAL = bt.capital = initial_capital
+        bt.report_path = self.report_path
+        bt.prepare_input_data_file_1M()
+        self.assertCountEqual(bt.input_data['HK.00700'].columns, strategy_class.REQUIRED_COLUMNS)
+        bt.init_strategy(strategy_class(bt.get_backtesting_init_data()))
+        return bt
+
+    def test_calculate_return_vectorized(self):
+        # A low initial capital also cancels some buy orders (negative capital)
+        for initial_capital in [10 ** 6, 40000]:
+            for strategy_class in [MACDCross, EMARibbon, KDJCross, RSIThreshold]:
+                event_bt = self.get_backtesting_engine(strategy_class, initial_capital)
+                event_bt.calculate_return()
+                vectorized_bt = self.get_backtesting_engine(strategy_class, initial_capital)
+                vectorized_bt.calculate_return_vectorized()
+
+                self.assertFalse(event_bt.transactions.empty)
+                pd.testing.assert_frame_equal(vectorized_bt.transactions, event_bt.transactions)
+                pd.testing.assert_frame_equal(vectorized_bt.returns_df, event_bt.returns_df)
+                self.assertAlmostEqual(vectorized_bt.capital, event_bt.capital, places=6)
+                self.assertDictEqual(vectorized_bt.positions, event_bt.positions)
+        self.assertTrue(any(self.report_path.glob('*_Transactions.csv')))
+
+
+class TestIndicators(unittest.TestCase):
+    def setUp(self):
+        input_df = DataProcessingInterface.get_stock_df_from_file(
+            PATH_DATA / 'HK.09988' / 'HK.09988_2022-04-13_1M.parquet')
+        self.input_df = input_df[['high', 'low', 'close']].astype(float)
+        self.input_df.loc[[5, 40, 41], 'close'] = np.nan
+
+    def assert_incremental(self, indicator, expected: pd.Series, column: str = 'close'):
+        output = []
+        for value in self.input_df[column]:
+            # A still-forming bar first, which is replaced by the completed bar
+            indicator.update(value + 1, replace=False)
+            output.append(indicator.update(value, replace=True))
+        np.testing.assert_allclose(output, expected.to_numpy(), rtol=0, atol=1e-9)
+
+    def test_moving_averages(self):
+        close = self.input_df['close']
+        self.assert_incremental(EWM(com=2), close.ewm(com=2).mean())
+        self.assert_incremental(EWM(com=5, min_periods=6), close.ewm(com=5, min_periods=6).mean())
+        self.assert_incremental(EMA(12), close.ewm(span=12, adjust=False).mean())
+        self.assert_incremental(SMA(9), close.rolling(9).mean())
+        self.assert_incremental(SMA(20, min_periods=3), close.rolling(20, min_periods=3).mean())
+
+    def test_rolling_extremes(self):
+        self.assert_incremental(RollingMax(9), self.input_df['close'].rolling(9).max())
+        self.assert_incremental(RollingMin(9, min_periods=1), self.input_df['close'].rolling(9, min_periods=1).min())
+        self.assert_incremental(RollingMax(30, min_periods=1), self.input_df['high'].rolling(30, min_periods=1).max(),
+                                'high')
+
+    def test_oscillators(self):
+        input_df = self.input_df.dropna()
+        ema_fast = input_df['close'].ewm(span=12, adjust=False).mean()
+        ema_slow = input_df['close'].ewm(span=26, adjust=False).mean()
+        macd = MACD(12, 26, 9)
+        output = np.array([macd.update(close) for close in input_df['close']])
+        np.testing.assert_allclose(output[:, 0], ema_fast - ema_slow, rtol=0, atol=1e-9)
+        np.testing.assert_allclose(output[:, 1], (ema_fast - ema_slow).ewm(span=9, adjust=False).mean(), rtol=0,
+                                   atol=1e-9)
+
+        diff = input_df['close'].diff()
+        gain = diff.clip(lower=0).iloc[1:].ewm(com=5, min_periods=6).mean()
+        loss = diff.clip(upper=0).iloc[1:].ewm(com=5, min_periods=6).mean()
+        rsi = RSI(6)
+        output = [rsi.update(close) for close in input_df['close']]
+        np.testing.assert_allclose(output[1:], 100 - 100 / (1 + abs(gain / loss)), rtol=0, atol=1e-9)
+
+        low = input_df['low'].rolling(9, min_periods=1).min()
+        high = input_df['high'].rolling(9, min_periods=1).max()
+        k = ((input_df['close'] - low) / (high - low) * 100).ewm(com=2).mean()
+        kdj = KDJ(9, 3, 3)
+        output = np.array([kdj.update(high, low, close) for high, low, close in input_df.itertuples(index=False)])
+        np.testing.assert_allclose(output[:, 0], k, rtol=0, atol=1e-9)
+        np.testing.assert_allclose(output[:, 1], k.ewm(com=2).mean(), rtol=0, atol=1e-9)
+
+
+class TestBarBuffer(unittest.TestCase):
+    def setUp(self):
+        self.input_df = DataProcessingInterface.get_stock_df_from_file(
+            PATH_DATA / 'HK.09988' / 'HK.09988_2022-04-13_1M.parquet').astype({'code': str})
+
+    def test_append(self):
+        bars = BarBuffer.from_df(self.input_df.iloc[:10], capacity=20)
+        self.assertEqual(bars.capacity, 20)
+        for record in self.input_df.iloc[10:50].to_dict('records'):
+            # The still-forming bar is replaced by the completed bar with the same time_key
+            self.assertFalse(bars.update({**record, 'close': 0.0}))
+            self.assertTrue(bars.update(record))
+        self.assertEqual(len(bars), 20)
+        pd.testing.assert_frame_equal(bars.to_df(), self.input_df.iloc[30:50].reset_index(drop=True), check_dtype=False)
+
+        # Windows are views of the buffer
+        close = bars.window('close')
+        self.assertTrue(np.shares_memory(close, bars.arrays['close']))
+        np.testing.assert_array_equal(close, self.input_df['close'].iloc[30:50])
+        self.assertEqual(bars.get('close', -1), self.input_df['close'].iloc[49])
+        self.assertEqual(bars.record(-2)['time_key'], self.input_df['time_key'].iloc[48])
+
+        bars.set_column('MACD', np.arange(20.0))
+        bars.set('MACD', -1.0)
+        bars.append(self.input_df.iloc[50].to_dict())
+        np.testing.assert_array_equal(bars.window('MACD', 3), [18.0, -1.0, np.nan])
+
+    def test_extend(self):
+        bars = BarBuffer.from_df(self.input_df.iloc[:10], capacity=20)
+        bars.extend(self.input_df.iloc[9:60])
+        pd.testing.assert_frame_equal(bars.to_df(), self.input_df.iloc[40:60].reset_index(drop=True),
+                                      check_dtype=False)
+        bars.extend(self.input_df.iloc[60:], grow=True)
+        self.assertEqual(len(bars), 20 + self.input_df.shape[0] - 60)
+        pd.testing.assert_frame_equal(bars.to_df(), self.input_df.iloc[40:].reset_index(drop=True), check_dtype=False)
+        bars.truncate(5)
+        self.assertListEqual(bars.to_df()['time_key'].tolist(), self.input_df['time_key'].iloc[-5:].tolist())
+
 
 if __name__ == '__main__':
     suite = (unittest.TestLoader().loadTestsFromTestCase(TestStrategy))
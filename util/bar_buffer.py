@@ -0,0 +1,250 @@
+#  Futu Algo: Algorithmic High-Frequency Trading Framework
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#  Written by Bill Chan <billpwchan@hotmail.com>, 2021
+#  Copyright (c)  billpwchan - All Rights Reserved
+
+
+import numpy as np
+import pandas as pd
+
+
+class BarRecord:
+    """
+        Scalar accessor of one bar in a BarBuffer (e.g., record['close']). Only valid until the next append
+    """
+    __slots__ = ['arrays', 'position']
+
+    def __init__(self, arrays: dict, position: int):
+        self.arrays = arrays
+        self.position = position
+
+    def __getitem__(self, column: str):
+        return self.arrays[column][self.position]
+
+    def __contains__(self, column: str) -> bool:
+        return column in self.arrays
+
+    def to_dict(self) -> dict:
+        return {column: array[self.position] for column, array in self.arrays.items()}
+
+
+class BarBuffer:
+    """
+        Fixed-capacity ring buffer of the bars of one stock, with one NumPy array per column (time_key, OHLCV,
+        the other K-line fields and the indicator outputs of a strategy).
+        Every bar is written twice (at slot i and i + capacity), so the last n bars are always one contiguous slice:
+        window views are zero-copy, and appending / replacing the last bar is O(1). When the buffer is full, appending
+        drops the oldest bar (unless grow=True). A Dataframe is only created on demand (to_df).
+    """
+    PRICE_COLUMNS = ['open', 'close', 'high', 'low']
+
+    def __init__(self, capacity: int, code: str = None, columns: list = None):
+        """
+        :param capacity: Max. number of bars
+        :param code: Stock Code with Format (e.g., HK.00001)
+        :param columns: Numeric columns (Default = time_key & OHLCV). Other columns are added when first written
+        """
+        self.capacity = max(capacity, 1)
+        self.code = code
+        self.start = 0
+        self.size = 0
+        self.arrays = {'time_key': np.empty(2 * self.capacity, dtype=object)}
+        for column in BarBuffer.PRICE_COLUMNS + ['volume'] if columns is None else columns:
+            self.add_column(column)
+
+    @staticmethod
+    def from_df(input_df: pd.DataFrame, capacity: int = 0):
+        """
+            Load the bars of a K-line Dataframe (OHLC converted to numeric)
+        :param input_df: K-line Dataframe of one stock
+        :param capacity: Min. capacity (the capacity also fits all bars of the Dataframe)
+        """
+        code = input_df['code'].iloc[0] if 'code' in input_df.columns and not input_df.empty else None
+        columns = [column for column in input_df.columns if column not in ['code', 'time_key']]
+        bar_buffer = BarBuffer(max(capacity, input_df.shape[0]), code, [])
+        for column in columns:
+            values = input_df[column]
+            if column in BarBuffer.PRICE_COLUMNS or pd.api.types.is_numeric_dtype(values):
+                bar_buffer.add_column(column)
+            else:
+                bar_buffer.add_column(column, dtype=object)
+        bar_buffer.extend(input_df)
+        return bar_buffer
+
+    def __len__(self) -> int:
+        return self.size
+
+    @property
+    def columns(self) -> list:
+        return list(self.arrays)
+
+    def add_column(self, column: str, dtype=np.float64) -> None:
+        if column not in self.arrays:
+            self.arrays[column] = np.full(2 * self.capacity, np.nan) if dtype == np.float64 else \
+                np.empty(2 * self.capacity, dtype=dtype)
+
+    def __position(self, index: int) -> int:
+        if not -self.size <= index < self.size:
+            raise IndexError(f'Bar index {index} out of range ({self.size} bars)')
+        return self.start + index % self.size
+
+    @staticmethod
+    def get_missing_value(array: np.ndarray):
+        return np.nan if array.dtype == np.float64 else None
+
+    def __write(self, slot: int, record) -> None:
+        for column, value in record.items():
+            if column == 'code':
+                self.code = self.code or value
+            elif column not in self.arrays:
+                self.add_column(column, dtype=np.float64 if isinstance(value, (int, float, np.number)) else object)
+        # Columns missing in the record (e.g., indicators not calculated yet) are cleared
+        for column, array in self.arrays.items():
+            value = record.get(column, self.get_missing_value(array))
+            array[slot] = value
+            array[slot + self.capacity] = value
+
+    def reserve(self, capacity: int) -> None:
+        """
+            Increase the capacity (the bars are copied once)
+        """
+        if capacity <= self.capacity:
+            return
+        arrays = {}
+        for column, array in self.arrays.items():
+            arrays[column] = np.full(2 * capacity, np.nan) if array.dtype == np.float64 else \
+                np.empty(2 * capacity, dtype=array.dtype)
+            arrays[column][:self.size] = array[self.start:self.start + self.size]
+            arrays[column][capacity:capacity + self.size] = array[self.start:self.start + self.size]
+        self.arrays, self.capacity, self.start = arrays, capacity, 0
+
+    def append(self, record: dict, grow: bool = False) -> None:
+        """
+            Append a bar. The oldest bar is dropped if the buffer is full (unless grow=True)
+        """
+        if self.size == self.capacity:
+            if grow:
+                self.reserve(2 * self.capacity)
+            else:
+                self.start = (self.start + 1) % self.capacity
+                self.size -= 1
+        self.size += 1
+        self.__write((self.start + self.size - 1) % self.capacity, record)
+
+    def replace_last(self, record: dict) -> None:
+        self.__write((self.start + self.size - 1) % self.capacity, record)
+
+    def update(self, record: dict, grow: bool = False) -> bool:
+        """
+            Append a bar, or replace the last bar if it has the same time_key (i.e., the still-forming bar)
+        :return: True if the last bar is replaced
+        """
+        if self.size and self.arrays['time_key'][self.start + self.size - 1] == record['time_key']:
+            self.replace_last(record)
+            return True
+        self.append(record, grow)
+        return False
+
+    def extend(self, input_df: pd.DataFrame, grow: bool = False) -> None:
+        """
+            Append the bars of a Dataframe (ordered by time_key) in one vectorized write. The first bar replaces the
+            last bar if it has the same time_key
+        """
+        if input_df.empty:
+            return
+        if self.size and self.arrays['time_key'][self.start + self.size - 1] == input_df['time_key'].iloc[0]:
+            self.size -= 1
+        num_bars = input_df.shape[0]
+        if grow and self.size + num_bars > self.capacity:
+            self.reserve(max(2 * self.capacity, self.size + num_bars))
+        num_kept = min(num_bars, self.capacity)
+        slots = (self.start + self.size + np.arange(num_bars - num_kept, num_bars)) % self.capacity
+        for column in input_df.columns:
+            if column == 'code':
+                self.code = self.code or input_df[column].iloc[0]
+                continue
+            values = input_df[column].to_numpy()[num_bars - num_kept:]
+            if column in BarBuffer.PRICE_COLUMNS:
+                values = pd.to_numeric(values)
+            self.add_column(column, dtype=np.float64 if pd.api.types.is_numeric_dtype(values) else object)
+            self.arrays[column][slots] = values
+            self.arrays[column][slots + self.capacity] = values
+        for column, array in self.arrays.items():
+            if column not in input_df.columns:
+                array[slots] = array[slots + self.capacity] = self.get_missing_value(array)
+        num_dropped = max(self.size + num_bars - self.capacity, 0)
+        self.start = (self.start + num_dropped) % self.capacity
+        self.size = min(self.size + num_bars, self.capacity)
+
+    def truncate(self, num_bars: int) -> None:
+        """
+            Keep the last num_bars bars only
+        """
+        if self.size > num_bars:
+            self.start = (self.start + self.size - num_bars) % self.capacity
+            self.size = num_bars
+
+    def window(self, column: str, num_bars: int = None):
+        """
+            Zero-copy view of a column over the last num_bars bars (Default = All)
+        """
+        num_bars = self.size if num_bars is None else min(num_bars, self.size)
+        return self.arrays[column][self.start + self.size - num_bars:self.start + self.size]
+
+    def series(self, column: str) -> pd.Series:
+        """
+            Column over all bars as a Series (sharing the memory of the buffer) for pandas calculations
+        """
+        return pd.Series(self.window(column), copy=False)
+
+    def price_df(self) -> pd.DataFrame:
+        """
+            OHLC of all bars as a Dataframe for vectorized indicator calculations
+        """
+        return pd.DataFrame({column: self.window(column) for column in BarBuffer.PRICE_COLUMNS}, copy=False)
+
+    def get(self, column: str, index: int = -1):
+        """
+            Scalar value of a bar (e.g., get('close', -1) for the last close price)
+        """
+        return self.arrays[column][self.__position(index)]
+
+    def set(self, column: str, value, index: int = -1) -> None:
+        self.add_column(column)
+        position = self.__position(index) % self.capacity
+        self.arrays[column][position] = value
+        self.arrays[column][position + self.capacity] = value
+
+    def set_column(self, column: str, values) -> None:
+        """
+            Write a column over all bars (e.g., an indicator calculated on the window)
+        """
+        self.add_column(column)
+        slots = (self.start + np.arange(self.size)) % self.capacity
+        values = np.asarray(values, dtype=np.float64)
+        self.arrays[column][slots] = values
+        self.arrays[column][slots + self.capacity] = values
+
+    def record(self, index: int = -1) -> BarRecord:
+        return BarRecord(self.arrays, self.__position(index))
+
+    def to_df(self, num_bars: int = None) -> pd.DataFrame:
+        """
+            Copy of the last num_bars bars (Default = All) as a K-line Dataframe
+        """
+        output_df = pd.DataFrame({column: self.window(column, num_bars).copy() for column in self.arrays})
+        if self.code is not None:
+            output_df.insert(0, 'code', self.code)
+        return output_df
@@ -30,11 +30,23 @@ PATH_FILTERS = PATH / 'filters'
 PATH_STRATEGIES = PATH / 'strategies'
 PATH_FILTER_REPORT = PATH / 'stock_filter_report'
 PATH_STRATEGY_REPORT = PATH / 'stock_strategy_report'
+PATH_DATA_REPORT = PATH / 'data_report'
+PATH_DATA_QUARANTINE = PATH / 'data_quarantine'
+PATH_BACKTESTING_REPORT = PATH / 'backtesting_report'
+PATH_TRADING_REPORT = PATH / 'trading_report'
 PATH_LOG = PATH / 'log'
 
 DATETIME_FORMAT_DW = '%Y-%m-%d'
 DATETIME_FORMAT_M = ''
 
+# Continuous trading sessions of HKEX in local time (Morning / Afternoon)
+HK_TRADING_SESSIONS = [('09:30', '12:00'), ('13:00', '16:00')]
+# Christmas Eve, New Year's Eve & Lunar New Year's Eve (Morning session only)
+HK_HALF_DAY_SESSIONS = [('09:30', '12:00')]
+# Time zone & end of the last trading session of each market (by stock code prefix, e.g., HK.00001)
+MARKET_SESSION_END = {'HK': ('Asia/Hong_Kong', HK_TRADING_SESSIONS[-1][1]), 'US': ('America/New_York', '16:00'),
+                      'SH': ('Asia/Shanghai', '15:00'), 'SZ': ('Asia/Shanghai', '15:00')}
+
 ORDER_RETRY_MAX = 3
 
 if not (PATH_CONFIG / 'config.ini').is_file():
@@ -0,0 +1,275 @@
+#  Futu Algo: Algorithmic High-Frequency Trading Framework
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#  Written by Bill Chan <billpwchan@hotmail.com>, 2021
+#  Copyright (c)  billpwchan - All Rights Reserved
+
+"""
+    Incremental technical indicators for live strategy updates.
+    Each indicator keeps its own state (one instance per stock) and is updated with one bar at a time in O(1).
+    update(..., replace=True) replaces the last bar instead of appending a new one, which is used for the still-forming
+    bar of a subscription (same time_key received again).
+    The outputs are identical to the pandas calculations (ewm / rolling) used by the strategies.
+"""
+
+import math
+from collections import deque
+
+
+def divide(numerator: float, denominator: float) -> float:
+    """
+        Float division with the pandas semantics (x / 0 = ±inf, 0 / 0 = NaN)
+    """
+    if denominator == 0:
+        if numerator == 0 or math.isnan(numerator):
+            return math.nan
+        return math.copysign(math.inf, numerator) * math.copysign(1, denominator)
+    return numerator / denominator
+
+
+class EWM:
+    """
+        Exponentially weighted mean. Equivalent to pd.Series.ewm(com, span, alpha, adjust, min_periods).mean()
+        (ignore_na=False)
+    """
+
+    def __init__(self, com: float = None, span: float = None, alpha: float = None, adjust: bool = True,
+                 min_periods: int = 0):
+        if com is not None:
+            alpha = 1 / (1 + com)
+        elif span is not None:
+            alpha = 2 / (span + 1)
+        self.alpha = alpha
+        self.adjust = adjust
+        self.min_periods = max(min_periods, 1)
+        # (weighted mean, weight of the previous observations, number of observations)
+        self.state = (math.nan, 1.0, 0)
+        self.previous_state = self.state
+
+    def update(self, value: float, replace: bool = False) -> float:
+        if replace:
+            self.state = self.previous_state
+        else:
+            self.previous_state = self.state
+        weighted, old_weight, num_obs = self.state
+        is_observation = not math.isnan(value)
+        num_obs += is_observation
+        if not math.isnan(weighted):
+            old_weight *= 1 - self.alpha
+            if is_observation:
+                new_weight = 1 if self.adjust else self.alpha
+                if weighted != value:
+                    weighted = (old_weight * weighted + new_weight * value) / (old_weight + new_weight)
+                old_weight = old_weight + new_weight if self.adjust else 1.0
+        elif is_observation:
+            weighted = value
+        self.state = (weighted, old_weight, num_obs)
+        return weighted if num_obs >= self.min_periods else math.nan
+
+    @property
+    def value(self) -> float:
+        return self.state[0] if self.state[2] >= self.min_periods else math.nan
+
+
+class EMA(EWM):
+    """
+        Exponential moving average. Equivalent to pd.Series.ewm(span=span, adjust=False).mean()
+    """
+
+    def __init__(self, span: int, min_periods: int = 0):
+        super().__init__(span=span, adjust=False, min_periods=min_periods)
+
+
+class SMA:
+    """
+        Simple moving average. Equivalent to pd.Series.rolling(window, min_periods).mean()
+    """
+
+    def __init__(self, window: int, min_periods: int = None):
+        self.window = window
+        self.min_periods = window if min_periods is None else max(min_periods, 1)
+        self.values = deque()
+        self.total = 0.0
+        self.num_valid = 0
+        self.evicted = None
+
+    def __push(self, value: float) -> None:
+        self.evicted = self.values.popleft() if len(self.values) == self.window else None
+        if self.evicted is not None and not math.isnan(self.evicted):
+            self.total -= self.evicted
+            self.num_valid -= 1
+        self.values.append(value)
+        if not math.isnan(value):
+            self.total += value
+            self.num_valid += 1
+
+    def update(self, value: float, replace: bool = False) -> float:
+        if replace and self.values:
+            last_value = self.values.pop()
+            if not math.isnan(last_value):
+                self.total -= last_value
+                self.num_valid -= 1
+            if self.evicted is not None:
+                self.values.appendleft(self.evicted)
+                if not math.isnan(self.evicted):
+                    self.total += self.evicted
+                    self.num_valid += 1
+        self.__push(value)
+        return self.value
+
+    @property
+    def value(self) -> float:
+        return self.total / self.num_valid if self.num_valid >= self.min_periods else math.nan
+
+
+class RollingMax:
+    """
+        Rolling maximum with a monotonic queue (amortized O(1) per bar).
+        Equivalent to pd.Series.rolling(window, min_periods).max()
+    """
+
+    def __init__(self, window: int, min_periods: int = None):
+        self.window = window
+        self.min_periods = window if min_periods is None else max(min_periods, 1)
+        # (bar index, value) in decreasing order of value
+        self.queue = deque()
+        self.valid = deque()
+        self.num_valid = 0
+        self.num_bars = 0
+        # Changes of the last update, undone if the last bar is replaced
+        self.removed_front = []
+        self.removed_back = []
+        self.appended = False
+        self.evicted_valid = None
+
+    @staticmethod
+    def dominates(new_value: float, value: float) -> bool:
+        return new_value >= value
+
+    def __push(self, value: float) -> None:
+        index = self.num_bars
+        self.num_bars += 1
+        self.removed_front, self.removed_back = [], []
+        while self.queue and self.queue[0][0] <= index - self.window:
+            self.removed_front.append(self.queue.popleft())
+        self.evicted_valid = self.valid.popleft() if len(self.valid) == self.window else None
+        self.appended = not math.isnan(value)
+        self.valid.append(self.appended)
+        self.num_valid += self.appended - bool(self.evicted_valid)
+        if self.appended:
+            while self.queue and self.dominates(value, self.queue[-1][1]):
+                self.removed_back.append(self.queue.pop())
+            self.queue.append((index, value))
+
+    def update(self, value: float, replace: bool = False) -> float:
+        if replace and self.num_bars:
+            if self.appended:
+                self.queue.pop()
+            self.queue.extend(reversed(self.removed_back))
+            self.queue.extendleft(reversed(self.removed_front))
+            self.num_valid += bool(self.evicted_valid) - self.valid.pop()
+            if self.evicted_valid is not None:
+                self.valid.appendleft(self.evicted_valid)
+            self.num_bars -= 1
+        self.__push(value)
+        return self.value
+
+    @property
+    def value(self) -> float:
+        return self.queue[0][1] if self.queue and self.num_valid >= self.min_periods else math.nan
+
+
+class RollingMin(RollingMax):
+    """
+        Rolling minimum with a monotonic queue (amortized O(1) per bar).
+        Equivalent to pd.Series.rolling(window, min_periods).min()
+    """
+
+    @staticmethod
+    def dominates(new_value: float, value: float) -> bool:
+        return new_value <= value
+
+
+class MACD:
+    """
+        MACD = EMA(close, fast) - EMA(close, slow), Signal = EMA(MACD, signal), Histogram = MACD - Signal
+    """
+
+    def __init__(self, fast_period: int = 12, slow_period: int = 26, signal_period: int = 9):
+        self.ema_fast = EMA(fast_period)
+        self.ema_slow = EMA(slow_period)
+        self.ema_signal = EMA(signal_period)
+
+    def update(self, close: float, replace: bool = False) -> tuple:
+        """
+        :return: (MACD, Signal, Histogram)
+        """
+        macd = self.ema_fast.update(close, replace) - self.ema_slow.update(close, replace)
+        signal = self.ema_signal.update(macd, replace)
+        return macd, signal, macd - signal
+
+
+class RSI:
+    """
+        Relative Strength Index with Wilder smoothing (α = 1 / period) of the gains and losses.
+        Equivalent to the gains / losses of close.diff() smoothed by ewm(com=period - 1, min_periods=period)
+    """
+
+    def __init__(self, period: int = 14):
+        self.gain = EWM(com=period - 1, min_periods=period)
+        self.loss = EWM(com=period - 1, min_periods=period)
+        # (previous close, whether the averages were updated by the last bar)
+        self.state = (None, False)
+        self.previous_state = self.state
+
+    def update(self, close: float, replace: bool = False) -> float:
+        if replace:
+            self.state = self.previous_state
+        else:
+            self.previous_state = self.state
+        previous_close, updated = self.state
+        # The gains / losses of the replaced bar are only replaced if they were updated
+        replace = replace and updated
+        change = close - previous_close if previous_close is not None else math.nan
+        self.state = (close, not math.isnan(change))
+        if math.isnan(change):
+            return math.nan
+        gain = self.gain.update(max(change, 0.0), replace)
+        loss = self.loss.update(min(change, 0.0), replace)
+        return 100 - divide(100, 1 + abs(divide(gain, loss)))
+
+
+class KDJ:
+    """
+        KDJ (Stochastic Oscillator): RSV = (close - min(low, fast_k)) / (max(high, fast_k) - min(low, fast_k)) * 100,
+        K = EWM(RSV, com=slow_k - 1), D = EWM(K, com=slow_d - 1), J = 3K - 2D. The first fast_k - 1 bars use all
+        available bars
+    """
+
+    def __init__(self, fast_k: int = 9, slow_k: int = 3, slow_d: int = 3):
+        self.low = RollingMin(fast_k, min_periods=1)
+        self.high = RollingMax(fast_k, min_periods=1)
+        self.k = EWM(com=slow_k - 1)
+        self.d = EWM(com=slow_d - 1)
+
+    def update(self, high: float, low: float, close: float, replace: bool = False) -> tuple:
+        """
+        :return: (K, D, J)
+        """
+        lowest = self.low.update(low, replace)
+        highest = self.high.update(high, replace)
+        rsv = divide(close - lowest, highest - lowest) * 100
+        k = self.k.update(rsv, replace)
+        d = self.d.update(k, replace)
+        return k, d, 3 * k - 2 * d